@@ -1,5 +1,4 @@
 from bot.session_manager import Session
-from common.log import logger
 
 """
     e.g.  [
@@ -11,36 +10,18 @@ from common.log import logger
 
 
 class BaiduWenxinSession(Session):
+    # 百度文心不支持system prompt，按问答对丢弃历史消息
+    KEEP_MESSAGES = 0
+    DISCARD_STEP = 2
+
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
         # 百度文心不支持system prompt
         # self.reset()
 
-    def discard_exceeding(self, max_tokens, cur_tokens=None):
-        precise = True
-        try:
-            cur_tokens = self.calc_tokens()
-        except Exception as e:
-            precise = False
-            if cur_tokens is None:
-                raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
-        while cur_tokens > max_tokens:
-            if len(self.messages) >= 2:
-                self.messages.pop(0)
-                self.messages.pop(0)
-            else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
-                break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
-        return cur_tokens
-
-    def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+    def count_message_tokens(self, message) -> int:
+        return num_tokens_from_messages([message], self.model)
 
 
 def num_tokens_from_messages(messages, model):
@@ -2,6 +2,7 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
 
 from bridge.context import Context
 from bridge.reply import Reply
@@ -15,3 +16,14 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def areply(self, query, context: Context = None) -> Reply:
+        """
+        async version of reply, used by the asyncio pipeline
+        bots with a native async http client should override it,
+        the default implementation runs the sync reply in the event loop's executor
+        :param req: received message
+        :return: reply content
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.reply, query, context)
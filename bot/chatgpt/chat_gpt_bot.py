@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import base64
 import time
 
@@ -60,50 +61,20 @@ class ChatGPTBot(Bot, OpenAIImage, OpenAIVision):
             logger.info("[CHATGPT] query={}".format(query))
 
             session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._reply_command(query, session_id)
             if reply:
                 return reply
             session = self.sessions.session_query(query, session_id)
             logger.debug("[CHATGPT] session query={}".format(session.messages))
 
             api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
+            new_args = self._build_args(context)
             # if context.get('stream'):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
             reply_content = self.reply_text(session_id, session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._build_reply(session_id, session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0, context=context)
@@ -117,6 +88,60 @@ class ChatGPTBot(Bot, OpenAIImage, OpenAIVision):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def areply(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        logger.info("[CHATGPT] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._reply_command(query, session_id)
+        if reply:
+            return reply
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+        reply_content = await self.areply_text(session_id, session, context.get("openai_api_key"), args=self._build_args(context))
+        return self._build_reply(session_id, session, reply_content)
+
+    def _reply_command(self, query, session_id):
+        reply = None
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        return reply
+
+    def _build_args(self, context):
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return new_args
+
+    def _build_reply(self, session_id, session, reply_content):
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session_id: str, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -137,87 +162,118 @@ class ChatGPTBot(Bot, OpenAIImage, OpenAIVision):
             response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            content = response.choices[0]["message"]["content"]
-            # fastgpt工具调用格式处理
-            if isinstance(content, list):
-                # {
-                #     "id": "",
-                #     "model": "",
-                #     "usage": {},
-                #     "choices": [
-                #         {
-                #             "message": {
-                #                 "role": "assistant",
-                #                 "content": [
-                #                     {
-                #                         "type": "tool",
-                #                         "tools": [
-                #                             {
-                #                                 "id": "xx",
-                #                                 "toolName": "HTTP请求",
-                #                                 "toolAvatar": "xx",
-                #                                 "functionName": "xx",
-                #                                 "params": "{\"key1\":\"xx\",\"key2\":\"xxx"}",
-                #                                 "response": "xxx"
-                #                             }
-                #                         ]
-                #                     },
-                #                     {
-                #                         "type": "text",
-                #                         "text": {
-                #                             "content": "xxx"
-                #                         }
-                #                     }
-                #                 ]
-                #             },
-                #             "finish_reason": "stop",
-                #             "index": 0
-                #         }
-                #     ]
-                # }
-                for item in content:
-                    if item["type"] == "text":
-                        content = item["text"]["content"]
-                        break
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": content,
-            }
+            return self._parse_response(response)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+            result, retry_delay = self._handle_error(e, session, retry_count)
+            if retry_delay is not None:
+                time.sleep(retry_delay)
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return self.reply_text(session_id, session, api_key, args, retry_count + 1)
             else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
-            if need_retry:
+    async def areply_text(self, session_id: str, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        """
+        async version of reply_text, call openai's ChatCompletion.acreate without holding a thread
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if conf().get("rate_limit_chatgpt") and not await loop.run_in_executor(None, self.tb4chatgpt.get_token):
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            res = await loop.run_in_executor(None, self.do_vision_completion_if_need, session_id, session.messages[-1]['content'])
+            if res:
+                return res
+            response = await openai.ChatCompletion.acreate(api_key=api_key, messages=session.messages, **args)
+            return self._parse_response(response)
+        except Exception as e:
+            result, retry_delay = self._handle_error(e, session, retry_count)
+            if retry_delay is not None:
+                await asyncio.sleep(retry_delay)
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session_id, session, api_key, args, retry_count + 1)
+                return await self.areply_text(session_id, session, api_key, args, retry_count + 1)
             else:
                 return result
 
+    def _parse_response(self, response) -> dict:
+        content = response.choices[0]["message"]["content"]
+        # fastgpt工具调用格式处理
+        if isinstance(content, list):
+            # {
+            #     "id": "",
+            #     "model": "",
+            #     "usage": {},
+            #     "choices": [
+            #         {
+            #             "message": {
+            #                 "role": "assistant",
+            #                 "content": [
+            #                     {
+            #                         "type": "tool",
+            #                         "tools": [
+            #                             {
+            #                                 "id": "xx",
+            #                                 "toolName": "HTTP请求",
+            #                                 "toolAvatar": "xx",
+            #                                 "functionName": "xx",
+            #                                 "params": "{\"key1\":\"xx\",\"key2\":\"xxx"}",
+            #                                 "response": "xxx"
+            #                             }
+            #                         ]
+            #                     },
+            #                     {
+            #                         "type": "text",
+            #                         "text": {
+            #                             "content": "xxx"
+            #                         }
+            #                     }
+            #                 ]
+            #             },
+            #             "finish_reason": "stop",
+            #             "index": 0
+            #         }
+            #     ]
+            # }
+            for item in content:
+                if item["type"] == "text":
+                    content = item["text"]["content"]
+                    break
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": content,
+        }
+
+    def _handle_error(self, e, session, retry_count):
+        """
+        :return: (失败时的回复, 重试前等待的秒数，不重试时为None)
+        """
+        need_retry = retry_count < 2
+        retry_delay = 0
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            retry_delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            retry_delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            retry_delay = 5
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return result, retry_delay if need_retry else None
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
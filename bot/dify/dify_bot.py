@@ -1,17 +1,17 @@
 # encoding:utf-8
+import asyncio
 import io
 import os
 import mimetypes
-import threading
-import json
 
 
 import requests
 from urllib.parse import urlparse, unquote
 
 from bot.bot import Bot
-from lib.dify.dify_client import DifyClient, ChatClient
+from lib.dify.dify_client import AsyncDifyClient, AsyncChatClient, get_chat_client
 from bot.dify.dify_session import DifySession, DifySessionManager
+from bot.dify.dify_sse_parser import DifySSEParser
 from bridge.context import ContextType, Context
 from bridge.reply import Reply, ReplyType
 from common.log import logger
@@ -28,42 +28,11 @@ class DifyBot(Bot):
     def reply(self, query, context: Context=None):
         # acquire reply content
         if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:
-            if context.type == ContextType.IMAGE_CREATE:
-                query = conf().get('image_create_prefix', ['画'])[0] + query
-            logger.info("[DIFY] query={}".format(query))
-            session_id = context["session_id"]
-            # TODO: 适配除微信以外的其他channel
-            channel_type = conf().get("channel_type", "wx")
-            user = None
-            if channel_type in ["wx", "wework", "gewechat"]:
-                user = context["msg"].other_user_nickname if context.get("msg") else "default"
-            elif channel_type in ["wechatcom_app", "wechatmp", "wechatmp_service", "wechatcom_service", "web"]:
-                user = context["msg"].other_user_id if context.get("msg") else "default"
-            else:
-                return Reply(ReplyType.ERROR, f"unsupported channel type: {channel_type}, now dify only support wx, wechatcom_app, wechatmp, wechatmp_service channel")
-            logger.debug(f"[DIFY] dify_user={user}")
-            user = user if user else "default" # 防止用户名为None，当被邀请进的群未设置群名称时用户名为None
-            session = self.sessions.get_session(session_id, user)
-            if context.get("isgroup", False):
-                # 群聊：根据是否是共享会话群来决定是否设置用户信息
-                if not context.get("is_shared_session_group", False):
-                    # 非共享会话群：设置发送者信息
-                    session.set_user_info(context["msg"].actual_user_id, context["msg"].actual_user_nickname)
-                else:
-                    # 共享会话群：不设置用户信息
-                    session.set_user_info('', '')
-                # 设置群聊信息
-                session.set_room_info(context["msg"].other_user_id, context["msg"].other_user_nickname)
-            else:
-                # 私聊：使用发送者信息作为用户信息，房间信息留空
-                session.set_user_info(context["msg"].other_user_id, context["msg"].other_user_nickname)
-                session.set_room_info('', '')
-
-            # 打印设置的session信息
-            logger.debug(f"[DIFY] Session user and room info - user_id: {session.get_user_id()}, user_name: {session.get_user_name()}, room_id: {session.get_room_id()}, room_name: {session.get_room_name()}")
-            logger.debug(f"[DIFY] session={session} query={query}")
-
+            query, session, reply = self._prepare_session(query, context)
+            if reply:
+                return reply
             reply, err = self._reply(query, session, context)
+            self.sessions.save_session(session)
             if err != None:
                 error_msg = conf().get("error_reply", "我暂时遇到了一些问题，请您稍后重试~")
                 reply = Reply(ReplyType.TEXT, error_msg)
@@ -72,6 +41,59 @@ class DifyBot(Bot):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def areply(self, query, context: Context=None):
+        if context.type != ContextType.TEXT and context.type != ContextType.IMAGE_CREATE:
+            return await super().areply(query, context)
+        query, session, reply = self._prepare_session(query, context)
+        if reply:
+            return reply
+        reply, err = await self._areply(query, session, context)
+        self.sessions.save_session(session)
+        if err != None:
+            error_msg = conf().get("error_reply", "我暂时遇到了一些问题，请您稍后重试~")
+            reply = Reply(ReplyType.TEXT, error_msg)
+        return reply
+
+    def _prepare_session(self, query, context: Context):
+        """
+        :return: (query, session, 出错时直接返回的reply)
+        """
+        if context.type == ContextType.IMAGE_CREATE:
+            query = conf().get('image_create_prefix', ['画'])[0] + query
+        logger.info("[DIFY] query={}".format(query))
+        session_id = context["session_id"]
+        # TODO: 适配除微信以外的其他channel
+        channel_type = conf().get("channel_type", "wx")
+        user = None
+        if channel_type in ["wx", "wework", "gewechat"]:
+            user = context["msg"].other_user_nickname if context.get("msg") else "default"
+        elif channel_type in ["wechatcom_app", "wechatmp", "wechatmp_service", "wechatcom_service", "web"]:
+            user = context["msg"].other_user_id if context.get("msg") else "default"
+        else:
+            return query, None, Reply(ReplyType.ERROR, f"unsupported channel type: {channel_type}, now dify only support wx, wechatcom_app, wechatmp, wechatmp_service channel")
+        logger.debug(f"[DIFY] dify_user={user}")
+        user = user if user else "default" # 防止用户名为None，当被邀请进的群未设置群名称时用户名为None
+        session = self.sessions.get_session(session_id, user)
+        if context.get("isgroup", False):
+            # 群聊：根据是否是共享会话群来决定是否设置用户信息
+            if not context.get("is_shared_session_group", False):
+                # 非共享会话群：设置发送者信息
+                session.set_user_info(context["msg"].actual_user_id, context["msg"].actual_user_nickname)
+            else:
+                # 共享会话群：不设置用户信息
+                session.set_user_info('', '')
+            # 设置群聊信息
+            session.set_room_info(context["msg"].other_user_id, context["msg"].other_user_nickname)
+        else:
+            # 私聊：使用发送者信息作为用户信息，房间信息留空
+            session.set_user_info(context["msg"].other_user_id, context["msg"].other_user_nickname)
+            session.set_room_info('', '')
+
+        # 打印设置的session信息
+        logger.debug(f"[DIFY] Session user and room info - user_id: {session.get_user_id()}, user_name: {session.get_user_name()}, room_id: {session.get_room_id()}, room_name: {session.get_room_name()}")
+        logger.debug(f"[DIFY] session={session} query={query}")
+        return query, session, None
+
     # TODO: delete this function
     def _get_payload(self, query, session: DifySession, response_mode):
         # 输入的变量参考 wechat-assistant-pro：https://github.com/leochen-g/wechat-assistant-pro/issues/76
@@ -91,6 +113,16 @@ class DifyBot(Bot):
     def _get_dify_conf(self, context: Context, key, default=None):
         return context.get(key, conf().get(key, default))
 
+    def _get_client(self, api_key, api_base):
+        # custom_dify_app等插件按群覆盖的api_key/api_base也会复用已创建的连接池
+        return get_chat_client(
+            api_key,
+            api_base,
+            pool_size=conf().get("dify_pool_size", 10),
+            timeout=(10, conf().get("dify_request_timeout", 180)),
+            max_retries=conf().get("dify_max_retries", 2),
+        )
+
     def _reply(self, query: str, session: DifySession, context: Context):
         try:
             session.count_user_message() # 限制一个conversation中消息数，防止conversation过长
@@ -109,11 +141,29 @@ class DifyBot(Bot):
             logger.exception(error_info)
             return None, error_info
 
+    async def _areply(self, query: str, session: DifySession, context: Context):
+        try:
+            session.count_user_message() # 限制一个conversation中消息数，防止conversation过长
+            dify_app_type = self._get_dify_conf(context, "dify_app_type", 'chatbot')
+            if dify_app_type == 'chatbot':
+                return await self._ahandle_chatbot(query, session, context)
+            elif dify_app_type == 'agent':
+                return await self._ahandle_agent(query, session, context)
+            elif dify_app_type == 'workflow':
+                return await self._ahandle_workflow(query, session, context)
+            else:
+                return None, "dify_app_type must be agent, chatbot or workflow"
+
+        except Exception as e:
+            error_info = f"[DIFY] Exception: {e}"
+            logger.exception(error_info)
+            return None, error_info
+
     def _handle_chatbot(self, query: str, session: DifySession, context: Context):
         api_key = self._get_dify_conf(context, "dify_api_key", '')
         api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
-        chat_client = ChatClient(api_key, api_base)
-        response_mode = 'blocking'
+        chat_client = self._get_client(api_key, api_base)
+        response_mode = self._get_dify_conf(context, "dify_response_mode", 'blocking')
         payload = self._get_payload(query, session, response_mode)
         files = self._get_upload_files(session, context)
         response = chat_client.create_chat_message(
@@ -129,6 +179,8 @@ class DifyBot(Bot):
             error_info = f"[DIFY] payload={payload} response text={response.text} status_code={response.status_code}"
             logger.warn(error_info)
             return None, error_info
+        if response_mode == 'streaming':
+            return self._handle_streaming_response(response, session, context, parse_markdown=True)
 
         # response:
         # {
@@ -145,76 +197,143 @@ class DifyBot(Bot):
         #     "created_at": 1705407629
         # }
         rsp_data = response.json()
+        return self._build_chatbot_reply(rsp_data, session, context)
+
+    async def _ahandle_chatbot(self, query: str, session: DifySession, context: Context):
+        api_key = self._get_dify_conf(context, "dify_api_key", '')
+        api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
+        chat_client = AsyncChatClient(api_key, api_base, timeout=conf().get("dify_request_timeout", 180))
+        response_mode = self._get_dify_conf(context, "dify_response_mode", 'blocking')
+        payload = self._get_payload(query, session, response_mode)
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(None, self._get_upload_files, session, context)
+        async with await chat_client.create_chat_message(
+            inputs=payload['inputs'],
+            query=payload['query'],
+            user=payload['user'],
+            response_mode=payload['response_mode'],
+            conversation_id=payload['conversation_id'],
+            files=files
+        ) as response:
+            if response.status != 200:
+                error_info = f"[DIFY] payload={payload} response text={await response.text()} status_code={response.status}"
+                logger.warn(error_info)
+                return None, error_info
+            if response_mode == 'streaming':
+                return await self._ahandle_streaming_response(response, session, context, parse_markdown=True)
+            rsp_data = await response.json(content_type=None)
+        # 结果中的图片、文件下载及中间消息发送为同步调用，放到线程池执行
+        return await loop.run_in_executor(None, self._build_chatbot_reply, rsp_data, session, context)
+
+    def _build_chatbot_reply(self, rsp_data: dict, session: DifySession, context: Context):
         logger.debug("[DIFY] usage {}".format(rsp_data.get('metadata', {}).get('usage', 0)))
 
         answer = rsp_data['answer']
-        parsed_content = parse_markdown_text(answer)
-
         # {"answer": "![image](/files/tools/dbf9cd7c-2110-4383-9ba8-50d9fd1a4815.png?timestamp=1713970391&nonce=0d5badf2e39466042113a4ba9fd9bf83&sign=OVmdCxCEuEYwc9add3YNFFdUpn4VdFKgl84Cg54iLnU=)"}
-        at_prefix = ""
+        replies = (self._markdown_item_to_reply(item, context) for item in parse_markdown_text(answer))
+        # parsed_content 没有数据时，final_reply为None，直接不回复
+        final_reply = self._send_replies(replies, context, hold_last=True)
+
+        # 设置dify conversation_id, 依靠dify管理上下文
+        if session.get_conversation_id() == '':
+            session.set_conversation_id(rsp_data['conversation_id'])
+
+        return final_reply, None
+
+    def _markdown_item_to_reply(self, item: dict, context: Context):
         channel = context.get("channel")
-        is_group = context.get("isgroup", False)
-        if is_group:
-            at_prefix = "@" + context["msg"].actual_user_nickname + "\n"
-        for item in parsed_content[:-1]:
-            reply = None
-            if item['type'] == 'text':
-                content = at_prefix + item['content']
-                reply = Reply(ReplyType.TEXT, content)
-            elif item['type'] == 'image':
-                image_url = self._fill_file_base_url(item['content'])
-                image = self._download_image(image_url)
-                if image:
-                    if channel.channel_type == "gewechat":
-                        reply = Reply(ReplyType.IMAGE_URL, image_url)
-                    else:
-                        reply = Reply(ReplyType.IMAGE, image)
-                else:
-                    reply = Reply(ReplyType.TEXT, f"图片链接：{image_url}")
-            elif item['type'] == 'file':
-                file_url = self._fill_file_base_url(item['content'])
-                file_path = self._download_file(file_url)
-                if file_path:
-                    reply = Reply(ReplyType.FILE, file_path)
-                else:
-                    reply = Reply(ReplyType.TEXT, f"文件链接：{file_url}")
-            logger.debug(f"[DIFY] reply={reply}")
-            if reply and channel:
-                channel.send(reply, context)
-        # parsed_content 没有数据时，直接不回复
-        if not parsed_content:
-            return None, None
-        final_item = parsed_content[-1]
-        final_reply = None
-        if final_item['type'] == 'text':
-            content = final_item['content']
-            if is_group:
-                at_prefix = "@" + context["msg"].actual_user_nickname + "\n"
-                content = at_prefix + content
-            final_reply = Reply(ReplyType.TEXT, final_item['content'])
-        elif final_item['type'] == 'image':
-            image_url = self._fill_file_base_url(final_item['content'])
+        reply = None
+        if item['type'] == 'text':
+            reply = Reply(ReplyType.TEXT, item['content'])
+        elif item['type'] == 'image':
+            image_url = self._fill_file_base_url(item['content'])
             image = self._download_image(image_url)
             if image:
-                if channel.channel_type == "gewechat":
-                    final_reply = Reply(ReplyType.IMAGE_URL, image_url)
+                if channel and channel.channel_type == "gewechat":
+                    reply = Reply(ReplyType.IMAGE_URL, image_url)
                 else:
-                    final_reply = Reply(ReplyType.IMAGE, image)
+                    reply = Reply(ReplyType.IMAGE, image)
             else:
-                final_reply = Reply(ReplyType.TEXT, f"图片链接：{image_url}")
-        elif final_item['type'] == 'file':
-            file_url = self._fill_file_base_url(final_item['content'])
+                reply = Reply(ReplyType.TEXT, f"图片链接：{image_url}")
+        elif item['type'] == 'file':
+            file_url = self._fill_file_base_url(item['content'])
             file_path = self._download_file(file_url)
             if file_path:
-                final_reply = Reply(ReplyType.FILE, file_path)
+                reply = Reply(ReplyType.FILE, file_path)
             else:
-                final_reply = Reply(ReplyType.TEXT, f"文件链接：{file_url}")
+                reply = Reply(ReplyType.TEXT, f"文件链接：{file_url}")
+        logger.debug(f"[DIFY] reply={reply}")
+        return reply
+
+    def _segment_to_replies(self, segment: dict, context: Context, parse_markdown: bool) -> list:
+        if segment['type'] == 'message_file':
+            return [Reply(ReplyType.IMAGE_URL, self._fill_file_base_url(segment['content']['url']))]
+        if parse_markdown:
+            return [self._markdown_item_to_reply(item, context) for item in parse_markdown_text(segment['content'])]
+        return [Reply(ReplyType.TEXT, segment['content'])]
+
+    def _send_replies(self, replies, context: Context, hold_last=False):
+        """
+        依次发送回复；hold_last为True时最后一条不发送，作为返回值交给channel按正常流程装饰和发送
+        """
+        pending = None
+        for reply in replies:
+            if not reply:
+                continue
+            if not hold_last:
+                self._send_segment(reply, context)
+                continue
+            if pending:
+                self._send_segment(pending, context)
+            pending = reply
+        return pending
+
+    def _send_segments(self, segments: list, context: Context, parse_markdown: bool, final: bool):
+        """
+        片段一经解析出来就立即发送；只有响应结束后的最后一条回复留作返回值
+        """
+        replies = (reply for segment in segments
+                   for reply in self._segment_to_replies(segment, context, parse_markdown))
+        return self._send_replies(replies, context, hold_last=final)
+
+    def _send_segment(self, reply: Reply, context: Context):
+        channel = context.get("channel")
+        if not channel:
+            return
+        if hasattr(channel, "send_segment"):
+            channel.send_segment(reply, context)
+        else:
+            channel.send(reply, context)
 
+    def _handle_streaming_response(self, response, session: DifySession, context: Context, parse_markdown=False):
+        parser = DifySSEParser(self._get_dify_conf(context, "dify_stream_segment_chars", 0))
+        try:
+            reply = None
+            for segments, final in parser.iter_lines(response.iter_lines()):
+                reply = self._send_segments(segments, context, parse_markdown, final)
+        finally:
+            response.close()  # 读取到message_end后可能还有未读数据，关闭后连接才能放回连接池
         # 设置dify conversation_id, 依靠dify管理上下文
         if session.get_conversation_id() == '':
-            session.set_conversation_id(rsp_data['conversation_id'])
+            session.set_conversation_id(parser.conversation_id)
+        return reply, None
 
-        return final_reply, None
+    async def _ahandle_streaming_response(self, response, session: DifySession, context: Context, parse_markdown=False):
+        loop = asyncio.get_running_loop()
+        parser = DifySSEParser(self._get_dify_conf(context, "dify_stream_segment_chars", 0))
+        # 图片、文件下载和发送为同步调用，放到线程池执行
+        async for line in response.content:
+            segments = parser.feed_line(line)
+            if parser.finished:
+                break
+            if segments:
+                await loop.run_in_executor(None, self._send_segments, segments, context, parse_markdown, False)
+        else:
+            segments = []
+        reply = await loop.run_in_executor(None, self._send_segments, segments + parser.finish(), context, parse_markdown, True)
+        if session.get_conversation_id() == '':
+            session.set_conversation_id(parser.conversation_id)
+        return reply, None
 
     def _download_file(self, url):
         try:
@@ -253,7 +372,7 @@ class DifyBot(Bot):
     def _handle_agent(self, query: str, session: DifySession, context: Context):
         api_key = self._get_dify_conf(context, "dify_api_key", '')
         api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
-        chat_client = ChatClient(api_key, api_base)
+        chat_client = self._get_client(api_key, api_base)
         response_mode = 'streaming'
         payload = self._get_payload(query, session, response_mode)
         files = self._get_upload_files(session, context)
@@ -275,39 +394,34 @@ class DifyBot(Bot):
         # data: {"event": "agent_thought", "id": "8dcf3648-fbad-407a-85dd-73a6f43aeb9f", "task_id": "9cf1ddd7-f94b-459b-b942-b77b26c59e9b", "message_id": "1fb10045-55fd-4040-99e6-d048d07cbad3", "position": 1, "thought": "", "observation": "", "tool": "dalle3", "tool_input": "{\"dalle3\": {\"prompt\": \"cute Japanese anime girl with white hair, blue eyes, bunny girl suit\"}}", "created_at": 1705639511, "message_files": [], "conversation_id": "c216c595-2d89-438c-b33c-aae5ddddd142"}
         # data: {"event": "agent_message", "id": "1fb10045-55fd-4040-99e6-d048d07cbad3", "task_id": "9cf1ddd7-f94b-459b-b942-b77b26c59e9b", "message_id": "1fb10045-55fd-4040-99e6-d048d07cbad3", "answer": "I have created an image of a cute Japanese", "created_at": 1705639511, "conversation_id": "c216c595-2d89-438c-b33c-aae5ddddd142"}
         # data: {"event": "message_end", "task_id": "9cf1ddd7-f94b-459b-b942-b77b26c59e9b", "id": "1fb10045-55fd-4040-99e6-d048d07cbad3", "message_id": "1fb10045-55fd-4040-99e6-d048d07cbad3", "conversation_id": "c216c595-2d89-438c-b33c-aae5ddddd142", "metadata": {"usage": {"prompt_tokens": 305, "prompt_unit_price": "0.001", "prompt_price_unit": "0.001", "prompt_price": "0.0003050", "completion_tokens": 97, "completion_unit_price": "0.002", "completion_price_unit": "0.001", "completion_price": "0.0001940", "total_tokens": 184, "total_price": "0.0002290", "currency": "USD", "latency": 1.771092874929309}}}
-        msgs, conversation_id = self._handle_sse_response(response)
-        channel = context.get("channel")
-        # TODO: 适配除微信以外的其他channel
-        is_group = context.get("isgroup", False)
-        for msg in msgs[:-1]:
-            if msg['type'] == 'agent_message':
-                if is_group:
-                    at_prefix = "@" + context["msg"].actual_user_nickname + "\n"
-                    msg['content'] = at_prefix + msg['content']
-                reply = Reply(ReplyType.TEXT, msg['content'])
-                channel.send(reply, context)
-            elif msg['type'] == 'message_file':
-                url = self._fill_file_base_url(msg['content']['url'])
-                reply = Reply(ReplyType.IMAGE_URL, url)
-                thread = threading.Thread(target=channel.send, args=(reply, context))
-                thread.start()
-        final_msg = msgs[-1]
-        reply = None
-        if final_msg['type'] == 'agent_message':
-            reply = Reply(ReplyType.TEXT, final_msg['content'])
-        elif final_msg['type'] == 'message_file':
-            url = self._fill_file_base_url(final_msg['content']['url'])
-            reply = Reply(ReplyType.IMAGE_URL, url)
-        # 设置dify conversation_id, 依靠dify管理上下文
-        if session.get_conversation_id() == '':
-            session.set_conversation_id(conversation_id)
-        return reply, None
+        return self._handle_streaming_response(response, session, context)
+
+    async def _ahandle_agent(self, query: str, session: DifySession, context: Context):
+        api_key = self._get_dify_conf(context, "dify_api_key", '')
+        api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
+        chat_client = AsyncChatClient(api_key, api_base, timeout=conf().get("dify_request_timeout", 180))
+        payload = self._get_payload(query, session, 'streaming')
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(None, self._get_upload_files, session, context)
+        async with await chat_client.create_chat_message(
+            inputs=payload['inputs'],
+            query=payload['query'],
+            user=payload['user'],
+            response_mode=payload['response_mode'],
+            conversation_id=payload['conversation_id'],
+            files=files
+        ) as response:
+            if response.status != 200:
+                error_info = f"[DIFY] payload={payload} response text={await response.text()} status_code={response.status}"
+                logger.warn(error_info)
+                return None, error_info
+            return await self._ahandle_streaming_response(response, session, context)
 
     def _handle_workflow(self, query: str, session: DifySession, context: Context):
         payload = self._get_workflow_payload(query, session)
         api_key = self._get_dify_conf(context, "dify_api_key", '')
         api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
-        dify_client = DifyClient(api_key, api_base)
+        dify_client = self._get_client(api_key, api_base)
         response = dify_client._send_request("POST", "/workflows/run", json=payload)
         if response.status_code != 200:
             error_info = f"[DIFY] payload={payload} response text={response.text} status_code={response.status_code}"
@@ -334,6 +448,22 @@ class DifyBot(Bot):
         #  }
 
         rsp_data = response.json()
+        return self._build_workflow_reply(rsp_data)
+
+    async def _ahandle_workflow(self, query: str, session: DifySession, context: Context):
+        payload = self._get_workflow_payload(query, session)
+        api_key = self._get_dify_conf(context, "dify_api_key", '')
+        api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
+        dify_client = AsyncDifyClient(api_key, api_base, timeout=conf().get("dify_request_timeout", 180))
+        async with await dify_client._send_request("POST", "/workflows/run", json=payload) as response:
+            if response.status != 200:
+                error_info = f"[DIFY] payload={payload} response text={await response.text()} status_code={response.status}"
+                logger.warn(error_info)
+                return None, error_info
+            rsp_data = await response.json(content_type=None)
+        return self._build_workflow_reply(rsp_data)
+
+    def _build_workflow_reply(self, rsp_data: dict):
         if 'data' not in rsp_data or 'outputs' not in rsp_data['data'] or 'text' not in rsp_data['data']['outputs']:
             error_info = f"[DIFY] Unexpected response format: {rsp_data}"
             logger.warn(error_info)
@@ -350,7 +480,7 @@ class DifyBot(Bot):
         memory.USER_IMAGE_CACHE[session_id] = None
         api_key = self._get_dify_conf(context, "dify_api_key", '')
         api_base = self._get_dify_conf(context, "dify_api_base", "https://api.dify.ai/v1")
-        dify_client = DifyClient(api_key, api_base)
+        dify_client = self._get_client(api_key, api_base)
         session_user = session.get_user()
         
         uploaded_files = []
@@ -415,86 +545,3 @@ class DifyBot(Bot):
             "response_mode": "blocking",
             "user": session.get_user()
         }
-
-    def _parse_sse_event(self, event_str):
-        """
-        Parses a single SSE event string and returns a dictionary of its data.
-        """
-        event_prefix = "data: "
-        if not event_str.startswith(event_prefix):
-            return None
-        trimmed_event_str = event_str[len(event_prefix):]
-
-        # Check if trimmed_event_str is not empty and is a valid JSON string
-        if trimmed_event_str:
-            try:
-                event = json.loads(trimmed_event_str)
-                return event
-            except json.JSONDecodeError:
-                logger.error(f"Failed to decode JSON from SSE event: {trimmed_event_str}")
-                return None
-        else:
-            logger.warn("Received an empty SSE event.")
-            return None
-
-    # TODO: 异步返回events
-    def _handle_sse_response(self, response: requests.Response):
-        events = []
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                event = self._parse_sse_event(decoded_line)
-                if event:
-                    events.append(event)
-
-        merged_message = []
-        accumulated_agent_message = ''
-        conversation_id = None
-        for event in events:
-            event_name = event['event']
-            if event_name == 'agent_message' or event_name == 'message':
-                accumulated_agent_message += event['answer']
-                logger.debug("[DIFY] accumulated_agent_message: {}".format(accumulated_agent_message))
-                # 保存conversation_id
-                if not conversation_id:
-                    conversation_id = event['conversation_id']
-            elif event_name == 'agent_thought':
-                self._append_agent_message(accumulated_agent_message, merged_message)
-                accumulated_agent_message = ''
-                logger.debug("[DIFY] agent_thought: {}".format(event))
-            elif event_name == 'message_file':
-                self._append_agent_message(accumulated_agent_message, merged_message)
-                accumulated_agent_message = ''
-                self._append_message_file(event, merged_message)
-            elif event_name == 'message_replace':
-                # TODO: handle message_replace
-                pass
-            elif event_name == 'error':
-                logger.error("[DIFY] error: {}".format(event))
-                raise Exception(event)
-            elif event_name == 'message_end':
-                self._append_agent_message(accumulated_agent_message, merged_message)
-                logger.debug("[DIFY] message_end usage: {}".format(event['metadata']['usage']))
-                break
-            else:
-                logger.warn("[DIFY] unknown event: {}".format(event))
-
-        if not conversation_id:
-            raise Exception("conversation_id not found")
-
-        return merged_message, conversation_id
-
-    def _append_agent_message(self, accumulated_agent_message,  merged_message):
-        if accumulated_agent_message:
-            merged_message.append({
-                'type': 'agent_message',
-                'content': accumulated_agent_message,
-            })
-
-    def _append_message_file(self, event: dict, merged_message: list):
-        if event.get('type') != 'image':
-            logger.warn("[DIFY] unsupported message file type: {}".format(event))
-        merged_message.append({
-            'type': 'message_file',
-            'content': event,
-        })
@@ -1,4 +1,6 @@
 from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.session_store import create_session_store
 from config import conf
 
 
@@ -58,9 +60,35 @@ class DifySession(object):
         
         self._user_message_counter += 1
 
+    def to_dict(self) -> dict:
+        """
+        导出会话状态用于持久化
+        """
+        return {
+            "user": self._user,
+            "conversation_id": self._conversation_id,
+            "user_message_counter": self._user_message_counter,
+            "user_id": self._user_id,
+            "user_name": self._user_name,
+            "room_id": self._room_id,
+            "room_name": self._room_name,
+        }
+
+    def load_dict(self, data: dict):
+        self._conversation_id = data.get("conversation_id", '')
+        self._user_message_counter = data.get("user_message_counter", 0)
+        self._user_id = data.get("user_id", '')
+        self._user_name = data.get("user_name", '')
+        self._room_id = data.get("room_id", '')
+        self._room_name = data.get("room_name", '')
+
 class DifySessionManager(object):
     def __init__(self, sessioncls, **session_kwargs):
-        if conf().get("expires_in_seconds"):
+        self.store = create_session_store(sessioncls.__name__, conf().get("expires_in_seconds"))
+        if self.store:
+            # 开启持久化后内存中只保留活跃会话，其余会话在首次访问时从存储中加载
+            sessions = ExpiredDict(conf().get("expires_in_seconds") or 3600, max_size=conf().get("session_cache_size", 1000))
+        elif conf().get("expires_in_seconds"):
             sessions = ExpiredDict(conf().get("expires_in_seconds"))
         else:
             sessions = dict()
@@ -76,7 +104,7 @@ class DifySessionManager(object):
             return self.sessioncls(session_id, user)
 
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, user)
+            self.sessions[session_id] = self._load_session(session_id, user) or self.sessioncls(session_id, user)
         session = self.sessions[session_id]
         return session
 
@@ -84,9 +112,31 @@ class DifySessionManager(object):
         session = self._build_session(session_id, user)
         return session
 
+    def save_session(self, session: DifySession):
+        if self.store and session.get_session_id() is not None:
+            self.store.put(session.get_session_id(), session.to_dict())
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.store:
+            self.store.delete(session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.store:
+            self.store.clear()
+
+    def _load_session(self, session_id: str, user: str):
+        if not self.store:
+            return None
+        try:
+            data = self.store.get(session_id)
+        except Exception as e:
+            logger.warning("[SessionStore] load session {} failed: {}".format(session_id, e))
+            return None
+        if not data:
+            return None
+        session = self.sessioncls(session_id, data.get("user") or user)
+        session.load_dict(data)
+        return session
@@ -0,0 +1,128 @@
+import json
+
+from common.log import logger
+
+# 句子结束符，开启按长度分段时在这些字符处切分
+SENTENCE_DELIMITERS = "。！？!?\n"
+# chatflow等应用中与回复内容无关的事件
+IGNORED_EVENTS = ["workflow_started", "node_started", "node_finished", "workflow_finished", "ping", "tts_message", "tts_message_end"]
+
+
+class DifySSEParser(object):
+    """
+    增量解析dify的SSE响应，每当一段回复完整时就返回该片段，不必等到message_end
+    片段格式: {'type': 'agent_message', 'content': 文本} 或 {'type': 'message_file', 'content': message_file事件}
+    """
+
+    def __init__(self, segment_chars=0):
+        """
+        :param segment_chars: 大于0时，累积的文本超过该长度后在最近的句子边界切分为一个片段；否则只在agent_thought、message_file和message_end处切分
+        """
+        self.segment_chars = segment_chars
+        self.conversation_id = None
+        self.finished = False
+        self._accumulated = ""
+
+    def iter_lines(self, lines):
+        """
+        从SSE响应的行迭代器中产出(片段列表, 是否为最后一批)，每读到一行就产出该行完成的片段
+        """
+        for line in lines:
+            segments = self.feed_line(line)
+            if self.finished:
+                yield segments + self.finish(), True
+                return
+            if segments:
+                yield segments, False
+        yield self.finish(), True
+
+    def feed_line(self, line) -> list:
+        if self.finished or not line:
+            return []
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        event = parse_sse_event(line.strip())
+        if not event:
+            return []
+        return self.feed_event(event)
+
+    def feed_event(self, event: dict) -> list:
+        segments = []
+        event_name = event["event"]
+        if event_name == "agent_message" or event_name == "message":
+            self._accumulated += event["answer"]
+            # 保存conversation_id
+            if not self.conversation_id:
+                self.conversation_id = event["conversation_id"]
+            if self.segment_chars > 0 and len(self._accumulated) >= self.segment_chars:
+                self._flush_sentences(segments)
+        elif event_name == "agent_thought":
+            self._flush(segments)
+            logger.debug("[DIFY] agent_thought: {}".format(event))
+        elif event_name == "message_file":
+            self._flush(segments)
+            if event.get("type") != "image":
+                logger.warn("[DIFY] unsupported message file type: {}".format(event))
+            segments.append({"type": "message_file", "content": event})
+        elif event_name == "message_replace":
+            # TODO: handle message_replace
+            pass
+        elif event_name == "error":
+            logger.error("[DIFY] error: {}".format(event))
+            raise Exception(event)
+        elif event_name == "message_end":
+            self._flush(segments)
+            self.finished = True
+            logger.debug("[DIFY] message_end usage: {}".format(event.get("metadata", {}).get("usage")))
+        elif event_name in IGNORED_EVENTS:
+            logger.debug("[DIFY] {}: {}".format(event_name, event))
+        else:
+            logger.warn("[DIFY] unknown event: {}".format(event))
+        return segments
+
+    def finish(self) -> list:
+        """
+        响应结束时调用，返回剩余的片段
+        """
+        segments = []
+        self._flush(segments)
+        self.finished = True
+        if not self.conversation_id:
+            raise Exception("conversation_id not found")
+        return segments
+
+    def _flush(self, segments: list):
+        if self._accumulated:
+            segments.append({"type": "agent_message", "content": self._accumulated})
+            self._accumulated = ""
+
+    def _flush_sentences(self, segments: list):
+        end = max(self._accumulated.rfind(c) for c in SENTENCE_DELIMITERS)
+        if end < 0:
+            return
+        content = self._accumulated[: end + 1].strip()
+        self._accumulated = self._accumulated[end + 1:]
+        if content:
+            segments.append({"type": "agent_message", "content": content})
+
+
+def parse_sse_event(event_str):
+    """
+    Parses a single SSE event string and returns a dictionary of its data.
+    """
+    event_prefix = "data: "
+    if not event_str.startswith(event_prefix):
+        return None
+    trimmed_event_str = event_str[len(event_prefix):]
+
+    # Check if trimmed_event_str is not empty and is a valid JSON string
+    if trimmed_event_str:
+        try:
+            event = json.loads(trimmed_event_str)
+            return event
+        except json.JSONDecodeError:
+            logger.error(f"Failed to decode JSON from SSE event: {trimmed_event_str}")
+            return None
+    else:
+        logger.warn("Received an empty SSE event.")
+        return None
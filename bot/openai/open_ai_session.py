@@ -1,8 +1,12 @@
+import functools
+
 from bot.session_manager import Session
-from common.log import logger
 
 
 class OpenAISession(Session):
+    # 补全模型没有system消息，从第一条消息开始丢弃
+    KEEP_MESSAGES = 0
+
     def __init__(self, session_id, system_prompt=None, model="text-davinci-003"):
         super().__init__(session_id, system_prompt)
         self.model = model
@@ -15,59 +19,38 @@ class OpenAISession(Session):
               A: xxx
               Q: xxx
         """
-        prompt = ""
-        for item in self.messages:
-            if item["role"] == "system":
-                prompt += item["content"] + "<|endoftext|>\n\n\n"
-            elif item["role"] == "user":
-                prompt += "Q: " + item["content"] + "\n"
-            elif item["role"] == "assistant":
-                prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
-
+        prompt = "".join(self._format_message(item) for item in self.messages)
         if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
             prompt += "A: "
         return prompt
 
-    def discard_exceeding(self, max_tokens, cur_tokens=None):
-        precise = True
-        try:
-            cur_tokens = self.calc_tokens()
-        except Exception as e:
-            precise = False
-            if cur_tokens is None:
-                raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
-        while cur_tokens > max_tokens:
-            if len(self.messages) > 1:
-                self.messages.pop(0)
-            elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
-                self.messages.pop(0)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = len(str(self))
-                break
-            elif len(self.messages) == 1 and self.messages[0]["role"] == "user":
-                logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
-                break
-            else:
-                logger.debug("max_tokens={}, total_tokens={}, len(conversation)={}".format(max_tokens, cur_tokens, len(self.messages)))
-                break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = len(str(self))
-        return cur_tokens
+    def _format_message(self, item):
+        if item["role"] == "system":
+            return item["content"] + "<|endoftext|>\n\n\n"
+        elif item["role"] == "user":
+            return "Q: " + item["content"] + "\n"
+        elif item["role"] == "assistant":
+            return "\n\nA: " + item["content"] + "<|endoftext|>\n"
+        return ""
 
-    def calc_tokens(self):
-        return num_tokens_from_string(str(self), self.model)
+    def count_message_tokens(self, message) -> int:
+        # 按消息分段编码，与整段prompt编码的结果可能相差几个token
+        return num_tokens_from_string(self._format_message(message), self.model)
+
+    def estimate_tokens(self, cur_tokens, max_tokens, discarded):
+        return sum(len(self._format_message(item)) for item in self.messages[discarded:])
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
-
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = _get_encoding(model)
     num_tokens = len(encoding.encode(string, disallowed_special=()))
     return num_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model):
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
@@ -1,9 +1,15 @@
 from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.session_store import create_session_store
 from config import conf
 
 
 class Session(object):
+    # 裁剪历史时始终保留的前几条消息，默认为system prompt
+    KEEP_MESSAGES = 1
+    # 每次丢弃的历史消息条数
+    DISCARD_STEP = 1
+
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
@@ -11,6 +17,7 @@ class Session(object):
             self.system_prompt = conf().get("character_desc", "")
         else:
             self.system_prompt = system_prompt
+        self._token_cache = {}  # id(message) -> (message, 内容快照, token数)
 
     # 重置会话
     def reset(self):
@@ -29,16 +36,102 @@ class Session(object):
         assistant_item = {"role": "assistant", "content": reply}
         self.messages.append(assistant_item)
 
+    def to_dict(self) -> dict:
+        """
+        导出会话状态用于持久化
+        """
+        return {"system_prompt": self.system_prompt, "messages": list(self.messages)}
+
+    def load_dict(self, data: dict):
+        self.system_prompt = data.get("system_prompt", self.system_prompt)
+        self.messages = data.get("messages", [])
+
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
-        raise NotImplementedError
+        """
+        从最早的历史消息开始丢弃，直到token数不超过max_tokens，返回丢弃后的token数
+        每条消息的token数在首次计算后缓存，裁剪时一次遍历完成
+        """
+        precise = True
+        try:
+            message_tokens = [self.message_tokens(message) for message in self.messages]
+            cur_tokens = self.base_tokens() + sum(message_tokens)
+        except Exception as e:
+            precise = False
+            if cur_tokens is None:
+                raise e
+            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        start = min(self.KEEP_MESSAGES, len(self.messages))
+        while cur_tokens > max_tokens:
+            remaining = len(self.messages) - start
+            if remaining > 1:
+                end = start + min(self.DISCARD_STEP, remaining)
+            elif remaining == 1 and self.is_reply(self.messages[start]):
+                end = start + 1
+            elif remaining == 1:
+                logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
+                break
+            else:
+                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                break
+            if precise:
+                cur_tokens -= sum(message_tokens[start:end])
+            else:
+                cur_tokens = self.estimate_tokens(cur_tokens, max_tokens, end)
+            start = end
+            if remaining == 1:
+                break
+        del self.messages[min(self.KEEP_MESSAGES, len(self.messages)):start]
+        return cur_tokens
 
     def calc_tokens(self):
+        return self.base_tokens() + sum(self.message_tokens(message) for message in self.messages)
+
+    def message_tokens(self, message) -> int:
+        """
+        返回单条消息的token数，消息内容不变时使用缓存结果
+        """
+        key = id(message)
+        snapshot = tuple(message.values())
+        cached = self._token_cache.get(key)
+        if cached and cached[0] is message and cached[1] == snapshot:
+            return cached[2]
+        tokens = self.count_message_tokens(message)
+        if len(self._token_cache) > 2 * len(self.messages) + 16:
+            # 清理已被移出会话的消息
+            alive = set(id(m) for m in self.messages)
+            self._token_cache = {k: v for k, v in self._token_cache.items() if k in alive}
+        self._token_cache[key] = (message, snapshot, tokens)
+        return tokens
+
+    def count_message_tokens(self, message) -> int:
+        """
+        计算单条消息的token数，子类按模型的计数规则实现
+        """
         raise NotImplementedError
 
+    def base_tokens(self) -> int:
+        """
+        与消息无关的固定token开销
+        """
+        return 0
+
+    def is_reply(self, message) -> bool:
+        return message.get("role") == "assistant"
+
+    def estimate_tokens(self, cur_tokens, max_tokens, discarded):
+        """
+        无法精确计算token数时，丢弃消息后估算剩余token数，discarded为已丢弃到的消息下标
+        """
+        return cur_tokens - max_tokens
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
+        self.store = create_session_store("{}:{}".format(sessioncls.__name__, session_args.get("model", "")), conf().get("expires_in_seconds"))
+        if self.store:
+            # 开启持久化后内存中只保留活跃会话，其余会话在首次访问时从存储中加载
+            sessions = ExpiredDict(conf().get("expires_in_seconds") or 3600, max_size=conf().get("session_cache_size", 1000))
+        elif conf().get("expires_in_seconds"):
             sessions = ExpiredDict(conf().get("expires_in_seconds"))
         else:
             sessions = dict()
@@ -55,9 +148,16 @@ class SessionManager(object):
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self._load_session(session_id)
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            elif system_prompt is not None:
+                session.set_system_prompt(system_prompt)
+                self.save_session(session)
+            self.sessions[session_id] = session
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+            self.save_session(self.sessions[session_id])
         session = self.sessions[session_id]
         return session
 
@@ -70,6 +170,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +182,34 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
+    def save_session(self, session):
+        if self.store and session.session_id is not None:
+            self.store.put(session.session_id, session.to_dict())
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.store:
+            self.store.delete(session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.store:
+            self.store.clear()
+
+    def _load_session(self, session_id):
+        if not self.store:
+            return None
+        try:
+            data = self.store.get(session_id)
+        except Exception as e:
+            logger.warning("[SessionStore] load session {} failed: {}".format(session_id, e))
+            return None
+        if not data:
+            return None
+        session = self.sessioncls(session_id, data.get("system_prompt"), **self.session_args)
+        session.load_dict(data)
+        return session
@@ -1,15 +1,22 @@
+import asyncio
 import os
-import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future
+from functools import partial
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.fair_queue import FairQueue
+from channel.request_quota import RequestQuota, estimate_tokens
+from channel.trigger_matcher import get_trigger_matcher
 from common.dequeue import Dequeue
 from common import memory
+from common.event_loop import get_event_loop
+from common.send_scheduler import PRIORITY_COMMAND, PRIORITY_REPLY, get_send_scheduler
+from common.thread_pool import ElasticThreadPool
 from plugins import *
 
 try:
@@ -17,7 +24,9 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+# 处理消息的线程池，容量在创建channel时按配置调整
+handler_pool = ElasticThreadPool("handler_pool", min_workers=2, max_workers=32)  # 慢速通道：模型调用、语音转换等
+fast_handler_pool = ElasticThreadPool("fast_handler_pool", min_workers=1, max_workers=8)  # 快速通道：管理命令、好友申请、退群等
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
@@ -27,8 +36,16 @@ class ChatChannel(Channel):
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
     lock = threading.Lock()  # 用于控制对sessions的访问
+    ready_sessions = FairQueue()  # 有待处理消息的session_id，produce和任务结束时写入，consume按群/用户公平读取
+    send_rate_limited = False  # 是否通过发送调度器限速发送，个人微信类渠道开启以避免触发频率限制
 
     def __init__(self):
+        idle_timeout = conf().get("handler_pool_idle_seconds", 60)
+        handler_pool.resize(conf().get("handler_pool_min_workers", 2), conf().get("handler_pool_max_workers", 32), idle_timeout)
+        fast_handler_pool.resize(1, conf().get("fast_handler_pool_max_workers", 8), idle_timeout)
+        if conf().get("fair_scheduling", True):
+            self.ready_sessions.configure(conf().get("fair_dispatch_slots", 0) or conf().get("handler_pool_max_workers", 32))
+        self.quota = RequestQuota()
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -47,8 +64,8 @@ class ChatChannel(Channel):
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
         # 群名匹配过程，设置session_id和receiver
+        matcher = get_trigger_matcher()
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
             cmsg = context["msg"]
             user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
@@ -58,24 +75,10 @@ class ChatChannel(Channel):
                 group_id = cmsg.other_user_id
                 context["group_name"] = group_name
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                        [
-                            group_name in group_name_white_list,
-                            "ALL_GROUP" in group_name_white_list,
-                            check_contain(group_name, group_name_keyword_white_list),
-                        ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.is_group_allowed(group_name):
                     session_id = f"{cmsg.actual_user_id}@@{group_id}" # 当群聊未共享session时，session_id为user_id与group_id的组合，用于区分不同群聊以及单聊
                     context["is_shared_session_group"] = False  # 默认为非共享会话群
-                    if any(
-                            [
-                                group_name in group_chat_in_one_session,
-                                "ALL_GROUP" in group_chat_in_one_session,
-                            ]
-                    ):
+                    if matcher.is_group_in_one_session(group_name):
                         session_id = group_id
                         context["is_shared_session_group"] = True  # 如果是共享会话群，设置为True
                 else:
@@ -91,17 +94,16 @@ class ChatChannel(Channel):
             context = e_context["context"]
             if e_context.is_pass() or context is None:
                 return context
-            if cmsg.from_user_id == self.user_id and not config.get("trigger_by_self", True):
+            if cmsg.from_user_id == self.user_id and not matcher.trigger_by_self:
                 logger.debug("[chat_channel]self message skipped")
                 return None
 
         # 消息内容匹配过程，并处理content
         if ctype == ContextType.TEXT:
-            nick_name_black_list = conf().get("nick_name_black_list", [])
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.match_group_chat_prefix(content)
+                match_contain = matcher.match_group_chat_keyword(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
                     if match_prefix is not None or match_contain is not None:
@@ -110,25 +112,22 @@ class ChatChannel(Channel):
                             content = content.replace(match_prefix, "", 1).strip()
                     if context["msg"].is_at:
                         nick_name = context["msg"].actual_user_nickname
-                        if nick_name and nick_name in nick_name_black_list:
+                        if matcher.is_nick_name_blocked(nick_name):
                             # 黑名单过滤
                             logger.warning(f"[chat_channel] Nickname {nick_name} in In BlackList, ignore")
                             return None
 
                         logger.info("[chat_channel]receive group at")
-                        if not conf().get("group_at_off", False):
+                        if not matcher.group_at_off:
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = matcher.remove_at(content, self.name)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = matcher.remove_at(subtract_res, at)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = matcher.remove_at(content, context["msg"].self_display_name)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -136,12 +135,12 @@ class ChatChannel(Channel):
                     return None
             else:  # 单聊
                 nick_name = context["msg"].from_user_nickname
-                if nick_name and nick_name in nick_name_black_list:
+                if matcher.is_nick_name_blocked(nick_name):
                     # 黑名单过滤
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.match_single_chat_prefix(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -149,19 +148,17 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = matcher.match_image_create_prefix(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get(
-                    "always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and matcher.always_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get(
-                    "voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and matcher.voice_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
@@ -176,6 +173,7 @@ class ChatChannel(Channel):
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
         # reply的构建步骤
         reply = self._generate_reply(context)
+        self._charge_reply(context, reply)
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
@@ -186,6 +184,48 @@ class ChatChannel(Channel):
             # reply的发送步骤
             self._send_reply(context, reply)
 
+    # 异步流水线的处理入口，在全局事件循环中执行，模型调用不再独占线程
+    async def _ahandle(self, context: Context):
+        if context is None or not context.content:
+            return
+        loop = asyncio.get_running_loop()
+        ### 魔改部分
+        if context.type == ContextType.TEXT:
+            if "生成" in context.content and "图片" in context.content:
+                await loop.run_in_executor(None, self._send_reply, context, Reply(ReplyType.TEXT, "收到~"))
+        ###
+        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        reply = await self._agenerate_reply(context)
+        self._charge_reply(context, reply)
+
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+
+        if reply and reply.content:
+            # 装饰和发送可能涉及语音合成、渠道接口等同步调用，放到线程池执行
+            reply = await loop.run_in_executor(None, self._decorate_reply, context, reply)
+            await loop.run_in_executor(None, self._send_reply, context, reply)
+
+    async def _agenerate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        e_context = await PluginManager().aemit_event(
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            )
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+                context["channel"] = e_context["channel"]
+                # 超出额度时可能同步发送提示，放到线程池执行
+                if not await asyncio.get_running_loop().run_in_executor(None, self._admit_unhandled_command, context):
+                    return None
+                reply = await super().abuild_reply_content(context.content, context)
+            else:
+                loop = asyncio.get_running_loop()
+                reply = await loop.run_in_executor(None, self._generate_default_reply, context, reply)
+        return reply
+
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
             EventContext(
@@ -198,57 +238,65 @@ class ChatChannel(Channel):
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
+                if not self._admit_unhandled_command(context):
+                    return None
                 reply = super().build_reply_content(context.content, context)
-            elif context.type == ContextType.VOICE:  # 语音消息
-                cmsg = context["msg"]
-                cmsg.prepare()
-                file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
-                # 删除临时文件
-                try:
-                    os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
-                except Exception as e:
-                    pass
-                    # logger.warning("[chat_channel]delete temp file error: " + str(e))
+            else:
+                reply = self._generate_default_reply(context, reply)
+        return reply
 
-                if reply.type == ReplyType.TEXT:
-                    new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
-                    if new_context:
-                        reply = self._generate_reply(new_context)
-                    else:
-                        return
-            elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
-                session_id = context["session_id"]
-                    
-                if session_id not in memory.USER_IMAGE_CACHE:
-                    memory.USER_IMAGE_CACHE[session_id] = []
+    # 文字和图片消息以外的默认处理逻辑
+    def _generate_default_reply(self, context: Context, reply: Reply) -> Reply:
+        if context.type == ContextType.VOICE:  # 语音消息
+            cmsg = context["msg"]
+            cmsg.prepare()
+            file_path = context.content
+            wav_path = os.path.splitext(file_path)[0] + ".wav"
+            try:
+                any_to_wav(file_path, wav_path)
+            except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+                logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
+                wav_path = file_path
+            # 语音识别
+            reply = super().build_voice_to_text(wav_path)
+            # 删除临时文件
+            try:
+                os.remove(file_path)
+                if wav_path != file_path:
+                    os.remove(wav_path)
+            except Exception as e:
+                pass
+                # logger.warning("[chat_channel]delete temp file error: " + str(e))
+
+            if reply.type == ReplyType.TEXT:
+                new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
+                if new_context:
+                    reply = self._generate_reply(new_context)
                 else:
-                    if not memory.USER_IMAGE_CACHE[session_id]:
-                        memory.USER_IMAGE_CACHE[session_id] = []
+                    return
+        elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
+            session_id = context["session_id"]
                 
-                memory.USER_IMAGE_CACHE[session_id].append({
-                    "path": context.content,
-                    "msg": context.get("msg"),
-                    "timestamp": time.time()  # 添加时间戳便于管理
-                })
-            elif context.type == ContextType.ACCEPT_FRIEND:  # 好友申请，匹配字符串
-                reply = self._build_friend_request_reply(context)
-            elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
-                pass
-            elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
-                pass
+            if session_id not in memory.USER_IMAGE_CACHE:
+                memory.USER_IMAGE_CACHE[session_id] = []
             else:
-                logger.warning("[chat_channel] unknown context type: {}".format(context.type))
-                return
+                if not memory.USER_IMAGE_CACHE[session_id]:
+                    memory.USER_IMAGE_CACHE[session_id] = []
+            
+            memory.USER_IMAGE_CACHE[session_id].append({
+                "path": context.content,
+                "msg": context.get("msg"),
+                "timestamp": time.time()  # 添加时间戳便于管理
+            })
+        elif context.type == ContextType.ACCEPT_FRIEND:  # 好友申请，匹配字符串
+            reply = self._build_friend_request_reply(context)
+        elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
+            pass
+        elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+            pass
+        else:
+            logger.warning("[chat_channel] unknown context type: {}".format(context.type))
+            return
         return reply
 
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
@@ -307,7 +355,19 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
                 self._send(reply, context)
 
+    def send_segment(self, reply: Reply, context: Context):
+        """
+        流式回复中，在最终回复之前发送已生成的片段，片段与最终回复一样经过装饰和插件处理
+        """
+        reply = self._decorate_reply(context, reply)
+        self._send_reply(context, reply)
+
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
+        if self.send_rate_limited and conf().get("send_scheduler_enabled", True):
+            # 交给发送调度器排队限速，失败重试不再阻塞处理线程
+            priority = PRIORITY_COMMAND if self._select_handler_pool(context) is fast_handler_pool else PRIORITY_REPLY
+            get_send_scheduler(self.send_account()).submit(context.get("receiver"), partial(self.send, reply, context), priority, desc=str(reply.type))
+            return
         try:
             self.send(reply, context)
         except Exception as e:
@@ -350,70 +410,194 @@ class ChatChannel(Channel):
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
-                self.sessions[session_id][1].release()
+                context_queue, semaphore, flow, weight = self.sessions[session_id]
+                semaphore.release()
+                if not context_queue.empty():
+                    # 释放了一个并发名额，唤醒消费者继续处理该会话
+                    urgent = self._select_handler_pool(context_queue.queue[0]) is fast_handler_pool
+                    self.ready_sessions.put(session_id, flow, weight, urgent=urgent)
+                else:
+                    self._try_release_session(session_id)
 
         return func
 
     def produce(self, context: Context):
         session_id = context.get("session_id", 0)
+        urgent = self._select_handler_pool(context) is fast_handler_pool
+        flow, weight = self._flow_of(context)
+        if not urgent and not self._admit(context, flow):  # 管理命令等由插件处理的消息入队时不受额度限制
+            return
         with self.lock:
             if session_id not in self.sessions:
                 self.sessions[session_id] = [
                     Dequeue(),
                     threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+                    flow,
+                    weight,
                 ]
             if context.type == ContextType.TEXT and context.content.startswith("#"):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
             else:
                 self.sessions[session_id][0].put(context)
+            self.ready_sessions.put(session_id, flow, weight, urgent=urgent)
+
+    # 群聊消息按群归为一个流，私聊消息按会话归流，流之间公平分发
+    def _flow_of(self, context: Context):
+        if not conf().get("fair_scheduling", True):
+            return "*", 1  # 所有会话同属一个流，按到达顺序分发
+        if context.get("isgroup", False):
+            return context.get("receiver"), conf().get("fair_group_weight", 1)
+        return context.get("session_id", 0), conf().get("fair_private_weight", 1)
+
+    # 超出额度或所在流排队过多的消息在入队前丢弃，返回是否允许入队
+    def _admit(self, context: Context, flow) -> bool:
+        max_pending = conf().get("fair_max_pending_per_flow", 50)
+        if max_pending and flow != "*" and self.ready_sessions.pending(flow) >= max_pending:
+            self.quota.count_queue_shed()
+            logger.warning("[chat_channel] too many pending messages in {}, drop message".format(flow))
+            return False
+        user, group = self._quota_keys(context)
+        who = self.quota.admit(user, group, context.content if context.type == ContextType.TEXT else "")
+        if who is None:
+            return True
+        self._quota_exceeded(context, who, user, group)
+        return False
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 入队时免于额度检查的管理命令未被插件处理、将要调用模型时，在此补做额度检查
+    def _admit_unhandled_command(self, context: Context) -> bool:
+        if self._select_handler_pool(context) is not fast_handler_pool:
+            return True
+        user, group = self._quota_keys(context)
+        who = self.quota.admit(user, group, context.content)
+        if who is None:
+            return True
+        self._quota_exceeded(context, who, user, group)
+        return False
+
+    # 超出额度的消息被丢弃，私聊时按should_notify限频回复quota_exceeded_reply
+    def _quota_exceeded(self, context: Context, who, user, group):
+        logger.info("[chat_channel] {} quota exceeded, drop message from {} in {}".format(who, user, group or "private chat"))
+        reply_text = conf().get("quota_exceeded_reply", "")
+        if reply_text and not context.get("isgroup", False) and self.quota.should_notify(user):
+            self._send_reply(context, Reply(ReplyType.TEXT, reply_text))
+
+    def _quota_keys(self, context: Context):
+        if context.get("isgroup", False):
+            user = getattr(context.get("msg"), "actual_user_id", None) or context.get("session_id", 0)
+            return user, context.get("receiver")
+        return context.get("session_id", 0), None
+
+    # 按回复长度补扣token额度
+    def _charge_reply(self, context: Context, reply: Reply):
+        if reply and reply.type == ReplyType.TEXT and isinstance(reply.content, str):
+            user, group = self._quota_keys(context)
+            self.quota.charge(user, group, estimate_tokens(reply.content))
+
+    # 消费者函数，单独线程，阻塞等待有消息的会话，被唤醒后立即分发，不再轮询所有会话
     def consume(self):
         while True:
+            session_id, slot = self.ready_sessions.get()
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
+                if session_id not in self.sessions:
+                    if slot:
+                        self.ready_sessions.release_slot()
+                    continue
+                context_queue, semaphore, flow, weight = self.sessions[session_id]
+                if context_queue.empty():
+                    if slot:
+                        self.ready_sessions.release_slot()
+                    self._try_release_session(session_id)
+                    continue
+                if not semaphore.acquire(blocking=False):  # 并发已满，任务结束的回调会再次唤醒该会话
+                    if slot:
+                        self.ready_sessions.release_slot()
+                    continue
+                # 只有慢速任务占用分发名额
+                if self._select_handler_pool(context_queue.queue[0]) is fast_handler_pool:
+                    if slot:
+                        self.ready_sessions.release_slot()
+                        slot = False
+                elif not slot:
+                    if not self.ready_sessions.try_acquire_slot():
                         semaphore.release()
-            time.sleep(0.2)
+                        self.ready_sessions.put(session_id, flow, weight)  # 名额已满，回到所属流排队
+                        continue
+                    slot = True
+                context = context_queue.get()
+                logger.debug("[chat_channel] consume context: {}".format(context))
+                if conf().get("async_pipeline", False):
+                    future: Future = asyncio.run_coroutine_threadsafe(self._ahandle(context), get_event_loop())
+                else:
+                    future: Future = self._select_handler_pool(context).submit(self._handle, context)
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+            # 回调可能在当前线程同步执行，需在锁外注册
+            if slot:
+                future.add_done_callback(lambda _: self.ready_sessions.release_slot())
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+
+    # 管理命令、好友申请和退群等由插件处理、不调用模型的消息走快速通道，避免被慢速的模型请求阻塞
+    # 插件指令(plugin_trigger_prefix)可能调用模型，按普通消息处理并计入额度
+    def _select_handler_pool(self, context: Context):
+        if context.type == ContextType.TEXT:
+            if context.content.startswith("#"):
+                return fast_handler_pool
+        elif context.type in [ContextType.ACCEPT_FRIEND, ContextType.EXIT_GROUP]:
+            return fast_handler_pool
+        return handler_pool
+
+    def send_account(self):
+        """
+        发送调度器按账号限速，多账号的渠道需返回区分账号的标识
+        """
+        return self.channel_type or conf().get("channel_type", "")
+
+    def send_scheduler_metrics(self):
+        return get_send_scheduler(self.send_account()).metrics()
+
+    def fair_queue_metrics(self):
+        metrics = self.ready_sessions.metrics()
+        metrics.update(self.quota.metrics())
+        return metrics
+
+    def handler_pool_metrics(self):
+        return [handler_pool.metrics(), fast_handler_pool.metrics()]
+
+    # 会话队列为空且没有处理中的任务时删除会话，调用方需持有self.lock
+    def _try_release_session(self, session_id):
+        context_queue, semaphore = self.sessions[session_id][:2]
+        if context_queue.empty() and semaphore._initial_value == semaphore._value:
+            self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+            assert len(self.futures[session_id]) == 0, "thread pool error"
+            del self.futures[session_id]
+            del self.sessions[session_id]
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
-            if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            if session_id not in self.sessions:
+                return
+            futures = list(self.futures.get(session_id, []))
+            cnt = self.sessions[session_id][0].qsize()
+            if cnt > 0:
+                logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+            self.sessions[session_id][0] = Dequeue()
+        # future取消时会同步执行回调，回调内需要获取self.lock，因此在锁外取消
+        for future in futures:
+            future.cancel()
 
     def cancel_all_session(self):
+        futures = []
         with self.lock:
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
+                futures.extend(self.futures.get(session_id, []))
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
                 self.sessions[session_id][0] = Dequeue()
+        for future in futures:
+            future.cancel()
 
 
 def check_prefix(content, prefix_list):
@@ -432,3 +616,32 @@ def check_contain(content, keyword_list):
         if content.find(ky) != -1:
             return True
     return None
+
+
+if __name__ == "__main__":
+    # 分发延迟基准测试：python -m channel.chat_channel [会话数]
+    import sys
+
+    session_cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latencies = []
+    done = threading.Event()
+
+    class _BenchChannel(ChatChannel):
+        def _handle(self, context: Context):
+            latencies.append(time.perf_counter() - context["enqueue_time"])
+            if len(latencies) == session_cnt:
+                done.set()
+
+    bench_channel = _BenchChannel()
+    for i in range(session_cnt):
+        bench_context = Context(ContextType.TEXT, "hello", {"session_id": "session_{}".format(i)})
+        bench_context["enqueue_time"] = time.perf_counter()
+        bench_channel.produce(bench_context)
+    done.wait()
+    latencies.sort()
+    print("sessions={}, p50={:.2f}ms, p99={:.2f}ms, max={:.2f}ms".format(
+        session_cnt,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+        latencies[-1] * 1000,
+    ))
@@ -0,0 +1,147 @@
+"""
+待处理会话的公平分发队列，替代原先按到达顺序分发的Queue
+    会话按流分组：群聊消息属于所在群的流，私聊消息属于该用户的流，一个热门群的所有成员共用一个流
+    流之间按赤字轮询(DRR)轮转，每轮为流增加与权重相等的额度，额度足够时分发一条消息并扣除其代价
+    慢速任务(模型调用)需要占用分发名额，名额用完后消息留在各自流中排队，空出名额时由DRR决定下一个，
+    线程池队列不会被某一个流占满，私聊不会被热门群饿死
+    管理命令等紧急消息不占名额，优先分发
+"""
+import threading
+from collections import deque
+
+
+class _Flow(object):
+    __slots__ = ("key", "weight", "items", "deficit", "new_round")
+
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+        self.items = deque()  # (session_id, cost)
+        self.deficit = 0
+        self.new_round = True
+
+
+class FairQueue(object):
+    def __init__(self, slots=0):
+        self.slots = slots  # 慢速任务的分发名额，0表示不限制
+        self._flows = {}  # flow -> _Flow，只保存有待分发会话的流
+        self._active = deque()  # 有待分发会话的流，DRR轮转顺序
+        self._urgent = deque()
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self.stats = {"dispatched": 0, "urgent": 0, "slot_waits": 0}
+
+    def configure(self, slots):
+        with self._cond:
+            self.slots = slots
+            self._cond.notify_all()
+
+    def put(self, session_id, flow=None, weight=1, cost=1, urgent=False):
+        """
+        session_id有待处理的消息，flow为None时会话单独成流
+        """
+        with self._cond:
+            if urgent:
+                self._urgent.append(session_id)
+            else:
+                key = session_id if flow is None else flow
+                state = self._flows.get(key)
+                if state is None:
+                    state = _Flow(key, max(weight, 1))
+                    self._flows[key] = state
+                    self._active.append(state)
+                state.items.append((session_id, cost))
+            self._cond.notify()
+
+    def get(self):
+        """
+        阻塞直到有可分发的会话，返回(session_id, 是否占用了名额)
+        占用名额的会话若最终没有分发慢速任务，调用方需调用release_slot归还
+        """
+        with self._cond:
+            while True:
+                if self._urgent:
+                    self.stats["urgent"] += 1
+                    return self._urgent.popleft(), False
+                if self._active:
+                    if not self.slots or self._inflight < self.slots:
+                        session_id = self._next()
+                        self._inflight += 1
+                        self.stats["dispatched"] += 1
+                        return session_id, True
+                    self.stats["slot_waits"] += 1
+                self._cond.wait()
+
+    def try_acquire_slot(self) -> bool:
+        with self._cond:
+            if self.slots and self._inflight >= self.slots:
+                return False
+            self._inflight += 1
+            return True
+
+    def release_slot(self):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify()
+
+    def pending(self, flow) -> int:
+        with self._cond:
+            state = self._flows.get(flow)
+            return len(state.items) if state else 0
+
+    def metrics(self) -> dict:
+        with self._cond:
+            metrics = dict(self.stats)
+            metrics["flows"] = len(self._flows)
+            metrics["pending"] = sum(len(state.items) for state in self._flows.values()) + len(self._urgent)
+            metrics["inflight"] = self._inflight
+            metrics["slots"] = self.slots
+        return metrics
+
+    def _next(self):
+        # 调用方需持有self._cond，且self._active非空
+        while True:
+            state = self._active[0]
+            if state.new_round:
+                state.deficit += state.weight
+                state.new_round = False
+            session_id, cost = state.items[0]
+            if cost > state.deficit:
+                # 本轮额度用完，轮到下一个流
+                state.new_round = True
+                self._active.rotate(-1)
+                continue
+            state.items.popleft()
+            state.deficit -= cost
+            if not state.items:
+                # 流空闲后不保留额度，避免积累额度后突发占满名额
+                self._active.popleft()
+                del self._flows[state.key]
+            return session_id
+
+
+if __name__ == "__main__":
+    # 公平性演示: python -m channel.fair_queue
+    # 一个群短时间内涌入1000条消息，随后10个私聊用户各发1条，比较私聊消息平均需要等多少条消息分发完
+    import time
+
+    def simulate(fair):
+        queue = FairQueue(slots=8)
+        for i in range(1000):
+            queue.put("user_{}@@hot_group".format(i % 200), flow="hot_group" if fair else "all")
+        for i in range(10):
+            queue.put("private_{}".format(i), flow=None if fair else "all")  # 所有消息同属一个流时等同于原先的先进先出
+        order = []
+        start = time.perf_counter()
+        for _ in range(1010):
+            session_id, slot = queue.get()
+            order.append(session_id)
+            if slot:
+                queue.release_slot()
+        elapsed = time.perf_counter() - start
+        positions = [i for i, session_id in enumerate(order) if session_id.startswith("private_")]
+        return sum(positions) / len(positions), elapsed
+
+    for fair, name in ((False, "fifo"), (True, "per-group flow")):
+        avg, elapsed = simulate(fair)
+        print("{:<15} private chats dispatched after avg {:.0f} messages, {:.0f} gets/s".format(name, avg, 1010 / elapsed))
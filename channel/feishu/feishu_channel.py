@@ -15,8 +15,9 @@ from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.singleton import singleton
+from common.token_manager import AccessTokenManager, make_token_key
 from config import conf
-from common.expired_dict import ExpiredDict
+from common.msg_dedup import MessageDeduplicator
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
 from common import utils
@@ -34,8 +35,8 @@ class FeiShuChanel(ChatChannel):
 
     def __init__(self):
         super().__init__()
-        # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
+        self.token_key = AccessTokenManager().register(
+            make_token_key("feishu", self.feishu_app_id, self.feishu_app_secret), self._fetch_tenant_access_token)
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
@@ -98,6 +99,13 @@ class FeiShuChanel(ChatChannel):
 
 
     def fetch_access_token(self) -> str:
+        try:
+            return AccessTokenManager().get_token(self.token_key)
+        except Exception as e:
+            logger.error(f"[FeiShu] fetch token error, {e}")
+            return ""
+
+    def _fetch_tenant_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -111,12 +119,9 @@ class FeiShuChanel(ChatChannel):
         if response.status_code == 200:
             res = response.json()
             if res.get("code") != 0:
-                logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
-            else:
-                return res.get("tenant_access_token")
-        else:
-            logger.error(f"[FeiShu] fetch token error, res={response}")
+                raise Exception(f"get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
+            return res.get("tenant_access_token"), res.get("expire")
+        raise Exception(f"fetch token error, res={response}")
 
 
     def _upload_image_url(self, img_url, access_token):
@@ -181,10 +186,9 @@ class FeishuController:
                 msg = event.get("message")
 
                 # 幂等判断
-                if channel.receivedMsgs.get(msg.get("message_id")):
+                if MessageDeduplicator().is_duplicate("feishu", msg.get("message_id")):
                     logger.warning(f"[FeiShu] repeat msg filtered, event_id={header.get('event_id')}")
                     return self.SUCCESS_MSG
-                channel.receivedMsgs[msg.get("message_id")] = True
 
                 is_group = False
                 chat_type = msg.get("chat_type")
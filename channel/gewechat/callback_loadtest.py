@@ -0,0 +1,132 @@
+"""
+gewechat回调压测工具，向本地启动的回调服务并发回放回调请求，统计吞吐、延迟和状态码分布
+
+    python -m channel.gewechat.callback_loadtest --url http://127.0.0.1:9919/v2/api/callback/collect \
+        --payloads callbacks.jsonl --concurrency 50 --requests 5000
+
+payloads文件每行一个录制的回调json，请求数超过文件行数时循环回放；
+不指定payloads时生成带唯一NewMsgId的私聊文本消息，指定--duplicate-ratio可混入重复投递的消息
+"""
+import argparse
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_payloads(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_payload(msg_id, app_id="wx_loadtest", to_wxid="wxid_bot"):
+    return {
+        "TypeName": "AddMsg",
+        "Appid": app_id,
+        "Wxid": to_wxid,
+        "Data": {
+            "MsgId": msg_id,
+            "NewMsgId": msg_id,
+            "FromUserName": {"string": "wxid_user_{}".format(msg_id % 100)},
+            "ToUserName": {"string": to_wxid},
+            "MsgType": 1,
+            "Content": {"string": "loadtest message {}".format(msg_id)},
+            "CreateTime": int(time.time()),
+        },
+    }
+
+
+def build_requests(payloads, total, duplicate_ratio, unique_ids):
+    """
+    生成待发送的请求体，unique_ids为True时改写NewMsgId，避免回放同一份录制数据时全部被去重
+    """
+    start_id = int(time.time() * 1000)
+    sent = []
+    result = []
+    for i, payload in zip(range(total), itertools.cycle(payloads) if payloads else itertools.repeat(None)):
+        if sent and random.random() < duplicate_ratio:
+            result.append(random.choice(sent))
+            continue
+        if payload is None:
+            payload = synthetic_payload(start_id + i)
+        elif unique_ids and isinstance(payload.get("Data"), dict):
+            payload = copy.deepcopy(payload)
+            payload["Data"]["NewMsgId"] = start_id + i
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        sent.append(body)
+        result.append(body)
+    return result
+
+
+def post(url, body, timeout):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception as e:
+        status = type(e).__name__
+    return status, time.perf_counter() - start
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(url, bodies, concurrency, timeout):
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(body):
+        status, latency = post(url, body, timeout)
+        with lock:
+            statuses[status] += 1
+            latencies.append(latency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, bodies))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(bodies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(bodies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0,
+        "status": {str(k): v for k, v in statuses.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gewechat callback load test")
+    parser.add_argument("--url", default="http://127.0.0.1:9919/v2/api/callback/collect")
+    parser.add_argument("--payloads", help="录制的回调数据，jsonl格式")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="重复投递的比例")
+    parser.add_argument("--keep-ids", action="store_true", help="回放时保留原始NewMsgId")
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads) if args.payloads else []
+    bodies = build_requests(payloads, args.requests, args.duplicate_ratio, not args.keep_ids)
+    print(json.dumps(run(args.url, bodies, args.concurrency, args.timeout), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 import os
 import json
+import threading
+import time
 import web
+from queue import Queue, Full
 from urllib.parse import urlparse
 
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
+from channel.gewechat.gewechat_contact_cache import GeWeChatContactCache
 from channel.gewechat.gewechat_message import GeWeChatMessage
 from common.log import logger
+from common.msg_dedup import MessageDeduplicator
 from common.singleton import singleton
 from common.tmp_dir import TmpDir
 from common.utils import compress_imgfile, fsize
@@ -19,9 +24,18 @@ MAX_UTF8_LEN = 2048
 @singleton
 class GeWeChatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    send_rate_limited = True
 
     def __init__(self):
         super().__init__()
+        # 回调请求只做校验和入队，解析消息、获取联系人信息和produce由ingest线程完成，避免阻塞回调导致gewechat超时重试
+        # 每个ingest线程有自己的队列，同一会话的消息按FromUserName分到同一个队列，保证按到达顺序处理
+        workers = max(1, conf().get("gewechat_ingest_workers", 4))
+        queue_size = max(1, conf().get("gewechat_ingest_queue_size", 1000) // workers)
+        self.ingest_queues = [Queue(queue_size) for _ in range(workers)]
+        self.ingest_stats = {"received": 0, "rejected": 0, "processed": 0, "errors": 0, "wait_ms": 0.0}
+        self._ingest_lock = threading.Lock()
+        self._ingest_workers = []
 
         self.base_url = conf().get("gewechat_base_url")
         if not self.base_url:
@@ -74,11 +88,11 @@ class GeWeChatChannel(ChatChannel):
             logger.error("[gewechat] callback_url is not set, unable to start callback server")
             return
 
+        self._start_ingest_workers()
+
         # 创建新线程设置回调地址
-        import threading
         def set_callback():
             # 等待服务器启动（给予适当的启动时间）
-            import time
             logger.info("[gewechat] sleep 3 seconds waiting for server to start, then set callback")
             time.sleep(3)
 
@@ -101,6 +115,68 @@ class GeWeChatChannel(ChatChannel):
         app = web.application(urls, globals(), autoreload=False)
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
+    def send_account(self):
+        return "gewechat:{}".format(conf().get("gewechat_app_id"))
+
+    def contact_cache_metrics(self) -> dict:
+        return GeWeChatContactCache().metrics()
+
+    def ingest(self, data) -> bool:
+        """
+        回调数据按会话放入对应ingest线程的队列，队列已满时返回False，由调用方决定丢弃或让gewechat重试
+        """
+        from_user = data.get("Data", {}).get("FromUserName", {})
+        if isinstance(from_user, dict):
+            from_user = from_user.get("string")
+        ingest_queue = self.ingest_queues[hash(from_user or "") % len(self.ingest_queues)]
+        try:
+            ingest_queue.put_nowait((data, time.monotonic()))
+        except Full:
+            logger.warning("[gewechat] ingest queue full, message rejected: {}".format(data.get("Data", {}).get("NewMsgId")))
+            return False
+        return True
+
+    def ingest_metrics(self) -> dict:
+        with self._ingest_lock:
+            metrics = dict(self.ingest_stats)
+        metrics["queue_depth"] = sum(q.qsize() for q in self.ingest_queues)
+        metrics["queue_size"] = sum(q.maxsize for q in self.ingest_queues)
+        metrics["workers"] = len(self._ingest_workers)
+        metrics["avg_wait_ms"] = round(metrics.pop("wait_ms") / metrics["processed"], 2) if metrics["processed"] else 0
+        return metrics
+
+    def _count_ingest(self, key, value=1):
+        with self._ingest_lock:
+            self.ingest_stats[key] += value
+
+    def _start_ingest_workers(self):
+        for i in range(len(self._ingest_workers), len(self.ingest_queues)):
+            t = threading.Thread(target=self._ingest_loop, args=(self.ingest_queues[i],), name="gewechat_ingest_{}".format(i), daemon=True)
+            t.start()
+            self._ingest_workers.append(t)
+
+    def _ingest_loop(self, ingest_queue: Queue):
+        while True:
+            data, enqueue_time = ingest_queue.get()
+            self._count_ingest("wait_ms", (time.monotonic() - enqueue_time) * 1000)
+            try:
+                self._handle_callback(data)
+                self._count_ingest("processed")
+            except Exception as e:
+                self._count_ingest("errors")
+                logger.exception("[gewechat] handle callback error: {}".format(e))
+
+    def _handle_callback(self, data):
+        gewechat_msg = GeWeChatMessage(data, self.client)
+        context = self._compose_context(
+            gewechat_msg.ctype,
+            gewechat_msg.content,
+            isgroup=gewechat_msg.is_group,
+            msg=gewechat_msg,
+        )
+        if context:
+            self.produce(context)
+
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
         gewechat_message = context.get("msg")
@@ -145,7 +221,12 @@ class Query:
 
     def POST(self):
         channel = GeWeChatChannel()
-        data = json.loads(web.data())
+        try:
+            data = json.loads(web.data())
+        except ValueError:
+            raise web.badrequest()
+        if not isinstance(data, dict):
+            raise web.badrequest()
         logger.debug("[gewechat] receive data: {}".format(data))
         # {'TypeName': 'AddMsg', 'Appid': 'wx_7fPru7ZQkO8sa7ep1yZfP', 'Data': {'MsgId': 687551448, 'FromUserName': {...}, 'ToUserName': {...}, 'MsgType': 1, 'Content': {...}, 'Status': 3, 'ImgStatus': 1, 'ImgBuf': {...}, 'CreateTime': 1732282644, 'MsgSource': '<msgsource>\n\t<sec_msg_node>\n\t\t<alnode>\n\t\t\t<fr>1</fr>\n\t\t</alnode>\n\t</sec_msg_node>\n\t<pua>1</pua>\n\t<signature>V1_CWV/Rvjg|v1_CWV/Rvjg</signature>\n\t<tmp_node>\n\t\t<publisher-id></publisher-id>\n\t</tmp_node>\n</msgsource>\n', 'PushContent': 'Loading... : hi', 'NewMsgId': 3343826003426280399, 'MsgSeq': 1095}, 'Wxid': 'wxid_dpk2goadsqxa19'}
         if data.get("testMsg"):
@@ -153,15 +234,18 @@ class Query:
         if data.get("TypeName") and data['TypeName'] == 'DifyAddMsg':
             return "success"
         elif data.get("TypeName") and data['TypeName'] == 'ModContact':
-            pass
-        gewechat_msg = GeWeChatMessage(data, channel.client)
-        
-        context = channel._compose_context(
-            gewechat_msg.ctype,
-            gewechat_msg.content,
-            isgroup=gewechat_msg.is_group,
-            msg=gewechat_msg,
-        )
-        if context:
-            channel.produce(context)
+            # 联系人或群信息(含群成员)变更，失效对应的缓存
+            GeWeChatContactCache().invalidate(data.get("Data", {}).get("UserName", {}).get("string"))
+            return "success"
+        channel._count_ingest("received")
+        # gewechat回调失败或超时会重试，重复的消息直接丢弃，避免重复调用模型
+        msg_id = data.get("Data", {}).get("NewMsgId") if data.get("TypeName") == 'AddMsg' else None
+        if msg_id is not None and MessageDeduplicator().is_duplicate("gewechat", msg_id):
+            return "success"
+        if not channel.ingest(data):
+            # 队列已满时撤销去重记录并返回503，由gewechat稍后重试，重试的消息可以正常处理
+            if msg_id is not None:
+                MessageDeduplicator().forget("gewechat", msg_id)
+            channel._count_ingest("rejected")
+            raise web.HTTPError("503 Service Unavailable", {"Content-Type": "text/plain"}, "busy")
         return "success"
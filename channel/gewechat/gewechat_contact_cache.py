@@ -0,0 +1,147 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.singleton import singleton
+from config import conf
+
+# 群成员缓存中找不到发送者时，距上次拉取超过该时间(秒)才重新拉取
+MEMBER_REFRESH_INTERVAL = 60
+
+
+@singleton
+class GeWeChatContactCache(object):
+    """
+    联系人和群成员缓存，避免每条消息都请求gewechat获取昵称和群成员列表
+    联系人按wxid缓存简要信息，群成员按群id缓存 wxid -> 成员信息 的索引；
+    同一个key的并发未命中只发起一次请求，收到ModContact回调时失效对应缓存
+    """
+
+    def __init__(self):
+        max_size = conf().get("gewechat_contact_cache_size", 10000)
+        self.contact_ttl = conf().get("gewechat_contact_cache_ttl", 3600)
+        self.member_ttl = conf().get("gewechat_member_cache_ttl", 600)
+        # 值为(获取时间, 数据)，按获取时间判断过期，访问不会延长有效期
+        self._contacts = ExpiredDict(self.contact_ttl, max_size=max_size)
+        self._members = ExpiredDict(self.member_ttl, max_size=max(max_size // 10, 100))
+        self._inflight = {}  # key -> Future，正在请求中的key
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def get_brief_info(self, client, app_id, wxid) -> dict:
+        """
+        获取联系人或群的简要信息，获取失败时返回None
+        """
+        cached = self._get_fresh(self._contacts, wxid, self.contact_ttl)
+        if cached is not None:
+            return cached
+        return self._load(self._contacts, ("contact", wxid), wxid, lambda: self._fetch_brief_info(client, app_id, wxid))
+
+    def get_chatroom_member(self, client, app_id, chatroom_id, wxid) -> dict:
+        """
+        获取群成员信息，缓存的成员列表中找不到该成员时(如新入群)重新拉取，同一个群最多每分钟拉取一次
+        """
+        item = self._members.get(chatroom_id)
+        members = self.get_chatroom_members(client, app_id, chatroom_id, force=item is None or wxid not in item[1])
+        return members.get(wxid) if members else None
+
+    def get_chatroom_members(self, client, app_id, chatroom_id, force=False) -> dict:
+        """
+        获取群的 wxid -> 成员信息，获取失败时返回None，返回的dict为缓存本身，不要修改
+        force为True时(如要找的成员不在缓存中)重新拉取，同一个群最多每分钟拉取一次
+        """
+        item = self._members.get(chatroom_id)
+        now = time.monotonic()
+        with self._lock:
+            if item is not None and now - item[0] < self.member_ttl and (not force or now - item[0] < MEMBER_REFRESH_INTERVAL):
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+        return self._load(self._members, ("members", chatroom_id), chatroom_id, lambda: self._fetch_members(client, app_id, chatroom_id))
+
+    def invalidate(self, wxid):
+        """
+        联系人或群信息变更时调用，群id同时失效成员缓存
+        """
+        if not wxid:
+            return
+        self._contacts.pop(wxid, None)
+        self._members.pop(wxid, None)
+        logger.debug("[gewechat] contact cache invalidated: {}".format(wxid))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "contacts": len(self._contacts),
+                "chatrooms": len(self._members),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0,
+                "fetches": self.fetches,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+            }
+
+    def _get_fresh(self, cache, key, ttl):
+        item = cache.get(key)
+        with self._lock:
+            if item is not None and time.monotonic() - item[0] < ttl:
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+        return None
+
+    def _load(self, cache, inflight_key, cache_key, loader):
+        """
+        加载数据并写入缓存，同一个inflight_key的并发请求等待第一个请求的结果
+        """
+        with self._lock:
+            future = self._inflight.get(inflight_key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[inflight_key] = future
+                self.fetches += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            try:
+                return future.result(timeout=30)
+            except Exception:
+                return None
+        try:
+            value = loader()
+            if value is not None:
+                cache[cache_key] = (time.monotonic(), value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning("[gewechat] load {} failed: {}".format(inflight_key, e))
+            future.set_exception(e)
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(inflight_key, None)
+
+    @staticmethod
+    def _fetch_brief_info(client, app_id, wxid):
+        response = client.get_brief_info(app_id, [wxid])
+        if response.get('ret') == 200 and response.get('data'):
+            return response['data'][0]
+        return None
+
+    @staticmethod
+    def _fetch_members(client, app_id, chatroom_id):
+        response = client.get_chatroom_member_list(app_id, chatroom_id)
+        if response.get('ret', 0) == 200 and response.get('data', {}).get('memberList', []):
+            return {member['wxid']: member for member in response['data']['memberList']}
+        return None
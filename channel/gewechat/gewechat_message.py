@@ -2,6 +2,7 @@ import base64
 import uuid
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
+from channel.gewechat.gewechat_contact_cache import GeWeChatContactCache
 from common.log import logger
 from common.tmp_dir import TmpDir
 from config import conf
@@ -136,9 +137,9 @@ class GeWeChatMessage(ChatMessage):
         self.other_user_id = self.from_user_id
 
         # 获取群聊或好友的名称
-        brief_info_response = self.client.get_brief_info(self.app_id, [self.other_user_id])
-        if brief_info_response['ret'] == 200 and brief_info_response['data']:
-            brief_info = brief_info_response['data'][0]
+        contact_cache = GeWeChatContactCache()
+        brief_info = contact_cache.get_brief_info(self.client, self.app_id, self.other_user_id)
+        if brief_info:
             self.other_user_nickname = brief_info.get('nickName', '')
             if not self.other_user_nickname:
                 self.other_user_nickname = self.other_user_id
@@ -178,16 +179,12 @@ class GeWeChatMessage(ChatMessage):
                 }
             }
             """
-            chatroom_member_list_response = self.client.get_chatroom_member_list(self.app_id, self.from_user_id)
-            if chatroom_member_list_response.get('ret', 0) == 200 and chatroom_member_list_response.get('data', {}).get('memberList', []):
-                # 从群成员列表中匹配acual_user_id
-                for member_info in chatroom_member_list_response['data']['memberList']:
-                    if member_info['wxid'] == self.actual_user_id:
-                        # 先获取displayName，如果displayName为空，再获取nickName
-                        self.actual_user_nickname = member_info.get('displayName', '')
-                        if not self.actual_user_nickname:
-                            self.actual_user_nickname = member_info.get('nickName', '')
-                        break
+            member_info = contact_cache.get_chatroom_member(self.client, self.app_id, self.from_user_id, self.actual_user_id)
+            if member_info:
+                # 先获取displayName，如果displayName为空，再获取nickName
+                self.actual_user_nickname = member_info.get('displayName', '')
+                if not self.actual_user_nickname:
+                    self.actual_user_nickname = member_info.get('nickName', '')
             # 如果actual_user_nickname为空，使用actual_user_id作为nickname
             if not self.actual_user_nickname:
                 self.actual_user_nickname = self.actual_user_id
@@ -0,0 +1,75 @@
+"""
+按用户、按群限制调用模型的请求数和token数，超出额度的消息在入队时直接丢弃，不再占用队列和线程
+    请求额度在入队时扣除；token额度入队时按问题长度预扣，回复生成后再按回复长度补扣，欠额补足前拒绝新的请求
+"""
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from common.token_bucket import KeyedTokenBucket
+from config import conf
+
+
+def estimate_tokens(text) -> int:
+    # 粗略估计，中文约每字1个token，英文等ASCII字符约每4个字符1个token
+    if not text:
+        return 0
+    ascii_cnt = sum(1 for c in text if ord(c) < 128)
+    return len(text) - ascii_cnt + (ascii_cnt + 3) // 4
+
+
+class RequestQuota(object):
+    def __init__(self):
+        max_keys = conf().get("quota_max_tracked", 10000)
+        self.user_requests = self._bucket("quota_user_requests_per_minute", max_keys)
+        self.group_requests = self._bucket("quota_group_requests_per_minute", max_keys)
+        self.user_tokens = self._bucket("quota_user_tokens_per_minute", max_keys)
+        self.group_tokens = self._bucket("quota_group_tokens_per_minute", max_keys)
+        self.notified = ExpiredDict(60)  # 一分钟内只提醒一次，避免提醒消息本身刷屏
+        self.stats = {"shed_user": 0, "shed_group": 0, "shed_queue": 0}
+
+    @staticmethod
+    def _bucket(key, max_keys):
+        limit = conf().get(key, 0)
+        return KeyedTokenBucket(limit, max_keys=max_keys) if limit else None
+
+    def admit(self, user, group, content) -> str:
+        """
+        检查并扣除额度，通过时返回None，否则返回超出额度的一方("user"或"group")
+        """
+        tokens = estimate_tokens(content)
+        if self.user_tokens is not None and self.user_tokens.available(user) <= 0:
+            return self._shed("user")
+        if group and self.group_tokens is not None and self.group_tokens.available(group) <= 0:
+            return self._shed("group")
+        if self.user_requests is not None and self.user_requests.try_acquire(user):
+            return self._shed("user")
+        if group and self.group_requests is not None and self.group_requests.try_acquire(group):
+            if self.user_requests is not None:
+                self.user_requests.release(user)
+            return self._shed("group")
+        self.charge(user, group, tokens)
+        return None
+
+    def charge(self, user, group, tokens):
+        if not tokens:
+            return
+        if self.user_tokens is not None:
+            self.user_tokens.charge(user, tokens)
+        if group and self.group_tokens is not None:
+            self.group_tokens.charge(group, tokens)
+
+    def should_notify(self, key) -> bool:
+        if key in self.notified:
+            return False
+        self.notified[key] = True
+        return True
+
+    def count_queue_shed(self):
+        self.stats["shed_queue"] += 1
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
+
+    def _shed(self, who):
+        self.stats["shed_" + who] += 1
+        logger.debug("[RequestQuota] {} quota exceeded".format(who))
+        return who
@@ -0,0 +1,156 @@
+"""
+出站消息流水线，渠道的send只负责把回复拆成发送步骤并入队，处理线程随即释放
+    媒体上传在上传线程池中并发执行
+    每个接收者的发送步骤严格按入队顺序执行，前一步完成后才开始下一步
+    步骤之间的间隔通过事件循环定时唤醒，不占用线程
+    发送失败的步骤留在队首，退避后重新发送，重试耗尽才跳过，后续步骤在此期间等待
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from common.event_loop import get_event_loop
+from common.log import logger
+from common.thread_pool import ElasticThreadPool
+
+
+class _SendStep(object):
+    __slots__ = ("fn", "uploads", "delay", "ready_at", "desc", "attempts")
+
+    def __init__(self, fn, uploads, delay, desc):
+        self.fn = fn
+        self.uploads = uploads
+        self.delay = delay
+        self.ready_at = None  # 上传完成且前一步结束后，再等待delay秒
+        self.desc = desc
+        self.attempts = 0
+
+
+class SendPipeline(object):
+    def __init__(self, name, send_workers=4, upload_workers=4, max_retries=2):
+        self.name = name
+        self.max_retries = max_retries
+        self.upload_pool = ElasticThreadPool("{}_upload".format(name), min_workers=0, max_workers=upload_workers)
+        self.send_pool = ElasticThreadPool("{}_send".format(name), min_workers=1, max_workers=send_workers)
+        self._queues = {}  # receiver -> deque[_SendStep]，存在即表示该接收者有发送任务在进行或等待唤醒
+        self._lock = threading.Lock()
+        self.stats = {"enqueued": 0, "sent": 0, "retries": 0, "failed": 0, "upload_failed": 0}
+
+    def upload(self, fn, *args, **kwargs) -> Future:
+        """
+        在上传线程池中执行上传，返回的Future可作为enqueue的依赖
+        """
+        return self.upload_pool.submit(fn, *args, **kwargs)
+
+    def enqueue(self, receiver, fn, *uploads: Future, delay=0, desc=""):
+        """
+        为receiver追加一个发送步骤，uploads全部完成且前一个步骤结束delay秒后调用fn(*上传结果)
+        任一上传失败时跳过该步骤，不影响后续步骤
+        """
+        step = _SendStep(fn, uploads, delay, desc)
+        with self._lock:
+            self.stats["enqueued"] += 1
+            queue = self._queues.get(receiver)
+            if queue is not None:
+                queue.append(step)
+                return
+            self._queues[receiver] = deque([step])
+        self.send_pool.submit(self._drain, receiver)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["receivers"] = len(self._queues)
+            metrics["pending"] = sum(len(queue) for queue in self._queues.values())
+        metrics["upload_pool"] = self.upload_pool.metrics()
+        metrics["send_pool"] = self.send_pool.metrics()
+        return metrics
+
+    def _resume(self, receiver):
+        self.send_pool.submit(self._drain, receiver)
+
+    def _drain(self, receiver):
+        while True:
+            with self._lock:
+                queue = self._queues[receiver]
+                if not queue:
+                    del self._queues[receiver]
+                    return
+                step = queue[0]
+                pending = next((upload for upload in step.uploads if not upload.done()), None)
+                if pending is None:
+                    now = time.monotonic()
+                    if step.ready_at is None:
+                        step.ready_at = now + step.delay
+                    if step.ready_at <= now:
+                        queue.popleft()
+            if pending is not None:
+                # 上传完成后由回调重新调度，回调可能在当前线程立即执行，需在锁外注册
+                pending.add_done_callback(lambda _: self._resume(receiver))
+                return
+            if step.ready_at > now:
+                self._resume_later(receiver, step.ready_at - now)
+                return
+            if not self._run_step(receiver, step):
+                return  # 发送失败，步骤已放回队首等待重试
+
+    def _resume_later(self, receiver, seconds):
+        loop = get_event_loop()
+        loop.call_soon_threadsafe(loop.call_later, seconds, self._resume, receiver)
+
+    # 返回False表示步骤失败后已放回队首，当前drain需要结束，到时间后重新唤醒
+    def _run_step(self, receiver, step) -> bool:
+        try:
+            results = [upload.result() for upload in step.uploads]
+        except Exception as e:
+            self._count("upload_failed")
+            logger.error("[{}] upload failed, skip {} to {}: {}".format(self.name, step.desc or "message", receiver, e))
+            return True
+        step.attempts += 1
+        try:
+            step.fn(*results)
+            self._count("sent")
+            return True
+        except Exception as e:
+            if isinstance(e, NotImplementedError) or step.attempts > self.max_retries:
+                self._count("failed")
+                logger.exception("[{}] send {} to {} failed after {} attempts: {}".format(self.name, step.desc or "message", receiver, step.attempts, e))
+                return True
+            backoff = 3 * 2 ** (step.attempts - 1) * random.uniform(0.5, 1.5)
+            step.ready_at = time.monotonic() + backoff
+            with self._lock:
+                self._queues[receiver].appendleft(step)
+                self.stats["retries"] += 1
+            logger.warning("[{}] send {} to {} failed, retry {} in {:.1f}s: {}".format(self.name, step.desc or "message", receiver, step.attempts, backoff, e))
+            self._resume_later(receiver, backoff)
+            return False
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+def when_all_done(futures, fn):
+    """
+    futures全部结束(无论成功或失败)后调用fn，用于上传完成后清理临时文件
+    """
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            fn()
+        except Exception as e:
+            logger.warning("[send_pipeline] callback error: {}".format(e))
+
+    if not futures:
+        fn()
+        return
+    for future in futures:
+        future.add_done_callback(on_done)
@@ -0,0 +1,169 @@
+"""
+消息触发条件匹配，根据配置预先构建查找结构，每条消息的匹配开销与名单和关键词数量无关
+    群名、昵称等精确匹配使用set
+    关键词包含匹配使用Aho-Corasick自动机
+    前缀匹配使用前缀树，保持与check_prefix相同的优先级（按配置中的顺序）
+配置被修改或重新加载后，下一次获取时重新构建并整体替换，匹配过程中不会读到构建了一半的结构
+"""
+import functools
+import re
+import threading
+from collections import deque
+
+from config import conf
+
+
+class PrefixTrie(object):
+    def __init__(self, prefixes):
+        self._root = {}
+        self._empty_index = None
+        for index, prefix in enumerate(prefixes or []):
+            if not prefix:
+                if self._empty_index is None:
+                    self._empty_index = index
+                continue
+            node = self._root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, (index, prefix))  # None键保存以该节点结尾的前缀及其在配置中的序号
+
+    def match(self, content):
+        """
+        返回content匹配到的前缀，多个前缀都匹配时返回配置中靠前的，与check_prefix一致
+        """
+        best = (self._empty_index, "") if self._empty_index is not None else None
+        node = self._root
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            found = node.get(None)
+            if found and (best is None or found[0] < best[0]):
+                best = found
+        return best[1] if best else None
+
+
+class KeywordAutomaton(object):
+    """
+    Aho-Corasick自动机，一次扫描判断文本中是否包含任意关键词
+    """
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [False]
+        self._match_all = False
+        for keyword in keywords or []:
+            if not keyword:
+                self._match_all = True  # 与str.find一致，空关键词匹配任意文本
+                continue
+            state = 0
+            for ch in keyword:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(False)
+                    self._goto[state][ch] = next_state
+                state = next_state
+            self._output[state] = True
+        self._build_fail()
+        self.empty = not self._match_all and len(self._goto) == 1
+
+    def _build_fail(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._output[next_state] = self._output[next_state] or self._output[self._fail[next_state]]
+
+    def search(self, content) -> bool:
+        if self._match_all:
+            return True
+        if self.empty:
+            return False
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return True
+        return False
+
+
+class TriggerMatcher(object):
+    def __init__(self, config):
+        group_name_white_list = config.get("group_name_white_list", []) or []
+        self.group_name_white_list = set(group_name_white_list)
+        self.all_group = "ALL_GROUP" in self.group_name_white_list
+        self.group_name_keywords = KeywordAutomaton(config.get("group_name_keyword_white_list", []))
+        group_chat_in_one_session = config.get("group_chat_in_one_session", []) or []
+        self.group_chat_in_one_session = set(group_chat_in_one_session)
+        self.all_group_in_one_session = "ALL_GROUP" in self.group_chat_in_one_session
+        self.nick_name_black_list = set(config.get("nick_name_black_list", []) or [])
+        self.group_chat_prefix = PrefixTrie(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordAutomaton(config.get("group_chat_keyword"))
+        self.single_chat_prefix = PrefixTrie(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixTrie(config.get("image_create_prefix", [""]))
+        self.group_at_off = config.get("group_at_off", False)
+        self.trigger_by_self = config.get("trigger_by_self", True)
+        self.always_reply_voice = config.get("always_reply_voice")
+        self.voice_reply_voice = config.get("voice_reply_voice")
+
+    def is_group_allowed(self, group_name) -> bool:
+        return self.all_group or group_name in self.group_name_white_list or (group_name is not None and self.group_name_keywords.search(group_name))
+
+    def is_group_in_one_session(self, group_name) -> bool:
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+    def is_nick_name_blocked(self, nick_name) -> bool:
+        return bool(nick_name) and nick_name in self.nick_name_black_list
+
+    def match_group_chat_prefix(self, content):
+        return self.group_chat_prefix.match(content)
+
+    def match_group_chat_keyword(self, content):
+        return True if self.group_chat_keyword.search(content) else None
+
+    def match_single_chat_prefix(self, content):
+        return self.single_chat_prefix.match(content)
+
+    def match_image_create_prefix(self, content):
+        return self.image_create_prefix.match(content)
+
+    @staticmethod
+    def remove_at(content, name):
+        return at_pattern(name).sub("", content)
+
+
+@functools.lru_cache(maxsize=4096)
+def at_pattern(name):
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+
+
+_state = (None, None, None)  # (配置对象, 配置版本, 匹配器)，整体替换保证三者一致
+_lock = threading.Lock()
+
+
+def get_trigger_matcher() -> TriggerMatcher:
+    """
+    获取与当前配置对应的匹配器，配置对象被替换或修改后重新构建
+    """
+    global _state
+    config = conf()
+    state = _state
+    if state[0] is not config or state[1] != config.version:
+        with _lock:
+            state = _state
+            if state[0] is not config or state[1] != config.version:
+                state = (config, config.version, TriggerMatcher(config))
+                _state = state
+    return state[2]
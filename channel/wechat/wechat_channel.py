@@ -16,7 +16,7 @@ from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel import chat_channel
 from channel.wechat.wechat_message import *
-from common.expired_dict import ExpiredDict
+from common.msg_dedup import MessageDeduplicator
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
@@ -24,6 +24,7 @@ from common.utils import convert_webp_to_png, remove_markdown_symbol
 from config import conf, get_appdata_dir
 from lib import itchat
 from lib.itchat.content import *
+from lib.itchat.download import MediaCache
 
 
 @itchat.msg_register([TEXT, VOICE, PICTURE, NOTE, ATTACHMENT, SHARING])
@@ -63,10 +64,8 @@ def deal_with_friend(msg):
 def _check(func):
     def wrapper(self, cmsg: ChatMessage):
         msgId = cmsg.msg_id
-        if msgId in self.receivedMsgs:
-            logger.info("Wechat message {} already received, ignore".format(msgId))
+        if MessageDeduplicator().is_duplicate("wx", msgId):
             return
-        self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if conf().get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
             logger.debug("[WX]history message {} skipped".format(msgId))
@@ -130,15 +129,21 @@ def qrCallback(uuid, status, qrcode):
 @singleton
 class WechatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    send_rate_limited = True
 
     def __init__(self):
         super().__init__()
-        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
         self.auto_login_times = 0
 
     def startup(self):
         try:
             itchat.instance.receivingRetryCount = 600  # 修改断线超时时间
+            max_size = conf().get("media_download_max_size", 0)
+            itchat.instance.downloadMaxSize = max_size * 1024 * 1024 if max_size else None
+            cache_size = conf().get("media_cache_size", 0)
+            if cache_size:
+                cache_dir = os.path.join(get_appdata_dir(), "media_cache")
+                itchat.instance.mediaCache = MediaCache(cache_dir, cache_size * 1024 * 1024)
             # login by scan QRCode
             hotReload = conf().get("hot_reload", False)
             status_path = os.path.join(get_appdata_dir(), "itchat.pkl")
@@ -158,12 +163,21 @@ class WechatChannel(ChatChannel):
         except Exception as e:
             logger.exception(e)
 
+    def receiving_metrics(self):
+        pipeline = itchat.instance.receivingPipeline
+        return pipeline.metrics() if pipeline is not None else None
+
+    def media_cache_metrics(self):
+        cache = itchat.instance.mediaCache
+        return cache.metrics() if cache is not None else None
+
     def exitCallback(self):
         try:
             time.sleep(2)
             self.auto_login_times += 1
             if self.auto_login_times < 3:
                 chat_channel.handler_pool._shutdown = False
+                chat_channel.fast_handler_pool._shutdown = False
                 self.startup()
         except Exception as e:
             pass
@@ -1,21 +1,23 @@
 # -*- coding=utf-8 -*-
 import io
 import os
-import time
+from functools import partial
 
 import requests
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
 from wechatpy.enterprise.exceptions import InvalidCorpIdException
-from wechatpy.exceptions import InvalidSignatureException, WeChatClientException
+from wechatpy.exceptions import InvalidSignatureException
 
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
+from channel.send_pipeline import SendPipeline, when_all_done
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
 from common.log import logger
+from common.msg_dedup import MessageDeduplicator
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length, convert_webp_to_png, remove_markdown_symbol
 from config import conf, subscribe_msg
@@ -41,6 +43,7 @@ class WechatComAppChannel(ChatChannel):
         )
         self.crypto = WeChatCrypto(self.token, self.aes_key, self.corp_id)
         self.client = WechatComAppClient(self.corp_id, self.secret)
+        self.send_pipeline = SendPipeline("wechatcom", conf().get("send_pipeline_workers", 4), conf().get("media_upload_workers", 4), conf().get("send_max_retries", 2))
 
     def startup(self):
         # start message listener
@@ -50,6 +53,7 @@ class WechatComAppChannel(ChatChannel):
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
     def send(self, reply: Reply, context: Context):
+        # 只负责拆分和入队，上传在上传线程池中并发执行，发送按接收者顺序进行，处理线程不再等待
         receiver = context["receiver"]
         if reply.type in [ReplyType.TEXT, ReplyType.ERROR, ReplyType.INFO]:
             reply_text = remove_markdown_symbol(reply.content)
@@ -57,79 +61,68 @@ class WechatComAppChannel(ChatChannel):
             if len(texts) > 1:
                 logger.info("[wechatcom] text too long, split into {} parts".format(len(texts)))
             for i, text in enumerate(texts):
-                self.client.message.send_text(self.agent_id, receiver, text)
-                if i != len(texts) - 1:
-                    time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                # 分段之间间隔0.5秒，防止发送过快乱序
+                self.send_pipeline.enqueue(receiver, partial(self.client.message.send_text, self.agent_id, receiver, text), delay=0.5 if i else 0, desc="text")
             logger.info("[wechatcom] Do send text to {}: {}".format(receiver, reply_text))
         elif reply.type == ReplyType.VOICE:
-            try:
-                media_ids = []
-                file_path = reply.content
-                amr_file = os.path.splitext(file_path)[0] + ".amr"
-                any_to_amr(file_path, amr_file)
-                duration, files = split_audio(amr_file, 60 * 1000)
-                if len(files) > 1:
-                    logger.info("[wechatcom] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
-                for path in files:
-                    response = self.client.media.upload("voice", open(path, "rb"))
-                    logger.debug("[wechatcom] upload voice response: {}".format(response))
-                    media_ids.append(response["media_id"])
-            except WeChatClientException as e:
-                logger.error("[wechatcom] upload voice failed: {}".format(e))
-                return
-            try:
-                os.remove(file_path)
-                if amr_file != file_path:
-                    os.remove(amr_file)
-            except Exception:
-                pass
-            for media_id in media_ids:
-                self.client.message.send_voice(self.agent_id, receiver, media_id)
-                time.sleep(1)
+            file_path = reply.content
+            amr_file = os.path.splitext(file_path)[0] + ".amr"
+            any_to_amr(file_path, amr_file)
+            duration, files = split_audio(amr_file, 60 * 1000)
+            if len(files) > 1:
+                logger.info("[wechatcom] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
+            uploads = [self.send_pipeline.upload(self._upload_media, "voice", path) for path in files]
+            for i, upload in enumerate(uploads):
+                self.send_pipeline.enqueue(receiver, partial(self.client.message.send_voice, self.agent_id, receiver), upload, delay=1 if i else 0, desc="voice")
+            when_all_done(uploads, partial(self._remove_files, {file_path, amr_file, *files}))
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
-            image_storage.seek(0)
-            if ".webp" in img_url:
-                try:
-                    image_storage = convert_webp_to_png(image_storage)
-                except Exception as e:
-                    logger.error(f"Failed to convert image: {e}")
-                    return
-            try:
-                response = self.client.media.upload("image", image_storage)
-                logger.debug("[wechatcom] upload image response: {}".format(response))
-            except WeChatClientException as e:
-                logger.error("[wechatcom] upload image failed: {}".format(e))
-                return
-
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
+            upload = self.send_pipeline.upload(self._upload_image_url, img_url)
+            self.send_pipeline.enqueue(receiver, partial(self.client.message.send_image, self.agent_id, receiver), upload, desc="image")
             logger.info("[wechatcom] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-            image_storage = reply.content
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
+            upload = self.send_pipeline.upload(self._upload_image, reply.content)
+            self.send_pipeline.enqueue(receiver, partial(self.client.message.send_image, self.agent_id, receiver), upload, desc="image")
+            logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
+
+    def send_pipeline_metrics(self) -> dict:
+        return self.send_pipeline.metrics()
+
+    def _upload_media(self, media_type, path):
+        with open(path, "rb") as f:
+            response = self.client.media.upload(media_type, f)
+        logger.debug("[wechatcom] upload {} response: {}".format(media_type, response))
+        return response["media_id"]
+
+    def _upload_image_url(self, img_url):
+        pic_res = requests.get(img_url, stream=True)
+        image_storage = io.BytesIO()
+        for block in pic_res.iter_content(1024):
+            image_storage.write(block)
+        if ".webp" in img_url:
             image_storage.seek(0)
+            image_storage = convert_webp_to_png(image_storage)
+        return self._upload_image(image_storage)
+
+    def _upload_image(self, image_storage):
+        sz = fsize(image_storage)
+        if sz >= 10 * 1024 * 1024:
+            logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
+            image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
+            logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
+        image_storage.seek(0)
+        response = self.client.media.upload("image", image_storage)
+        logger.debug("[wechatcom] upload image response: {}".format(response))
+        return response["media_id"]
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
             try:
-                response = self.client.media.upload("image", image_storage)
-                logger.debug("[wechatcom] upload image response: {}".format(response))
-            except WeChatClientException as e:
-                logger.error("[wechatcom] upload image failed: {}".format(e))
-                return
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
-            logger.info("[wechatcom] sendImage, receiver={}".format(receiver))
+                os.remove(path)
+            except Exception:
+                pass
 
 
 class Query:
@@ -174,6 +167,8 @@ class Query:
             except NotImplementedError as e:
                 logger.debug("[wechatcom] " + str(e))
                 return "success"
+            if MessageDeduplicator().is_duplicate("wechatcom_app", wechatcom_msg.msg_id):
+                return "success"
             context = channel._compose_context(
                 wechatcom_msg.ctype,
                 wechatcom_msg.content,
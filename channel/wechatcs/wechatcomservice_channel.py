@@ -16,8 +16,10 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcs.wechatcomservice_message import WechatComServiceMessage
+from channel.wechatcs.wechatcomservice_sync import KfSyncEngine
 from common.log import logger
 from common.singleton import singleton
+from common.token_manager import AccessTokenManager
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length
 from config import conf, subscribe_msg
 from voice.audio_convert import any_to_amr, split_audio
@@ -31,6 +33,7 @@ from wechatpy.exceptions import InvalidSignatureException
 from wechatpy.enterprise.exceptions import InvalidCorpIdException
 
 MAX_UTF8_LEN = 2048
+INVALID_TOKEN_ERRCODES = (40001, 40014, 42001)
 
 
 @singleton
@@ -54,6 +57,7 @@ class WechatComServiceChannel(ChatChannel):
         )
         self.crypto = WeChatCrypto(self.token, self.aes_key, self.corp_id)
         self.client = WechatComAppClient(self.corp_id, self.secret)
+        self.sync_engine = KfSyncEngine(self.sync_msg, self.handle_kf_message)
 
     def startup(self):
         # start message listener
@@ -178,7 +182,7 @@ class WechatComServiceChannel(ChatChannel):
                 logger.error("Invalid JSON format in reply.content")
 
     def send_text_message(self, external_userid, open_kfid, content, msgid=None):
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.fetch_access_token()}"
+        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.access_token}"
         data = {
             "touser": external_userid,
             "open_kfid": open_kfid,
@@ -192,7 +196,7 @@ class WechatComServiceChannel(ChatChannel):
         return response.json()
 
     def send_image_message(self, external_userid, open_kfid, msgid=None, media_id=None):
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.fetch_access_token()}"
+        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.access_token}"
         data = {
             "touser": external_userid,
             "open_kfid": open_kfid,
@@ -210,7 +214,7 @@ class WechatComServiceChannel(ChatChannel):
         return response
 
     def send_voice_message(self, external_userid, open_kfid, media_id, msgid=None):
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.fetch_access_token()}"
+        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.access_token}"
         data = {
             "touser": external_userid,
             "open_kfid": open_kfid,
@@ -239,7 +243,7 @@ class WechatComServiceChannel(ChatChannel):
         if msgid:
             data["msgid"] = msgid
         # 发送图文链接消息
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.fetch_access_token()}"
+        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/send_msg?access_token={self.client.access_token}"
         response = requests.post(url, json=data).json()
         if response['errmsg'] == 'ok':
             print("Send LINK Message Success")
@@ -247,35 +251,48 @@ class WechatComServiceChannel(ChatChannel):
             print(f"Something error: {response}")
         return response
 
-    def get_latest_message(self, token, open_kfid, next_cursor=""):
-        logger.debug(f"self.client.fetch_access_token():{self.client.fetch_access_token()}")
-        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/sync_msg?access_token={self.client.fetch_access_token()}"
+    def sync_msg(self, token, open_kfid, next_cursor="", limit=1000):
+        access_token = self.client.access_token
+        url = f"https://qyapi.weixin.qq.com/cgi-bin/kf/sync_msg?access_token={access_token}"
         data = {
             "token": token,
             "open_kfid": open_kfid,
-            "limit": 1000
+            "limit": limit
         }
         if next_cursor:
             data["cursor"] = next_cursor
 
-        response = requests.post(url, json=data)
+        response = requests.post(url, json=data, timeout=10)
         response_data = response.json()
-        # if response_data["errcode"] == 0 and response_data["msg_list"]:
-        #     return response_data["msg_list"][-1]  # 返回最新的一条消息
-        # else:
-        #     return None
 
         # 检查是否有错误码并打印相关错误信息
         if response_data.get("errcode") != 0:
+            if response_data.get("errcode") in INVALID_TOKEN_ERRCODES:
+                AccessTokenManager().invalidate(self.client.token_key, access_token)
             logger.error(
                 f"[ERROR][{response_data.get('errcode')}][{response_data.get('errmsg')}] - Failed to fetch messages, more info at {response_data.get('more_info') or 'https://open.work.weixin.qq.com/devtool/query?e=' + str(response_data.get('errcode'))}")
             return None
 
-        logger.debug(f"response_data:{response_data}")
-        if response_data.get("msg_list"):
-            return response_data["msg_list"][-1]  # 返回最新的一条消息
-        else:
-            return None
+        logger.debug("[wechatcs] sync_msg got {} messages, has_more={}".format(len(response_data.get("msg_list") or []), response_data.get("has_more")))
+        return response_data
+
+    def handle_kf_message(self, msg):
+        try:
+            wechatcom_copy_msg = WechatComServiceMessage(msg=msg, client=self.client)
+        except NotImplementedError as e:
+            logger.debug("[wechatcs] " + str(e))
+            return
+        context = self._compose_context(
+            wechatcom_copy_msg.ctype,
+            wechatcom_copy_msg.content,
+            isgroup=False,
+            msg=wechatcom_copy_msg,
+        )
+        if context:
+            self.produce(context)
+
+    def sync_metrics(self) -> dict:
+        return self.sync_engine.metrics()
 
 
 class Query:
@@ -315,28 +332,10 @@ class Query:
             if msg_type == "event" and event == "kf_msg_or_event":
                 # 在这里处理特定事件
                 # 示例代码，根据实际情况修改
+                # 回调只通知有新消息，消息内容在后台按保存的cursor拉取，同一客服的并发回调合并为一次同步
                 token = xml_tree.find("Token").text
                 open_kfid = xml_tree.find("OpenKfId").text
-                next_cursor = ""  # 第一次请求时不需要提供 cursor
-
-                latest_message = channel.get_latest_message(token, open_kfid, next_cursor)
-                logger.debug(f"[wechatcs] latest_message: {latest_message}")
-                try:
-                    wechatcom_copy_msg = WechatComServiceMessage(msg=latest_message, client=channel.client)
-                    logger.debug(f"[wechatcs] wechatcom_copy_msg: {wechatcom_copy_msg}")
-                except NotImplementedError as e:
-                    logger.debug("[wechatcs] " + str(e))
-                    return "success"
-                context = channel._compose_context(
-                    wechatcom_copy_msg.ctype,
-                    wechatcom_copy_msg.content,
-                    isgroup=False,
-                    msg=wechatcom_copy_msg,
-                )
-                logger.debug(f"[wechatcs] context: {context}")
-                if context:
-                    channel.produce(context)
-                logger.debug(f"[wechatcs] get latest message: {latest_message}")
+                channel.sync_engine.notify(token, open_kfid)
                 return json.dumps({"status": "success"})
             else:
                 return "Unsupported event type"
@@ -50,6 +50,8 @@ class WechatComServiceMessage(ChatMessage):
 
             # download_voice()
             self._prepare_fn = download_voice
+        else:
+            raise NotImplementedError("Unsupported message type: Type:{} ".format(self.msgtype))
         # 可以根据需要添加更多消息类型的处理
         self.from_user_id = self.external_userid
         self.to_user_id = self.open_kfid
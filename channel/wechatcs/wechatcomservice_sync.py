@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+
+from common.log import logger
+from common.msg_dedup import MessageDeduplicator
+from config import conf, get_appdata_dir
+
+# 微信客服消息来源，3为客户发送的消息，4为系统事件，5为接待人员(包括本程序)发送的消息
+ORIGIN_CUSTOMER = 3
+
+
+class KfCursorStore(object):
+    """
+    按open_kfid保存kf/sync_msg返回的next_cursor，重启后从上次的位置继续拉取
+    每次更新都写入临时文件再替换，进程中途退出也不会留下不完整的文件
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_appdata_dir(), "wechatcs_cursors.json")
+        self._lock = threading.Lock()
+        self._cursors = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._cursors = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("[wechatcs] load sync cursors failed: {}".format(e))
+
+    def get(self, open_kfid):
+        with self._lock:
+            return self._cursors.get(open_kfid, "")
+
+    def set(self, open_kfid, cursor):
+        with self._lock:
+            if not cursor or self._cursors.get(open_kfid) == cursor:
+                return
+            self._cursors[open_kfid] = cursor
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._cursors, f)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning("[wechatcs] save sync cursor failed: {}".format(e))
+
+
+class KfSyncEngine(object):
+    """
+    微信客服消息同步，收到kf_msg_or_event回调后从保存的cursor开始按has_more翻页拉取全部新消息，
+    按msgid去重后逐条交给handler处理
+    同一个open_kfid同时只有一个同步在进行，同步期间到达的回调只记录token，当前同步结束后再补拉一轮
+    """
+
+    def __init__(self, fetch_fn, handler, cursor_store: KfCursorStore = None):
+        """
+        :param fetch_fn: fetch_fn(token, open_kfid, cursor, limit)，返回sync_msg的响应，失败时返回None
+        :param handler: handler(msg)，处理一条客户消息
+        """
+        self.fetch_fn = fetch_fn
+        self.handler = handler
+        self.cursor_store = cursor_store or KfCursorStore()
+        self.limit = conf().get("wechatcs_sync_limit", 1000)
+        self.max_age = conf().get("wechatcs_msg_max_age", 600)
+        self._states = {}  # open_kfid -> {"token": 最新的回调token, "running": 是否正在同步, "pending": 同步期间是否有新回调}
+        self._lock = threading.Lock()
+        self.stats = {"callbacks": 0, "coalesced": 0, "syncs": 0, "pages": 0, "messages": 0, "handled": 0, "skipped": 0, "errors": 0}
+
+    def notify(self, token, open_kfid):
+        """
+        收到回调时调用，立即返回，拉取在后台线程中进行
+        """
+        with self._lock:
+            self.stats["callbacks"] += 1
+            state = self._states.setdefault(open_kfid, {"token": token, "running": False, "pending": False})
+            state["token"] = token
+            if state["running"]:
+                state["pending"] = True
+                self.stats["coalesced"] += 1
+                return
+            state["running"] = True
+        threading.Thread(target=self._run, args=(open_kfid,), name="wechatcs_sync_{}".format(open_kfid), daemon=True).start()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["running"] = sum(1 for state in self._states.values() if state["running"])
+        return metrics
+
+    def _run(self, open_kfid):
+        while True:
+            with self._lock:
+                state = self._states[open_kfid]
+                state["pending"] = False
+                token = state["token"]
+                self.stats["syncs"] += 1
+            try:
+                self.sync(token, open_kfid)
+            except Exception as e:
+                self._count("errors")
+                logger.exception("[wechatcs] sync messages failed, open_kfid={}: {}".format(open_kfid, e))
+            with self._lock:
+                if not state["pending"]:
+                    state["running"] = False
+                    return
+
+    def sync(self, token, open_kfid):
+        cursor = self.cursor_store.get(open_kfid)
+        # 没有保存过cursor时会拉到最近几天的历史消息，只处理max_age以内的，避免重启后回复旧消息
+        min_send_time = time.time() - self.max_age if self.max_age else 0
+        while True:
+            response = self.fetch_fn(token, open_kfid, cursor, self.limit)
+            if response is None:
+                self._count("errors")
+                return
+            self._count("pages")
+            msg_list = response.get("msg_list") or []
+            for msg in msg_list:
+                self._handle(msg, min_send_time)
+            next_cursor = response.get("next_cursor")
+            if next_cursor:
+                cursor = next_cursor
+                self.cursor_store.set(open_kfid, cursor)
+            if not response.get("has_more") or not next_cursor:
+                return
+
+    def _handle(self, msg, min_send_time):
+        self._count("messages")
+        if msg.get("origin") != ORIGIN_CUSTOMER or msg.get("send_time", 0) < min_send_time:
+            self._count("skipped")
+            return
+        if MessageDeduplicator().is_duplicate("wechatcs", msg.get("msgid")):
+            self._count("skipped")
+            return
+        try:
+            self.handler(msg)
+            self._count("handled")
+        except Exception as e:
+            self._count("errors")
+            logger.exception("[wechatcs] handle message failed, msgid={}: {}".format(msg.get("msgid"), e))
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
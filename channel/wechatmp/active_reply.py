@@ -10,6 +10,7 @@ from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_channel import WechatMPChannel
 from channel.wechatmp.wechatmp_message import WeChatMPMessage
 from common.log import logger
+from common.msg_dedup import MessageDeduplicator
 from config import conf, subscribe_msg
 
 
@@ -40,6 +41,9 @@ class Query:
                 from_user = wechatmp_msg.from_user_id
                 content = wechatmp_msg.content
                 message_id = wechatmp_msg.msg_id
+                # 公众号服务器在5秒内未收到响应时会重试，重复的消息直接丢弃
+                if MessageDeduplicator().is_duplicate("wechatmp", message_id):
+                    return "success"
 
                 logger.info(
                     "[wechatmp] {}:{} Receive post query {} {}: {}".format(
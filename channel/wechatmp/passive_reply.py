@@ -62,7 +62,7 @@ class Query:
                     logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
 
                     if supported and context:
-                        channel.running.add(from_user)
+                        channel.passive_state.start(from_user)
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
@@ -100,20 +100,15 @@ class Query:
                     )
                 )
 
-                task_running = True
-                waiting_until = request_time + 4
-                while time.time() < waiting_until:
-                    if from_user in channel.running:
-                        time.sleep(0.1)
-                    else:
-                        task_running = False
-                        break
+                # 阻塞等待回复生成完成的事件，完成后立即返回，不再轮询
+                task_running = not channel.passive_state.wait(from_user, request_time + 4 - time.time())
 
                 reply_text = ""
                 if task_running:
                     if request_cnt < 3:
                         # waiting for timeout (the POST request will be closed by Wechat official server)
-                        time.sleep(2)
+                        # 在5秒内返回任何内容都会让公众号服务器停止重试，只能等到连接被关闭
+                        time.sleep(max(request_time + 6 - time.time(), 0))
                         # and do nothing, waiting for the next request
                         return "success"
                     else:  # request_cnt == 3:
@@ -123,19 +118,14 @@ class Query:
                         return encrypt_func(replyPost.render())
 
                 # reply is ready
-                channel.request_cnt.pop(message_id)
+                channel.request_cnt.pop(message_id, None)
 
                 # no return because of bandwords or other reasons
-                if from_user not in channel.cache_dict and from_user not in channel.running:
-                    return "success"
-
                 # Only one request can access to the cached data
-                try:
-                    (reply_type, reply_content) = channel.cache_dict[from_user].pop(0)
-                    if not channel.cache_dict[from_user]:  # If popping the message makes the list empty, delete the user entry from cache
-                        del channel.cache_dict[from_user]
-                except IndexError:
+                reply = channel.passive_state.pop_reply(from_user)
+                if reply is None:
                     return "success"
+                (reply_type, reply_content) = reply
 
                 if reply_type == "text":
                     if len(reply_content.encode("utf8")) <= MAX_UTF8_LEN:
@@ -148,7 +138,7 @@ class Query:
                             max_split=1,
                         )
                         reply_text = splits[0] + continue_text
-                        channel.cache_dict[from_user].append(("text", splits[1]))
+                        channel.passive_state.cache_reply(from_user, "text", splits[1])
 
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
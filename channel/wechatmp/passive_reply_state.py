@@ -0,0 +1,141 @@
+import threading
+import time
+
+from common.expired_dict import ExpiredDict
+from config import conf
+
+
+class PassiveReplyState(object):
+    """
+    公众号被动回复模式下的回复状态
+        cache_dict: 用户 -> 待取回的回复列表，用户不再发消息取回时按ttl过期
+        running: 用户 -> threading.Event，回复生成完成后set，等待中的回调请求立即返回
+        request_cnt: 消息id -> 公众号服务器对该消息的请求次数
+    """
+
+    def __init__(self, cache_ttl=None, cache_size=None, running_ttl=None):
+        self.cache_dict = ExpiredDict(cache_ttl or conf().get("wechatmp_reply_cache_ttl", 600), max_size=cache_size or conf().get("wechatmp_reply_cache_size", 10000))
+        # 生成回复的任务异常丢失时，超时后允许用户重新提问
+        self.running = ExpiredDict(running_ttl or conf().get("wechatmp_running_ttl", 600))
+        # 公众号服务器对同一消息最多重试3次，超时后清理未完成的计数，避免长期占用内存
+        self.request_cnt = ExpiredDict(60)
+        # 回复由发送线程写入、由回调请求线程取出，对回复列表的读改写需加锁
+        self._lock = threading.Lock()
+
+    def start(self, user):
+        self.running[user] = threading.Event()
+
+    def finish(self, user):
+        event = self.running.pop(user, None)
+        if event:
+            event.set()
+
+    def wait(self, user, timeout) -> bool:
+        """
+        等待用户的回复生成完成，返回是否已完成
+        """
+        event = self.running.get(user)
+        return event is None or event.wait(max(timeout, 0))
+
+    def cache_reply(self, user, reply_type, content):
+        with self._lock:
+            replies = self.cache_dict.get(user)
+            if replies is None:
+                self.cache_dict[user] = [(reply_type, content)]
+            else:
+                replies.append((reply_type, content))
+
+    def pop_reply(self, user):
+        """
+        取出用户最早的一条回复，没有回复时返回None
+        """
+        with self._lock:
+            replies = self.cache_dict.get(user)
+            if not replies:
+                return None
+            reply = replies.pop(0)
+            if not replies:
+                self.cache_dict.pop(user, None)
+            return reply
+
+
+if __name__ == "__main__":
+    # 被动回复压测: python -m channel.wechatmp.passive_reply_state [服务线程数] [时间缩放]
+    # 模拟公众号服务器的重试规则(每次请求5秒超时，最多3次，共15秒)，统计不同关注者并发量下在15秒内拿到回复的比例
+    # 时间按缩放比例压缩，0.1表示15秒的窗口用1.5秒跑完
+    import random
+    import sys
+    from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+    server_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    scale = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+
+    def run(followers, mode):
+        state = PassiveReplyState(cache_ttl=60, cache_size=followers * 2, running_ttl=60)
+        server = ThreadPoolExecutor(max_workers=server_threads)
+        results = {}
+        timers = []
+        started = set()
+
+        def generate(user):
+            state.cache_reply(user, "text", "reply")
+            state.finish(user)
+
+        def handle(user, request_cnt, request_time):
+            # 与passive_reply.Query.POST相同的等待逻辑，mode=poll为改造前的轮询
+            if user not in started:
+                started.add(user)
+                state.start(user)
+                timer = threading.Timer(random.uniform(1, 10) * scale, generate, (user,))
+                timer.start()
+                timers.append(timer)
+            deadline = request_time + 4 * scale
+            if mode == "event":
+                done = state.wait(user, deadline - time.monotonic())
+            else:
+                done = False
+                while time.monotonic() < deadline:
+                    if user in state.running:
+                        time.sleep(0.1 * scale)
+                    else:
+                        done = True
+                        break
+            if not done or time.monotonic() - request_time > 5 * scale:
+                time.sleep(max(request_time + 6 * scale - time.monotonic(), 0))
+                return None
+            return state.pop_reply(user)
+
+        def follower(user):
+            start = time.monotonic()
+            for request_cnt in (1, 2, 3):
+                request_time = start + (request_cnt - 1) * 5 * scale
+                time.sleep(max(request_time - time.monotonic(), 0))
+                future = server.submit(handle, user, request_cnt, request_time)
+                try:
+                    # 公众号服务器5秒内没有收到响应就断开并重试，排队等待服务线程的时间也计算在内
+                    if future.result(timeout=max(request_time + 5 * scale - time.monotonic(), 0)):
+                        results[user] = (time.monotonic() - start) / scale
+                        return
+                except Exception:
+                    pass
+
+        cpu_start = time.process_time()
+        with ThreadPoolExecutor(max_workers=followers) as clients:
+            wait_futures([clients.submit(follower, "user_%d" % i) for i in range(followers)])
+        cpu = time.process_time() - cpu_start
+        for timer in timers:
+            timer.cancel()
+        server.shutdown(wait=True)
+        latencies = sorted(results.values())
+        return {
+            "served": len(results) / followers,
+            "p50_s": latencies[len(latencies) // 2] if latencies else None,
+            "cpu_s": cpu,
+        }
+
+    print("server_threads={}, scale={}".format(server_threads, scale))
+    for followers in (10, 50, 100, 200, 400):
+        for mode in ("poll", "event"):
+            r = run(followers, mode)
+            print("{:>4} followers {:<6} served {:6.1%}  p50 {:>5}s  cpu {:.2f}s".format(
+                followers, mode, r["served"], round(r["p50_s"], 1) if r["p50_s"] else "-", r["cpu_s"]))
@@ -4,18 +4,18 @@ import imghdr
 import io
 import os
 import threading
-import time
+from functools import partial
 
 import requests
 import web
 from wechatpy.crypto import WeChatCrypto
-from wechatpy.exceptions import WeChatClientException
-from collections import defaultdict
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.send_pipeline import SendPipeline, when_all_done
 from channel.wechatmp.common import *
+from channel.wechatmp.passive_reply_state import PassiveReplyState
 from channel.wechatmp.wechatmp_client import WechatMPClient
 from common.log import logger
 from common.singleton import singleton
@@ -42,16 +42,19 @@ class WechatMPChannel(ChatChannel):
         token = conf().get("wechatmp_token")
         aes_key = conf().get("wechatmp_aes_key")
         self.client = WechatMPClient(appid, secret)
+        self.send_pipeline = SendPipeline("wechatmp", conf().get("send_pipeline_workers", 4), conf().get("media_upload_workers", 4), conf().get("send_max_retries", 2))
         self.crypto = None
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
+            # 待取回的回复、处理中的用户和请求计数都有过期时间，用户不再取回时自动清理
+            self.passive_state = PassiveReplyState()
             # Cache the reply to the user's first message
-            self.cache_dict = defaultdict(list)
+            self.cache_dict = self.passive_state.cache_dict
             # Record whether the current message is being processed
-            self.running = set()
+            self.running = self.passive_state.running
             # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            self.request_cnt = self.passive_state.request_cnt
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -65,7 +68,18 @@ class WechatMPChannel(ChatChannel):
             urls = ("/wx", "channel.wechatmp.active_reply.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatmp_port", 8080)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        if self.passive_reply:
+            # 被动回复的每个请求最多占用服务线程6秒，默认的10个线程只能同时服务很少的用户
+            from cheroot import wsgi
+
+            server = wsgi.Server(("0.0.0.0", port), app.wsgifunc(), numthreads=conf().get("wechatmp_server_threads", 64))
+            logger.info("[wechatmp] http://0.0.0.0:{}/ server_threads={}".format(port, server.requests.min))
+            try:
+                server.start()
+            except KeyboardInterrupt:
+                server.stop()
+        else:
+            web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
     def start_loop(self, loop):
         asyncio.set_event_loop(loop)
@@ -78,12 +92,14 @@ class WechatMPChannel(ChatChannel):
         logger.info("[wechatmp] permanent media {} has been deleted".format(media_id))
 
     def send(self, reply: Reply, context: Context):
+        # 只负责拆分和入队，上传在上传线程池中并发执行，写入缓存或发送按接收者顺序进行，处理线程不再等待
         receiver = context["receiver"]
+        pipeline = self.send_pipeline
         if self.passive_reply:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = remove_markdown_symbol(reply.content)
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                pipeline.enqueue(receiver, partial(self._cache_reply, receiver, "text", reply_text), desc="text")
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -92,90 +108,14 @@ class WechatMPChannel(ChatChannel):
 
                 for path in files:
                     # support: <2M, <60s, mp3/wma/wav/amr
-                    try:
-                        with open(path, "rb") as f:
-                            response = self.client.material.add("voice", f)
-                            logger.debug("[wechatmp] upload voice response: {}".format(response))
-                            f_size = os.fstat(f.fileno()).st_size
-                            time.sleep(1.0 + 2 * f_size / 1024 / 1024)
-                            # todo check media_id
-                    except WeChatClientException as e:
-                        logger.error("[wechatmp] upload voice failed: {}".format(e))
-                        return
-                    media_id = response["media_id"]
-                    logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
-
-            elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-                img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
-            elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-                image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.material.add("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
-            elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
-                video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
-
-            elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
-                video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.material.add("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                media_id = response["media_id"]
-                logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
-
+                    upload = pipeline.upload(self._add_material, "voice", path)
+                    # 永久素材上传后需要等待一段时间才能使用，按文件大小在上传完成后延迟写入缓存
+                    delay = 1.0 + 2 * os.path.getsize(path) / 1024 / 1024
+                    pipeline.enqueue(receiver, partial(self._cache_reply, receiver, "voice"), upload, delay=delay, desc="voice")
+            elif reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.VIDEO_URL, ReplyType.VIDEO]:
+                media_type = self._media_type(reply.type)
+                upload = pipeline.upload(self._upload_reply_media, self.client.material.add, reply, receiver + "-" + str(context["msg"].msg_id))
+                pipeline.enqueue(receiver, partial(self._cache_reply, receiver, media_type), upload, desc=media_type)
         else:
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = reply.content
@@ -183,122 +123,99 @@ class WechatMPChannel(ChatChannel):
                 if len(texts) > 1:
                     logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
                 for i, text in enumerate(texts):
-                    self.client.message.send_text(receiver, text)
-                    if i != len(texts) - 1:
-                        time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                    # 分段之间间隔0.5秒，防止发送过快乱序
+                    pipeline.enqueue(receiver, partial(self.client.message.send_text, receiver, text), delay=0.5 if i else 0, desc="text")
                 logger.info("[wechatmp] Do send text to {}: {}".format(receiver, reply_text))
             elif reply.type == ReplyType.VOICE:
-                try:
-                    file_path = reply.content
+                file_path = reply.content
+                file_name = os.path.basename(file_path)
+                file_type = os.path.splitext(file_name)[1]
+                if file_type == ".mp3":
+                    file_type = "audio/mpeg"
+                elif file_type == ".amr":
+                    file_type = "audio/amr"
+                else:
+                    mp3_file = os.path.splitext(file_path)[0] + ".mp3"
+                    any_to_mp3(file_path, mp3_file)
+                    file_path = mp3_file
                     file_name = os.path.basename(file_path)
-                    file_type = os.path.splitext(file_name)[1]
-                    if file_type == ".mp3":
-                        file_type = "audio/mpeg"
-                    elif file_type == ".amr":
-                        file_type = "audio/amr"
-                    else:
-                        mp3_file = os.path.splitext(file_path)[0] + ".mp3"
-                        any_to_mp3(file_path, mp3_file)
-                        file_path = mp3_file
-                        file_name = os.path.basename(file_path)
-                        file_type = "audio/mpeg"
-                    logger.info("[wechatmp] file_name: {}, file_type: {} ".format(file_name, file_type))
-                    media_ids = []
-                    duration, files = split_audio(file_path, 60 * 1000)
-                    if len(files) > 1:
-                        logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
-                    for path in files:
-                        # support: <2M, <60s, AMR\MP3
-                        response = self.client.media.upload("voice", (os.path.basename(path), open(path, "rb"), file_type))
-                        logger.debug("[wechatcom] upload voice response: {}".format(response))
-                        media_ids.append(response["media_id"])
-                        os.remove(path)
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload voice failed: {}".format(e))
-                    return
-
-                try:
-                    os.remove(file_path)
-                except Exception:
-                    pass
-
-                for media_id in media_ids:
-                    self.client.message.send_voice(receiver, media_id)
-                    time.sleep(1)
+                    file_type = "audio/mpeg"
+                logger.info("[wechatmp] file_name: {}, file_type: {} ".format(file_name, file_type))
+                duration, files = split_audio(file_path, 60 * 1000)
+                if len(files) > 1:
+                    logger.info("[wechatmp] voice too long {}s > 60s , split into {} parts".format(duration / 1000.0, len(files)))
+                # support: <2M, <60s, AMR\MP3
+                uploads = [pipeline.upload(self._upload_voice, path, file_type) for path in files]
+                for i, upload in enumerate(uploads):
+                    pipeline.enqueue(receiver, partial(self.client.message.send_voice, receiver), upload, delay=1 if i else 0, desc="voice")
+                when_all_done(uploads, partial(self._remove_files, {file_path, *files}))
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
-            elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-                img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                self.client.message.send_image(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send image to {}".format(receiver))
-            elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
-                image_storage = reply.content
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
-                    response = self.client.media.upload("image", (filename, image_storage, content_type))
-                    logger.debug("[wechatmp] upload image response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload image failed: {}".format(e))
-                    return
-                self.client.message.send_image(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send image to {}".format(receiver))
-            elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
-                video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                self.client.message.send_video(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send video to {}".format(receiver))
-            elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
-                video_storage = reply.content
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
-                    logger.debug("[wechatmp] upload video response: {}".format(response))
-                except WeChatClientException as e:
-                    logger.error("[wechatmp] upload video failed: {}".format(e))
-                    return
-                self.client.message.send_video(receiver, response["media_id"])
-                logger.info("[wechatmp] Do send video to {}".format(receiver))
+            elif reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.VIDEO_URL, ReplyType.VIDEO]:
+                media_type = self._media_type(reply.type)
+                send_fn = self.client.message.send_image if media_type == "image" else self.client.message.send_video
+                upload = pipeline.upload(self._upload_reply_media, self.client.media.upload, reply, receiver + "-" + str(context["msg"].msg_id))
+                pipeline.enqueue(receiver, partial(send_fn, receiver), upload, desc=media_type)
+                logger.info("[wechatmp] Do send {} to {}".format(media_type, receiver))
         return
 
+    def send_pipeline_metrics(self) -> dict:
+        return self.send_pipeline.metrics()
+
+    def _cache_reply(self, receiver, reply_type, content):
+        if reply_type != "text":
+            logger.info("[wechatmp] {} uploaded, receiver {}, media_id {}".format(reply_type, receiver, content))
+        self.passive_state.cache_reply(receiver, reply_type, content)
+
+    @staticmethod
+    def _media_type(reply_type):
+        return "image" if reply_type in [ReplyType.IMAGE_URL, ReplyType.IMAGE] else "video"
+
+    def _add_material(self, media_type, path):
+        with open(path, "rb") as f:
+            response = self.client.material.add(media_type, f)
+        logger.debug("[wechatmp] upload {} response: {}".format(media_type, response))
+        return response["media_id"]
+
+    def _upload_voice(self, path, file_type):
+        with open(path, "rb") as f:
+            response = self.client.media.upload("voice", (os.path.basename(path), f, file_type))
+        logger.debug("[wechatmp] upload voice response: {}".format(response))
+        return response["media_id"]
+
+    def _upload_reply_media(self, upload_fn, reply, name):
+        """
+        上传图片或视频回复，upload_fn为永久素材(被动回复)或临时素材(主动发送)的上传方法
+        """
+        storage = reply.content
+        if reply.type in [ReplyType.IMAGE_URL, ReplyType.VIDEO_URL]:  # 从网络下载
+            res = requests.get(reply.content, stream=True)
+            storage = io.BytesIO()
+            for block in res.iter_content(1024):
+                storage.write(block)
+        storage.seek(0)
+        if reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE]:
+            media_type, file_type = "image", imghdr.what(storage)
+        else:
+            media_type, file_type = "video", "mp4"
+        response = upload_fn(media_type, (name + "." + file_type, storage, media_type + "/" + file_type))
+        logger.debug("[wechatmp] upload {} response: {}".format(media_type, response))
+        return response["media_id"]
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            # 回复在流水线中写入缓存后才标记处理完成
+            self.send_pipeline.enqueue(context["receiver"], partial(self.passive_state.finish, session_id), desc="finish")
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
-            assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self.send_pipeline.enqueue(context["receiver"], partial(self.passive_state.finish, session_id), desc="finish")
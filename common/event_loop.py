@@ -0,0 +1,37 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import conf
+
+_loop = None
+_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    获取异步流水线使用的全局事件循环，首次调用时在守护线程中启动
+    同步的bot和插件通过该循环的默认线程池执行，避免阻塞事件循环
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=conf().get("async_executor_max_workers", 32), thread_name_prefix="async_executor"))
+            t = threading.Thread(target=_start_loop, args=(loop,), name="async_pipeline_loop")
+            t.setDaemon(True)
+            t.start()
+            _loop = loop
+    return _loop
+
+
+def _start_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def run_sync(coro, timeout=None):
+    """
+    在非事件循环线程中同步等待协程执行结果
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result(timeout)
@@ -1,42 +1,211 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
+_MISSING = object()
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+
+class ExpiredDict(MutableMapping):
+    """
+    带过期时间的线程安全字典，读写都会刷新过期时间
+    所有条目的有效期相同，按最近访问顺序保存在OrderedDict中，队首即最早过期的条目，
+    每次访问时从队首清理过期条目，均摊O(1)；设置max_size后超出容量时淘汰最久未访问的条目
+    """
+
+    def __init__(self, expires_in_seconds, max_size=None):
         self.expires_in_seconds = expires_in_seconds if expires_in_seconds else 3600
+        self.max_size = max_size
+        self._data = OrderedDict()  # key -> (value, 过期时间)
+        self._lock = threading.RLock()
+        # 统计数据
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            self._data[key] = (value, now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            if self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
 
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return len(self._data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__, dict(self.items()))
 
+    def get(self, key, default=None):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data[key] = (item[0], now + self.expires_in_seconds)
+            self._data.move_to_end(key)
+            return item[0]
+
+    def pop(self, key, *default):
+        with self._lock:
+            self._purge(time.monotonic())
+            if key in self._data:
+                return self._data.pop(key)[0]
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # keys/values/items返回快照，遍历时不刷新过期时间
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self._lock:
+            self._purge(time.monotonic())
+            return list(self._data.keys())
+
+    def values(self):
+        with self._lock:
+            self._purge(time.monotonic())
+            return [value for value, _ in self._data.values()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self._lock:
+            self._purge(time.monotonic())
+            return [(key, value) for key, (value, _) in self._data.items()]
 
-    def __iter__(self):
-        return self.keys().__iter__()
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+    # 调用方需持有self._lock
+    def _purge(self, now):
+        data = self._data
+        while data:
+            key = next(iter(data))
+            if data[key][1] > now:
+                break
+            del data[key]
+            self.expirations += 1
+
+
+if __name__ == "__main__":
+    # 与旧实现对比的微基准: python -m common.expired_dict [条目数]
+    import sys
+    from datetime import datetime, timedelta
+
+    class LegacyExpiredDict(dict):
+        def __init__(self, expires_in_seconds):
+            super().__init__()
+            self.expires_in_seconds = expires_in_seconds if expires_in_seconds else 3600
+
+        def __getitem__(self, key):
+            value, expiry_time = super().__getitem__(key)
+            if datetime.now() > expiry_time:
+                del self[key]
+                raise KeyError("expired {}".format(key))
+            self.__setitem__(key, value)
+            return value
+
+        def __setitem__(self, key, value):
+            expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
+            super().__setitem__(key, (value, expiry_time))
+
+        def get(self, key, default=None):
+            try:
+                return self[key]
+            except KeyError:
+                return default
+
+        def __contains__(self, key):
+            try:
+                self[key]
+                return True
+            except KeyError:
+                return False
+
+        def keys(self):
+            keys = list(super().keys())
+            return [key for key in keys if key in self]
+
+        def items(self):
+            return [(key, self[key]) for key in self.keys()]
+
+        def __iter__(self):
+            return self.keys().__iter__()
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    def bench(cls):
+        d = cls(3600)
+        result = {}
+        start = time.perf_counter()
+        for i in range(n):
+            d["msg_%d" % i] = True
+        result["set"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(n):
+            "msg_%d" % i in d
+        result["contains"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(n):
+            d.get("missing_%d" % i)
+        result["miss"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(10):
+            d.items()
+        result["items x10"] = time.perf_counter() - start
+        return result
+
+    legacy, current = bench(LegacyExpiredDict), bench(ExpiredDict)
+    print("{} entries".format(n))
+    for op in current:
+        print("{:<10} legacy {:8.3f}s  current {:8.3f}s".format(op, legacy[op], current[op]))
+
+    # 过期条目会被回收，旧实现中未被访问的过期条目永远不会释放
+    d = ExpiredDict(0.01)
+    for i in range(n):
+        d[i] = i
+    time.sleep(0.02)
+    d["new"] = True
+    print("after expiry: size={}, stats={}".format(len(d), d.stats()))
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from common.log import logger
+from common.session_store import create_session_store
+from common.singleton import singleton
+from config import conf
+
+
+@singleton
+class MessageDeduplicator(object):
+    """
+    所有渠道共用的消息去重，按 渠道:消息id 记录最近收到的消息，重复投递的消息在进入produce前丢弃
+    内存中按到达顺序保存在OrderedDict中，超过时间窗口或容量上限的记录从队首淘汰；
+    开启msg_dedup_persist且配置了session_store时，记录同时写入存储，重启或多实例部署后仍能去重
+    """
+
+    def __init__(self):
+        self.window_seconds = conf().get("msg_dedup_window_seconds", 27000)
+        self.max_size = conf().get("msg_dedup_max_size", 100000)
+        self.store = create_session_store("msg_dedup", self.window_seconds) if conf().get("msg_dedup_persist", False) else None
+        self._seen = OrderedDict()  # 渠道:消息id -> 收到时间
+        self._lock = threading.Lock()
+        self.checked = Counter()
+        self.dropped = Counter()
+
+    def is_duplicate(self, channel_type, msg_id) -> bool:
+        """
+        判断消息是否已经收到过，首次收到时记录并返回False
+        """
+        if msg_id is None or msg_id == "":
+            return False
+        key = "{}:{}".format(channel_type, msg_id)
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self.checked[channel_type] += 1
+            duplicate = key in self._seen
+            if not duplicate:
+                self._seen[key] = now
+                if len(self._seen) > self.max_size:
+                    self._seen.popitem(last=False)
+        if not duplicate and self.store:
+            try:
+                # 原子地检查并记录，多个实例同时收到同一条重试消息时只有一个会处理
+                duplicate = not self.store.put_if_absent(key, {"ts": int(time.time())})
+            except Exception as e:
+                logger.warning("[MsgDedup] persist check failed: {}".format(e))
+        if duplicate:
+            with self._lock:
+                self.dropped[channel_type] += 1
+            logger.info("[MsgDedup] duplicate message dropped, channel={}, msg_id={}".format(channel_type, msg_id))
+        return duplicate
+
+    def forget(self, channel_type, msg_id):
+        """
+        撤销is_duplicate的记录，消息未能处理(如入队失败)时调用，重新投递的消息不会被当作重复丢弃
+        """
+        if msg_id is None or msg_id == "":
+            return
+        key = "{}:{}".format(channel_type, msg_id)
+        with self._lock:
+            self._seen.pop(key, None)
+        if self.store:
+            try:
+                self.store.delete(key)
+            except Exception as e:
+                logger.warning("[MsgDedup] persist forget failed: {}".format(e))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._seen),
+                "checked": dict(self.checked),
+                "dropped": dict(self.dropped),
+            }
+
+    # 调用方需持有self._lock
+    def _purge(self, now):
+        seen = self._seen
+        deadline = now - self.window_seconds
+        while seen:
+            key = next(iter(seen))
+            if seen[key] > deadline:
+                break
+            del seen[key]
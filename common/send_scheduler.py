@@ -0,0 +1,201 @@
+"""
+出站消息发送调度，按账号限制总发送速率，按接收者限制单个会话的发送速率，避免触发微信的频率限制
+    每个账号一个调度线程，按优先级挑选可以发送的消息，交给发送线程池执行
+    同一接收者的消息按提交顺序发送，前一条发送结束(成功或放弃)后才发送下一条
+    发送失败按指数退避加随机抖动重试，重试期间不占用线程；重试耗尽后写入死信日志
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from common.log import logger
+from common.thread_pool import ElasticThreadPool
+from common.token_bucket import KeyedTokenBucket, TokenBucket
+from config import conf, get_appdata_dir
+
+PRIORITY_COMMAND = 0  # 管理命令的回复
+PRIORITY_REPLY = 1  # 普通对话回复
+PRIORITY_BULK = 2  # 群发、定时推送等批量消息
+
+
+class _SendTask(object):
+    __slots__ = ("receiver", "fn", "priority", "seq", "desc", "future", "attempts", "not_before")
+
+    def __init__(self, receiver, fn, priority, seq, desc):
+        self.receiver = receiver
+        self.fn = fn
+        self.priority = priority
+        self.seq = seq
+        self.desc = desc
+        self.future = Future()
+        self.attempts = 0
+        self.not_before = 0
+
+
+class _ReceiverState(object):
+    __slots__ = ("tasks", "inflight")
+
+    def __init__(self):
+        self.tasks = deque()
+        self.inflight = False
+
+
+class SendScheduler(object):
+    def __init__(self, account, rate_per_minute=60, receiver_rate_per_minute=20, max_retries=2, workers=4):
+        self.account = account
+        self.max_retries = max_retries
+        self.account_bucket = TokenBucket(rate_per_minute, initial_tokens=rate_per_minute)
+        # 接收者的令牌只保存在共用的按key令牌桶中，发送完成即可删除接收者状态
+        self.receiver_buckets = KeyedTokenBucket(receiver_rate_per_minute, max_keys=conf().get("send_receiver_bucket_size", 10000))
+        self.pool = ElasticThreadPool("send_{}".format(account), min_workers=0, max_workers=workers)
+        self._receivers = {}
+        self._cond = threading.Condition()
+        self._seq = 0
+        self.stats = {"submitted": 0, "sent": 0, "retries": 0, "dead": 0, "throttled": 0}
+        self.dead_letter_path = os.path.join(get_appdata_dir(), "send_dead_letter.jsonl")
+        threading.Thread(target=self._dispatch_loop, name="send_scheduler_{}".format(account), daemon=True).start()
+
+    def submit(self, receiver, fn, priority=PRIORITY_REPLY, desc="") -> Future:
+        """
+        提交一次发送，fn()在发送线程中执行，抛出异常时重试，返回的Future在发送成功或放弃后完成
+        """
+        with self._cond:
+            self._seq += 1
+            task = _SendTask(receiver, fn, priority, self._seq, desc)
+            state = self._receivers.get(receiver)
+            if state is None:
+                state = _ReceiverState()
+                self._receivers[receiver] = state
+            state.tasks.append(task)
+            self.stats["submitted"] += 1
+            self._cond.notify()
+        return task.future
+
+    def metrics(self) -> dict:
+        with self._cond:
+            metrics = dict(self.stats)
+            metrics["receivers"] = len(self._receivers)
+            metrics["receiver_buckets"] = len(self.receiver_buckets)
+            metrics["pending"] = sum(len(state.tasks) for state in self._receivers.values())
+        return metrics
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                task, wait = self._next_task()
+                if task is None:
+                    self._cond.wait(wait)
+                    continue
+                self._receivers[task.receiver].inflight = True
+            self.pool.submit(self._run, task)
+
+    def _next_task(self):
+        """
+        选出下一条可以发送的消息，没有时返回(None, 最长等待秒数)，调用方需持有self._cond
+        """
+        now = time.monotonic()
+        wait = 60
+        candidates = []
+        for receiver, state in list(self._receivers.items()):
+            if state.inflight:
+                continue
+            if not state.tasks:
+                del self._receivers[receiver]  # 没有待发送消息的接收者不再保留状态
+                continue
+            head = state.tasks[0]
+            if head.not_before > now:
+                wait = min(wait, head.not_before - now)
+                continue
+            candidates.append(head)
+        # 优先级高的先发，同优先级按提交顺序
+        candidates.sort(key=lambda t: (t.priority, t.seq))
+        for task in candidates:
+            # 账号令牌不足时高优先级消息也要等待，低优先级消息不能插队
+            account_wait = self.account_bucket.try_acquire()
+            if account_wait:
+                self.stats["throttled"] += 1
+                return None, min(wait, account_wait)
+            receiver_wait = self.receiver_buckets.try_acquire(task.receiver)
+            if receiver_wait:
+                self.account_bucket.release()
+                wait = min(wait, receiver_wait)
+                continue
+            self._receivers[task.receiver].tasks.popleft()
+            return task, 0
+        return None, wait
+
+    def _run(self, task):
+        task.attempts += 1
+        error = None
+        try:
+            task.fn()
+        except NotImplementedError as e:
+            error = e
+            task.attempts = self.max_retries + 1  # 不支持的消息类型不重试
+        except Exception as e:
+            error = e
+        with self._cond:
+            state = self._receivers[task.receiver]
+            state.inflight = False
+            if error is None:
+                self.stats["sent"] += 1
+            elif task.attempts <= self.max_retries:
+                # 放回队首保持顺序，到时间后由调度线程重新发送
+                backoff = 3 * 2 ** (task.attempts - 1)
+                task.not_before = time.monotonic() + backoff * random.uniform(0.5, 1.5)
+                state.tasks.appendleft(task)
+                self.stats["retries"] += 1
+            else:
+                self.stats["dead"] += 1
+            self._cond.notify()
+        if error is None:
+            task.future.set_result(True)
+        elif task.not_before > time.monotonic():
+            logger.warning("[SendScheduler] send {} to {} failed, retry {} in {:.1f}s: {}".format(
+                task.desc or "message", task.receiver, task.attempts, task.not_before - time.monotonic(), error))
+        else:
+            self._dead_letter(task, error)
+            task.future.set_exception(error)
+
+    def _dead_letter(self, task, error):
+        logger.error("[SendScheduler] give up sending {} to {} after {} attempts: {}".format(task.desc or "message", task.receiver, task.attempts, error))
+        record = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "account": self.account,
+            "receiver": task.receiver,
+            "priority": task.priority,
+            "desc": task.desc,
+            "attempts": task.attempts,
+            "error": repr(error),
+        }
+        try:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning("[SendScheduler] write dead letter failed: {}".format(e))
+
+
+_schedulers = {}
+_lock = threading.Lock()
+
+
+def get_send_scheduler(account) -> SendScheduler:
+    """
+    获取账号对应的发送调度器，同一账号的对话回复和插件群发共用速率限制
+    """
+    with _lock:
+        scheduler = _schedulers.get(account)
+        if scheduler is None:
+            scheduler = SendScheduler(
+                account,
+                conf().get("send_rate_per_minute", 60),
+                conf().get("send_rate_per_receiver_per_minute", 20),
+                conf().get("send_max_retries", 2),
+                conf().get("send_scheduler_workers", 4),
+            )
+            _schedulers[account] = scheduler
+    return scheduler
@@ -0,0 +1,632 @@
+"""
+会话持久化存储，会话以json字符串的形式按namespace + session_id保存，支持以下后端:
+    memory: 进程内存，仅用于测试或与其他后端对比
+    sqlite: 本地sqlite文件，使用WAL模式，单进程重启后可恢复会话
+    redis: 任意兼容redis协议的服务，可在多个实例间共享会话
+通过WriteBehindSessionStore包装后写入先进入待写队列，由后台线程批量落盘
+"""
+import atexit
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, unquote
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf, get_appdata_dir
+
+_DELETED = object()
+
+
+class SessionStore(object):
+    """
+    会话存储接口，data为可json序列化的dict，ttl为过期时间(秒)，0或None表示不过期
+    """
+
+    def __init__(self, namespace, ttl=None):
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def get(self, session_id):
+        raise NotImplementedError
+
+    def put(self, session_id, data: dict):
+        self.write_batch([(session_id, data)])
+
+    def delete(self, session_id):
+        self.write_batch([(session_id, None)])
+
+    def put_if_absent(self, session_id, data: dict) -> bool:
+        """
+        会话不存在(或已过期)时写入并返回True，已存在时不写入并返回False，检查和写入是原子的，
+        多个实例共享同一后端时只有一个能写入成功，过期时间使用存储的ttl
+        """
+        raise NotImplementedError
+
+    def write_batch(self, items: list):
+        """
+        批量写入，items为(session_id, data)列表，data为None表示删除
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, namespace, ttl=None):
+        super().__init__(namespace, ttl)
+        self._data = ExpiredDict(ttl) if ttl else dict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            value = self._data.get(session_id)
+        return json.loads(value) if value else None
+
+    def write_batch(self, items: list):
+        with self._lock:
+            for session_id, data in items:
+                if data is None:
+                    self._data.pop(session_id, None)
+                else:
+                    self._data[session_id] = json.dumps(data, ensure_ascii=False)
+
+    def put_if_absent(self, session_id, data: dict) -> bool:
+        with self._lock:
+            if self._data.get(session_id) is not None:
+                return False
+            self._data[session_id] = json.dumps(data, ensure_ascii=False)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, namespace, path, ttl=None):
+        super().__init__(namespace, ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "namespace TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (namespace, session_id))"
+        )
+        self._purge_expired()
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, updated_at FROM sessions WHERE namespace=? AND session_id=?",
+                (self.namespace, session_id),
+            ).fetchone()
+        if not row or self._expired(row[1]):
+            return None
+        return json.loads(row[0])
+
+    def write_batch(self, items: list):
+        now = time.time()
+        upserts = [(self.namespace, session_id, json.dumps(data, ensure_ascii=False), now) for session_id, data in items if data is not None]
+        deletes = [(self.namespace, session_id) for session_id, data in items if data is None]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self._conn.executemany("INSERT OR REPLACE INTO sessions (namespace, session_id, data, updated_at) VALUES (?, ?, ?, ?)", upserts)
+                if deletes:
+                    self._conn.executemany("DELETE FROM sessions WHERE namespace=? AND session_id=?", deletes)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def put_if_absent(self, session_id, data: dict) -> bool:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.ttl:
+                    # 已过期但还未清理的记录视为不存在
+                    self._conn.execute(
+                        "DELETE FROM sessions WHERE namespace=? AND session_id=? AND updated_at<?",
+                        (self.namespace, session_id, now - self.ttl),
+                    )
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO sessions (namespace, session_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, session_id, json.dumps(data, ensure_ascii=False), now),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE namespace=?", (self.namespace,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _expired(self, updated_at):
+        return self.ttl and updated_at + self.ttl < time.time()
+
+    def _purge_expired(self):
+        if self.ttl:
+            with self._lock:
+                self._conn.execute("DELETE FROM sessions WHERE namespace=? AND updated_at<?", (self.namespace, time.time() - self.ttl))
+
+
+class RedisSessionStore(SessionStore):
+    """
+    直接使用RESP协议通信，不依赖redis客户端库，兼容redis及实现了GET/SET(含NX、EX)/DEL/SCAN命令的服务
+    """
+
+    def __init__(self, namespace, url="redis://127.0.0.1:6379/0", ttl=None, key_prefix="cow:session", timeout=5):
+        super().__init__(namespace, ttl)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.key_prefix = "{}:{}:".format(key_prefix, namespace)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+
+    def get(self, session_id):
+        value = self._execute([("GET", self._key(session_id))])[0]
+        return json.loads(value) if value else None
+
+    def write_batch(self, items: list):
+        commands = []
+        for session_id, data in items:
+            if data is None:
+                commands.append(("DEL", self._key(session_id)))
+            elif self.ttl:
+                commands.append(("SET", self._key(session_id), json.dumps(data, ensure_ascii=False), "EX", int(self.ttl)))
+            else:
+                commands.append(("SET", self._key(session_id), json.dumps(data, ensure_ascii=False)))
+        if commands:
+            self._execute(commands)
+
+    def put_if_absent(self, session_id, data: dict) -> bool:
+        command = ("SET", self._key(session_id), json.dumps(data, ensure_ascii=False), "NX")
+        if self.ttl:
+            command += ("EX", int(self.ttl))
+        return self._execute([command])[0] is not None
+
+    def clear(self):
+        cursor = "0"
+        while True:
+            cursor, keys = self._execute([("SCAN", cursor, "MATCH", self.key_prefix + "*", "COUNT", 500)])[0]
+            if keys:
+                self._execute([("DEL",) + tuple(keys)])
+            if cursor in ("0", b"0"):
+                break
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _key(self, session_id):
+        return self.key_prefix + str(session_id)
+
+    def _execute(self, commands: list) -> list:
+        """
+        以pipeline方式发送一组命令并按顺序返回结果，连接断开时重连重试一次
+        """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._pipeline(commands)
+                except (ConnectionError, socket.timeout, OSError) as e:
+                    self._disconnect()
+                    if attempt:
+                        raise
+                    logger.warning("[SessionStore] redis connection error, reconnecting: {}".format(e))
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        init_commands = []
+        if self.password:
+            init_commands.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            init_commands.append(("SELECT", self.db))
+        if init_commands:
+            try:
+                self._pipeline(init_commands)
+            except Exception:
+                # 认证或选库失败时不能保留该连接，否则后续命令会在未认证的连接上执行
+                self._disconnect()
+                raise
+
+    def _disconnect(self):
+        if self._sock:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
+
+    def _pipeline(self, commands: list) -> list:
+        self._sock.sendall(b"".join(_encode_command(command) for command in commands))
+        results = []
+        error = None
+        for _ in commands:
+            try:
+                results.append(self._read_reply())
+            except RedisError as e:
+                error = error or e
+                results.append(None)
+        if error:
+            raise error
+        return results
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise ConnectionError("unknown redis reply: {}".format(line))
+
+
+class RedisError(Exception):
+    pass
+
+
+def _encode_command(command) -> bytes:
+    parts = [b"*%d\r\n" % len(command)]
+    for arg in command:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+class WriteBehindSessionStore(SessionStore):
+    """
+    写入先合并到待写队列，同一会话只保留最新状态，后台线程每flush_interval秒或积累batch_size条后批量写入后端
+    读取时优先返回待写队列中的数据，保证读到自己的写入
+    """
+
+    def __init__(self, store: SessionStore, flush_interval=1.0, batch_size=100):
+        super().__init__(store.namespace, store.ttl)
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self.flushed = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name="session_store_{}".format(store.namespace), daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get(self, session_id):
+        with self._cond:
+            data = self._pending.get(session_id)
+        if data is _DELETED:
+            return None
+        if data is not None:
+            return data
+        return self.store.get(session_id)
+
+    def write_batch(self, items: list):
+        with self._cond:
+            for session_id, data in items:
+                self._pending[session_id] = _DELETED if data is None else data
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def put_if_absent(self, session_id, data: dict) -> bool:
+        # 直接在后端原子地检查和写入，该会话有待写数据时先落盘，避免后端看到的是旧状态
+        with self._cond:
+            pending = session_id in self._pending
+        if pending:
+            self.flush()
+        return self.store.put_if_absent(session_id, data)
+
+    def clear(self):
+        with self._flush_lock:
+            with self._cond:
+                self._pending.clear()
+            self.store.clear()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            items = [(session_id, None if data is _DELETED else data) for session_id, data in pending.items()]
+            try:
+                self.store.write_batch(items)
+                self.flushed += len(items)
+            except Exception as e:
+                self.errors += 1
+                logger.error("[SessionStore] flush {} sessions failed: {}".format(len(items), e))
+                with self._cond:
+                    # 写入失败时放回队列，保留期间产生的更新
+                    for session_id, data in pending.items():
+                        self._pending.setdefault(session_id, data)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(self.flush_interval + 5)
+        self.flush()
+        self.store.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+
+def create_session_store(namespace, ttl=None):
+    """
+    根据配置创建会话存储，未配置session_store时返回None，会话只保存在内存中
+    """
+    backend = conf().get("session_store", "")
+    if not backend:
+        return None
+    if backend == "memory":
+        store = MemorySessionStore(namespace, ttl)
+    elif backend == "sqlite":
+        path = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions.db")
+        store = SQLiteSessionStore(namespace, path, ttl)
+    elif backend == "redis":
+        store = RedisSessionStore(namespace, conf().get("session_store_redis_url", "redis://127.0.0.1:6379/0"), ttl)
+    else:
+        logger.error("[SessionStore] unknown session_store: {}, sessions will only be kept in memory".format(backend))
+        return None
+    logger.info("[SessionStore] namespace={}, backend={}".format(namespace, backend))
+    return WriteBehindSessionStore(store, conf().get("session_store_flush_interval", 1))
+
+
+if __name__ == "__main__":
+    # 在没有redis服务的环境下验证RedisSessionStore: python -m common.session_store
+    # 进程内启动一个实现了所用命令的RESP协议替身，覆盖认证选库、pipeline中的错误、断线重连和clear的分页
+    import fnmatch
+    import itertools
+    import socketserver
+
+    class RespStandIn(socketserver.ThreadingTCPServer):
+        """
+        redis协议替身，支持AUTH/SELECT/GET/SET(NX、EX)/DEL/SCAN，可注入错误和断开连接
+        """
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def __init__(self, password=None):
+            super().__init__(("127.0.0.1", 0), RespHandler)
+            self.password = password
+            self.dbs = {}  # db -> {key: (value, expire_at)}
+            self.lock = threading.Lock()
+            self.commands = []  # 收到的命令名，按顺序
+            self.error_keys = set()  # SET这些key时返回-ERR
+            self.connections = set()
+            self._cursors = {}
+            self._cursor_ids = itertools.count(1)
+
+        @property
+        def port(self):
+            return self.server_address[1]
+
+        def count(self, name):
+            with self.lock:
+                return self.commands.count(name)
+
+        def drop_connections(self):
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        def execute(self, db, command):
+            name, args = command[0].upper(), command[1:]
+            with self.lock:
+                self.commands.append(name)
+                data = self.dbs.setdefault(db, {})
+                now = time.time()
+                for key in [key for key, (_, expire_at) in data.items() if expire_at and expire_at <= now]:
+                    del data[key]
+                if name == "GET":
+                    value = data.get(args[0])
+                    return _bulk(value[0] if value else None)
+                if name == "SET":
+                    key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+                    if key in self.error_keys:
+                        return b"-ERR injected error\r\n"
+                    if "NX" in options and key in data:
+                        return _bulk(None)
+                    expire_at = now + int(options[options.index("EX") + 1]) if "EX" in options else None
+                    data[key] = (value, expire_at)
+                    return b"+OK\r\n"
+                if name == "DEL":
+                    return b":%d\r\n" % sum(data.pop(key, None) is not None for key in args)
+                if name == "SCAN":
+                    # 游标记录上一页的最后一个key，扫描期间删除已返回的key不会漏掉其余的key
+                    last = self._cursors.pop(args[0], "")
+                    options = dict(zip([arg.upper() for arg in args[1::2]], args[2::2]))
+                    page = sorted(key for key in data if key > last)[:int(options.get("COUNT", 10))]
+                    cursor = "0"
+                    if page and page[-1] != max(data):
+                        cursor = str(next(self._cursor_ids))
+                        self._cursors[cursor] = page[-1]
+                    keys = [key for key in page if fnmatch.fnmatchcase(key, options.get("MATCH", "*"))]
+                    return b"*2\r\n" + _bulk(cursor) + b"*%d\r\n" % len(keys) + b"".join(_bulk(key) for key in keys)
+            return "-ERR unknown command '{}'\r\n".format(name).encode("utf-8")
+
+    class RespHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            server = self.server
+            with server.lock:
+                server.connections.add(self.request)
+            authed, db = server.password is None, 0
+            try:
+                while True:
+                    command = self._read_command()
+                    if command is None:
+                        return
+                    name = command[0].upper()
+                    if name == "AUTH":
+                        with server.lock:
+                            server.commands.append(name)
+                        authed = command[-1] == server.password
+                        reply = b"+OK\r\n" if authed else b"-WRONGPASS invalid password\r\n"
+                    elif not authed:
+                        reply = b"-NOAUTH Authentication required.\r\n"
+                    elif name == "SELECT":
+                        with server.lock:
+                            server.commands.append(name)
+                        db, reply = int(command[1]), b"+OK\r\n"
+                    else:
+                        reply = server.execute(db, command)
+                    self.wfile.write(reply)
+                    self.wfile.flush()
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                with server.lock:
+                    server.connections.discard(self.request)
+
+        def _read_command(self):
+            line = self.rfile.readline()
+            if not line:
+                return None
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+            return args
+
+    def _bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        value = value.encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def check(name, fn):
+        fn()
+        print("ok  {}".format(name))
+
+    server = RespStandIn(password="secret")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "redis://:secret@127.0.0.1:{}/3".format(server.port)
+    store = RedisSessionStore("check", url, ttl=60, timeout=2)
+
+    def auth_and_select():
+        store.put("alice", {"n": 1})
+        assert server.commands[:2] == ["AUTH", "SELECT"], server.commands
+        assert server.dbs[3]["cow:session:check:alice"][1] is not None
+        assert store.get("alice") == {"n": 1}
+        wrong = RedisSessionStore("check", "redis://:wrong@127.0.0.1:{}/3".format(server.port), timeout=2)
+        for _ in range(2):  # 认证失败的连接不会被复用
+            try:
+                wrong.get("alice")
+                raise AssertionError("wrong password accepted")
+            except RedisError as e:
+                assert "WRONGPASS" in str(e)
+        wrong.close()
+
+    def error_in_pipeline():
+        server.error_keys.add("cow:session:check:bad")
+        try:
+            store.write_batch([("before", {"n": 1}), ("bad", {"n": 2}), ("after", {"n": 3})])
+            raise AssertionError("-ERR not raised")
+        except RedisError as e:
+            assert "injected" in str(e)
+        # 出错后仍读完了所有回复，连接上的后续回复没有错位
+        assert store.get("before") == {"n": 1} and store.get("after") == {"n": 3} and store.get("bad") is None
+
+    def reconnect():
+        auths = server.count("AUTH")
+        server.drop_connections()
+        assert store.get("alice") == {"n": 1}
+        assert server.count("AUTH") == auths + 1 and server.count("SELECT") >= 2
+
+    def put_if_absent():
+        assert store.put_if_absent("dedup", {"ts": 1}) is True
+        assert store.put_if_absent("dedup", {"ts": 2}) is False
+        assert store.get("dedup") == {"ts": 1}
+
+    def clear_pages():
+        other = RedisSessionStore("other", url, timeout=2)
+        other.write_batch([(i, {"i": i}) for i in range(10)])
+        store.write_batch([(i, {"i": i}) for i in range(1200)])
+        scans = server.count("SCAN")
+        store.clear()
+        assert server.count("SCAN") - scans >= 3, "clear should page through SCAN"
+        assert not [key for key in server.dbs[3] if key.startswith(store.key_prefix)]
+        assert len([key for key in server.dbs[3] if key.startswith(other.key_prefix)]) == 10
+        other.close()
+
+    def server_down():
+        server.shutdown()
+        server.server_close()
+        server.drop_connections()
+        try:
+            store.get("alice")
+            raise AssertionError("unreachable server not reported")
+        except OSError:
+            pass
+
+    check("AUTH/SELECT on connect", auth_and_select)
+    check("-ERR inside a pipeline", error_in_pipeline)
+    check("reconnect and retry", reconnect)
+    check("SET NX EX", put_if_absent)
+    check("clear pages through SCAN", clear_pages)
+    check("give up when reconnect fails", server_down)
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from common.log import logger
+
+
+class ElasticThreadPool(object):
+    """
+    按排队深度自动伸缩的线程池，submit接口与ThreadPoolExecutor兼容
+    线程按需创建，排队任务多于空闲线程时扩容到max_workers，线程空闲超过idle_timeout秒后收缩到min_workers
+    """
+
+    def __init__(self, name, min_workers=1, max_workers=8, idle_timeout=60, initializer=None):
+        self.name = name
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers, 1)
+        self.idle_timeout = idle_timeout
+        self._initializer = initializer
+        self._shutdown = False
+        self._queue = deque()  # (future, fn, args, kwargs, 入队时间)
+        self._cond = threading.Condition()
+        self._workers = 0  # 存活线程数
+        self._idle_workers = 0  # 等待任务的线程数
+        self._active_workers = 0  # 正在执行任务的线程数
+        # 统计数据
+        self._submitted = 0
+        self._completed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._recent_wait = 0.0  # 排队等待时间的指数移动平均
+        self._last_saturated_log = 0
+
+    def resize(self, min_workers=None, max_workers=None, idle_timeout=None):
+        with self._cond:
+            if min_workers is not None:
+                self.min_workers = min_workers
+            if max_workers is not None:
+                self.max_workers = max(max_workers, self.min_workers, 1)
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            self._cond.notify_all()  # 唤醒空闲线程，按新的配置决定是否退出
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._queue.append((future, fn, args, kwargs, time.monotonic()))
+            self._submitted += 1
+            if len(self._queue) > self._idle_workers:
+                if self._workers < self.max_workers:
+                    self._spawn_worker()
+                elif time.monotonic() - self._last_saturated_log > 60:
+                    self._last_saturated_log = time.monotonic()
+                    logger.warning("[{}] pool saturated, workers={}, queue_depth={}".format(self.name, self._workers, len(self._queue)))
+            self._cond.notify()
+        return future
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            if wait:
+                while self._workers > 0:
+                    self._cond.wait(1)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "name": self.name,
+                "queue_depth": len(self._queue),
+                "workers": self._workers,
+                "active_workers": self._active_workers,
+                "min_workers": self.min_workers,
+                "max_workers": self.max_workers,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "avg_wait_ms": round(self._total_wait / self._completed * 1000, 2) if self._completed else 0,
+                "recent_wait_ms": round(self._recent_wait * 1000, 2),
+                "max_wait_ms": round(self._max_wait * 1000, 2),
+            }
+
+    # 调用方需持有self._cond
+    def _spawn_worker(self):
+        self._workers += 1
+        t = threading.Thread(target=self._worker, name="{}_{}".format(self.name, self._submitted), daemon=True)
+        t.start()
+
+    def _worker(self):
+        if self._initializer:
+            try:
+                self._initializer()
+            except Exception as e:
+                logger.exception("[{}] worker initializer error: {}".format(self.name, e))
+        while True:
+            with self._cond:
+                while not self._queue:
+                    if self._shutdown or self._workers > self.max_workers:
+                        self._workers -= 1
+                        self._cond.notify_all()
+                        return
+                    self._idle_workers += 1
+                    notified = self._cond.wait(self.idle_timeout)
+                    self._idle_workers -= 1
+                    if not notified and not self._queue and self._workers > self.min_workers:
+                        self._workers -= 1
+                        return
+                future, fn, args, kwargs, enqueue_time = self._queue.popleft()
+                wait_time = time.monotonic() - enqueue_time
+                self._recent_wait = self._recent_wait * 0.8 + wait_time * 0.2
+                self._max_wait = max(self._max_wait, wait_time)
+                self._active_workers += 1
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._cond:
+                self._active_workers -= 1
+                self._completed += 1
+                self._total_wait += wait_time
@@ -1,42 +1,250 @@
+import asyncio
 import threading
 import time
+from collections import OrderedDict
+
+
+def _wait_for_tokens(try_acquire, timeout):
+    """
+    按try_acquire返回的等待时间休眠直到拿到令牌，超时返回False
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        wait = try_acquire()
+        if wait == 0:
+            return True
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                return False  # 等到超时也拿不到令牌，不再等待
+        time.sleep(wait)
+
+
+async def _await_tokens(try_acquire, timeout):
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        wait = try_acquire()
+        if wait == 0:
+            return True
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                return False
+        await asyncio.sleep(wait)
 
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
+    """
+    令牌桶，不使用后台线程定时生成令牌，每次获取时按距上次计算经过的时间补充令牌
+    """
+
+    def __init__(self, tpm, timeout=None, initial_tokens=0):
         self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
+        self.tokens = min(float(initial_tokens), self.capacity)  # 初始令牌数，默认为0
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
-        return True
+        self.lock = threading.Lock()
+        self._last = time.monotonic()  # 上次补充令牌的时间
+
+    def _refill(self, now):
+        # 调用方需持有self.lock
+        if now > self._last:
+            self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+
+    def try_acquire(self, n=1) -> float:
+        """
+        尝试获取n个令牌，成功返回0，否则返回还需等待的秒数
+        """
+        if n > self.capacity:
+            raise ValueError("cannot acquire {} tokens from a bucket of capacity {}".format(n, self.capacity))
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            return (n - self.tokens) / self.rate
+
+    def release(self, n=1):
+        """
+        归还已获取但未使用的令牌
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + n)
+
+    def available(self) -> float:
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def get_token(self, n=1):
+        """获取令牌，n为本次请求消耗的令牌数"""
+        return _wait_for_tokens(lambda: self.try_acquire(n), self.timeout)
+
+    async def aget_token(self, n=1):
+        """在事件循环中等待令牌，不占用线程"""
+        return await _await_tokens(lambda: self.try_acquire(n), self.timeout)
 
     def close(self):
-        self.is_running = False
+        pass  # 没有后台线程需要停止，保留接口兼容旧的调用方
+
+
+class KeyedTokenBucket:
+    """
+    按key(用户、群等)分别限速的令牌桶，所有key共用一把锁，每个key只保存(令牌数, 上次补充时间)
+    超过max_keys时淘汰最久未使用的key，被淘汰的key下次使用时按满桶重新开始，只会让限速变宽松
+    """
+
+    def __init__(self, tpm, timeout=None, max_keys=10000):
+        self.capacity = int(tpm)
+        self.rate = int(tpm) / 60
+        self.timeout = timeout
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [令牌数, 上次补充时间]
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key, n=1) -> float:
+        if n > self.capacity:
+            raise ValueError("cannot acquire {} tokens from a bucket of capacity {}".format(n, self.capacity))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(key, now)
+            if bucket[0] >= n:
+                bucket[0] -= n
+                return 0
+            return (n - bucket[0]) / self.rate
+
+    def release(self, key, n=1):
+        with self._lock:
+            bucket = self._bucket(key, time.monotonic())
+            bucket[0] = min(self.capacity, bucket[0] + n)
+
+    def charge(self, key, n):
+        """
+        扣除实际消耗的令牌，允许扣成负数，欠下的令牌补足之前该key获取令牌都会失败
+        """
+        with self._lock:
+            bucket = self._bucket(key, time.monotonic())
+            bucket[0] -= n
+
+    def available(self, key) -> float:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return self.capacity
+            return min(self.capacity, bucket[0] + (time.monotonic() - bucket[1]) * self.rate)
+
+    def get_token(self, key, n=1):
+        return _wait_for_tokens(lambda: self.try_acquire(key, n), self.timeout)
+
+    async def aget_token(self, key, n=1):
+        return await _await_tokens(lambda: self.try_acquire(key, n), self.timeout)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _bucket(self, key, now):
+        # 调用方需持有self._lock
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.capacity, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            if now > bucket[1]:
+                bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
 
 
 if __name__ == "__main__":
+    # 与旧的线程实现对比: python -m common.token_bucket
+    import os
+
+    class LegacyTokenBucket:
+        def __init__(self, tpm, timeout=None):
+            self.capacity = int(tpm)
+            self.tokens = 0
+            self.rate = int(tpm) / 60
+            self.timeout = timeout
+            self.cond = threading.Condition()
+            self.is_running = True
+            threading.Thread(target=self._generate_tokens, daemon=True).start()
+
+        def _generate_tokens(self):
+            while self.is_running:
+                with self.cond:
+                    if self.tokens < self.capacity:
+                        self.tokens += 1
+                    self.cond.notify()
+                time.sleep(1 / self.rate)
+
+        def get_token(self):
+            with self.cond:
+                while self.tokens <= 0:
+                    if not self.cond.wait(self.timeout):
+                        return False
+                self.tokens -= 1
+            return True
+
+        def close(self):
+            self.is_running = False
+
+    def idle_cpu(cls, count, seconds=2):
+        threads_before = threading.active_count()
+        buckets = [cls(600) for _ in range(count)]
+        start = time.process_time()
+        time.sleep(seconds)
+        cpu = time.process_time() - start
+        threads = threading.active_count() - threads_before
+        for bucket in buckets:
+            bucket.close()
+        time.sleep(0.5)  # 等待旧实现的线程退出，避免影响下一轮统计
+        return cpu, threads
+
+    def acquire_latency(cls, count):
+        # 600tpm即每秒10个令牌，连续获取count个令牌的总耗时，理论值为count/10秒
+        bucket = cls(600)
+        start = time.monotonic()
+        for _ in range(count):
+            bucket.get_token()
+        bucket.close()
+        return time.monotonic() - start
+
+    print("pid={}".format(os.getpid()))
+    for cls in (LegacyTokenBucket, TokenBucket):
+        cpu, threads = idle_cpu(cls, 200)
+        print("{:<18} 200 idle buckets @600tpm: cpu {:.3f}s in 2s, extra threads {}".format(cls.__name__, cpu, threads))
+    for cls in (LegacyTokenBucket, TokenBucket):
+        print("{:<18} acquire 20 tokens @600tpm: {:.2f}s".format(cls.__name__, acquire_latency(cls, 20)))
+
+    bucket = TokenBucket(6000000, initial_tokens=6000000)
+    start = time.perf_counter()
+    for _ in range(200000):
+        bucket.try_acquire()
+    print("TokenBucket.try_acquire: {:.0f} ops/s".format(200000 / (time.perf_counter() - start)))
+
+    keyed = KeyedTokenBucket(20, max_keys=10000)
+    start = time.perf_counter()
+    for i in range(200000):
+        keyed.try_acquire("user_%d" % (i % 50000))
+    print("KeyedTokenBucket.try_acquire over 50000 keys: {:.0f} ops/s, keys kept {}".format(200000 / (time.perf_counter() - start), len(keyed)))
+
+    async def async_acquire():
+        bucket = TokenBucket(600)
+        start = time.monotonic()
+        await asyncio.gather(*(bucket.aget_token() for _ in range(10)))
+        return time.monotonic() - start
+
+    print("TokenBucket.aget_token 10 concurrent @600tpm: {:.2f}s, no thread blocked".format(asyncio.run(async_acquire())))
+    multi = TokenBucket(600, initial_tokens=0)
+    start = time.monotonic()
+    multi.get_token(5)
+    print("TokenBucket.get_token(5) @600tpm from empty: {:.2f}s".format(time.monotonic() - start))
+
     token_bucket = TokenBucket(20, None)  # 创建一个每分钟生产20个tokens的令牌桶
     # token_bucket = TokenBucket(20, 0.1)
     for i in range(3):
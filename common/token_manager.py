@@ -0,0 +1,218 @@
+"""
+各渠道共用的access_token管理，按凭证(渠道类型 + app_id + secret摘要)缓存token
+    同一个凭证同时只有一个线程请求新token，其余线程等待并复用结果
+    后台线程在token过期前refresh_ahead秒主动刷新，发送消息时不需要等待获取token
+    开启access_token_persist时token写入appdata目录，重启后在有效期内继续使用，节省获取token的调用次数
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from common.log import logger
+from common.singleton import singleton
+from config import conf, get_appdata_dir
+
+
+def make_token_key(kind, app_id, secret) -> str:
+    # secret只保留摘要，区分同一个app_id下的不同secret，同时避免写入持久化文件
+    digest = hashlib.sha1((secret or "").encode("utf-8")).hexdigest()[:8]
+    return "{}:{}:{}".format(kind, app_id, digest)
+
+
+class _TokenEntry(object):
+    def __init__(self, key, fetcher, refresh_ahead):
+        self.key = key
+        self.fetcher = fetcher  # fetcher() -> (token, expires_in)
+        self.refresh_ahead = refresh_ahead
+        self.token = None
+        self.expires_at = 0  # time.time()时间戳，需要与持久化的数据通用
+        self.retry_at = 0  # 后台刷新失败后推迟到该时间再重试
+        self.lock = threading.Lock()
+
+    def valid(self, now, margin=0):
+        return self.token is not None and self.expires_at - now > margin
+
+    def refresh_due_at(self):
+        return max(self.expires_at - self.refresh_ahead, self.retry_at)
+
+
+@singleton
+class AccessTokenManager(object):
+    def __init__(self):
+        self.refresh_ahead = conf().get("access_token_refresh_ahead", 300)
+        self.persist_path = os.path.join(get_appdata_dir(), "access_tokens.json") if conf().get("access_token_persist", False) else None
+        self._entries = {}
+        self._persisted = self._load_persisted()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._refresher = None
+        self.stats = {"hits": 0, "fetches": 0, "waits": 0, "background_refreshes": 0, "errors": 0}
+
+    def register(self, key, fetcher, refresh_ahead=None):
+        """
+        注册凭证对应的token获取方法，同一个key重复注册时替换fetcher并保留已缓存的token
+        """
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _TokenEntry(key, fetcher, self.refresh_ahead if refresh_ahead is None else refresh_ahead)
+                persisted = self._persisted.pop(key, None)
+                if persisted and persisted.get("expires_at", 0) > time.time():
+                    entry.token, entry.expires_at = persisted["token"], persisted["expires_at"]
+                    logger.info("[TokenManager] restored access token for {}".format(key))
+                self._entries[key] = entry
+            else:
+                entry.fetcher = fetcher
+            self._ensure_refresher()
+            self._cond.notify()
+        return key
+
+    def get_token(self, key, stale_token=None) -> str:
+        """
+        获取有效的token，stale_token为调用方确认已失效的token，缓存的token与之相同时强制刷新
+        获取失败时抛出异常
+        """
+        entry = self._entries[key]
+        token = entry.token
+        if token is not None and token != stale_token and entry.valid(time.time()):
+            self._count("hits")
+            return token
+        if not entry.lock.acquire(blocking=False):
+            self._count("waits")
+            entry.lock.acquire()
+        try:
+            # 等待期间其他线程可能已经获取到新token
+            if entry.token is not None and entry.token != stale_token and entry.valid(time.time()):
+                return entry.token
+            return self._refresh(entry)
+        finally:
+            entry.lock.release()
+
+    def invalidate(self, key, token=None):
+        """
+        token失效时调用，指定token时只在缓存的token与之相同时失效
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        with entry.lock:
+            if token is None or entry.token == token:
+                entry.token = None
+                entry.expires_at = 0
+
+    def metrics(self) -> dict:
+        now = time.time()
+        with self._lock:
+            metrics = dict(self.stats)
+        metrics["tokens"] = {key: int(entry.expires_at - now) if entry.token else None for key, entry in list(self._entries.items())}
+        return metrics
+
+    def _refresh(self, entry):
+        # 调用方需持有entry.lock
+        self._count("fetches")
+        try:
+            token, expires_in = entry.fetcher()
+        except Exception:
+            self._count("errors")
+            raise
+        if not token:
+            self._count("errors")
+            raise ValueError("empty access token for {}".format(entry.key))
+        entry.token = token
+        entry.expires_at = time.time() + int(expires_in or 7200)
+        entry.retry_at = 0
+        logger.debug("[TokenManager] access token refreshed for {}, expires_in={}".format(entry.key, expires_in))
+        self._save_persisted()
+        with self._cond:
+            self._cond.notify()
+        return token
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _ensure_refresher(self):
+        # 调用方需持有self._lock
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="token_refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                tracked = [entry for entry in self._entries.values() if entry.token is not None]
+                due = [entry for entry in tracked if entry.refresh_due_at() <= now]
+                if not due:
+                    next_due = min((entry.refresh_due_at() for entry in tracked), default=now + 60)
+                    self._cond.wait(min(max(next_due - now, 1), 60))
+                    continue
+            for entry in due:
+                if not entry.lock.acquire(blocking=False):
+                    continue  # 已有线程在获取
+                try:
+                    if entry.token is not None and entry.refresh_due_at() <= time.time():
+                        self._refresh(entry)
+                        self._count("background_refreshes")
+                except Exception as e:
+                    logger.warning("[TokenManager] background refresh failed for {}: {}".format(entry.key, e))
+                    # 刷新失败时30秒后重试，旧token在过期前仍然可用
+                    entry.retry_at = time.time() + 30
+                finally:
+                    entry.lock.release()
+
+    def _load_persisted(self) -> dict:
+        if not self.persist_path:
+            return {}
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("[TokenManager] load persisted tokens failed: {}".format(e))
+            return {}
+
+    def _save_persisted(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            data = {key: {"token": entry.token, "expires_at": entry.expires_at} for key, entry in self._entries.items() if entry.token}
+            tmp_path = self.persist_path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.persist_path)
+            except Exception as e:
+                logger.warning("[TokenManager] save tokens failed: {}".format(e))
+
+
+class ManagedTokenClientMixin(object):
+    """
+    wechatpy客户端使用AccessTokenManager管理token，需放在WeChatClient之前继承，并在初始化后调用_register_token
+    """
+
+    def _register_token(self, kind, app_id, secret):
+        self.token_key = AccessTokenManager().register(make_token_key(kind, app_id, secret), self._fetch_token_from_server)
+
+    def _fetch_token_from_server(self):
+        result = super().fetch_access_token()
+        return result["access_token"], result["expires_in"]
+
+    @property
+    def access_token(self):
+        token = AccessTokenManager().get_token(self.token_key)
+        self._sync_session(token)
+        return token
+
+    def fetch_access_token(self):  # 重载父类方法，wechatpy在token失效时调用，只有当前token仍是失效的那个时才重新获取
+        token = AccessTokenManager().get_token(self.token_key, stale_token=self.session.get(self.access_token_key))
+        self._sync_session(token)
+        return token
+
+    def _sync_session(self, token):
+        # wechatpy在token失效重试时从session读取新token
+        if self.session.get(self.access_token_key) != token:
+            self.session.set(self.access_token_key, token)
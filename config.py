@@ -56,12 +56,48 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "handler_pool_min_workers": 2,  # 处理消息的线程池最少线程数
+    "handler_pool_max_workers": 32,  # 处理消息的线程池最多线程数，排队消息增多时自动扩容
+    "fast_handler_pool_max_workers": 8,  # 处理管理命令等插件消息的快速通道线程池最多线程数
+    "handler_pool_idle_seconds": 60,  # 线程空闲超过该时间后自动回收
+    "fair_scheduling": True,  # 是否按群/私聊用户公平分发待处理消息，避免热门群占满处理线程
+    "fair_dispatch_slots": 0,  # 同时处理的模型调用类消息上限，0表示与handler_pool_max_workers相同
+    "fair_group_weight": 1,  # 公平分发时每个群每轮可分发的消息数
+    "fair_private_weight": 1,  # 公平分发时每个私聊会话每轮可分发的消息数
+    "fair_max_pending_per_flow": 50,  # 单个群或私聊排队的消息超过该数量时丢弃新消息，0表示不限制
+    "quota_user_requests_per_minute": 0,  # 每个用户每分钟最多发起的模型请求数，0表示不限制
+    "quota_group_requests_per_minute": 0,  # 每个群每分钟最多发起的模型请求数，0表示不限制
+    "quota_user_tokens_per_minute": 0,  # 每个用户每分钟可消耗的token数(按问题和回复长度估算)，0表示不限制
+    "quota_group_tokens_per_minute": 0,  # 每个群每分钟可消耗的token数(按问题和回复长度估算)，0表示不限制
+    "quota_max_tracked": 10000,  # 最多记录多少个用户/群的额度，超过时淘汰最久未使用的
+    "quota_exceeded_reply": "请求太频繁了，请稍后再试",  # 私聊超出额度时的提示，每分钟最多提示一次，为空时不提示
+    "send_pipeline_workers": 4,  # wechatcom_app、wechatmp按接收者顺序发送消息的线程池最多线程数
+    "media_upload_workers": 4,  # wechatcom_app、wechatmp并发上传图片、语音等媒体的线程数
+    "send_scheduler_enabled": True,  # 个人微信类渠道(wx、gewechat)是否通过发送调度器限速发送
+    "send_rate_per_minute": 60,  # 每个账号每分钟最多发送的消息数，允许短时间内突发到该数量
+    "send_rate_per_receiver_per_minute": 20,  # 每个接收者(好友或群)每分钟最多发送的消息数
+    "send_receiver_bucket_size": 10000,  # 最多保留多少个接收者的限速状态，超过时淘汰最久未发送的接收者
+    "send_max_retries": 2,  # 发送失败的重试次数；发送调度器重试耗尽后写入appdata目录下的send_dead_letter.jsonl，wechatcom_app、wechatmp的发送队列同样按此重试
+    "send_scheduler_workers": 4,  # 每个账号执行发送的线程数
+    "send_msg_contact_ttl": 86400,  # send_msg插件gewechat联系人索引的有效期(秒)，过期后后台刷新；群成员使用gewechat_member_cache_ttl
+    "send_msg_fetch_workers": 4,  # send_msg插件并发获取联系人简要信息的线程数
+    "send_msg_broadcast_workers": 8,  # send_msg插件群发时并发查找接收者和提交发送的线程数
+    "async_pipeline": False,  # 是否开启异步处理流水线，开启后消息在单个事件循环中处理，支持异步的bot(dify、chatgpt)不再占用线程
+    "async_executor_max_workers": 32,  # 异步流水线中执行同步bot、插件和发送逻辑的线程池大小
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     "group_exit_msg": "",  # 退出群聊的消息
     "accept_friend_msg": "",  # 接受好友请求后发送的消息
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "",  # 会话持久化后端，为空时只保存在内存中，可选 memory/sqlite/redis
+    "session_store_path": "",  # sqlite会话文件路径，默认为数据目录下的sessions.db
+    "session_store_redis_url": "redis://127.0.0.1:6379/0",  # redis会话存储地址，格式 redis://[:password@]host:port/db
+    "session_store_flush_interval": 1,  # 会话批量写入存储的间隔，单位秒
+    "session_cache_size": 1000,  # 开启会话持久化后内存中最多保留的活跃会话数
+    "msg_dedup_window_seconds": 27000,  # 消息去重的时间窗口，单位秒，需覆盖各渠道的最长重试时间(飞书约7小时)
+    "msg_dedup_max_size": 100000,  # 消息去重最多记录的消息数
+    "msg_dedup_persist": False,  # 是否将去重记录写入session_store配置的存储，重启后仍能去重，多实例共享同一存储(如redis)时同一消息只会被一个实例处理
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
@@ -106,6 +142,11 @@ available_setting = {
     "dify_api_key": "app-xxx",
     "dify_app_type": "chatbot", # dify助手类型 chatbot(对应聊天助手)/agent(对应Agent)/workflow(对应工作流)，默认为chatbot
     "dify_conversation_max_messages": 5, # dify目前不支持设置历史消息长度，暂时使用超过最大消息数清空会话的策略，缺点是没有滑动窗口，会突然丢失历史消息，当设置的值小于等于0，则不限制历史消息长度
+    "dify_pool_size": 10,  # 每个dify应用(api_base+api_key)复用的keep-alive连接数
+    "dify_request_timeout": 180,  # dify请求读取超时时间，单位秒
+    "dify_max_retries": 2,  # dify连接失败时的重试次数，幂等请求返回502/503/504时也会重试
+    "dify_response_mode": "blocking",  # chatbot类型的响应模式，blocking(等待完整回复)/streaming(边生成边发送)，agent类型始终为streaming
+    "dify_stream_segment_chars": 0,  # 流式回复累积超过该字数后在句子边界处分段发送，0表示只在工具调用、图片和结束处分段
     # coze配置
     "coze_api_base": "https://api.coze.cn",
     "coze_api_key": "xxx",
@@ -147,11 +188,17 @@ available_setting = {
     "baidu_translate_app_key": "",  # 百度翻译api的秘钥
     # itchat的配置
     "hot_reload": False,  # 是否开启热重载
+    "media_download_max_size": 0,  # 下载图片、语音、视频、文件的大小上限(MB)，超过时放弃下载，0表示不限制
+    "media_cache_size": 0,  # 已下载媒体的缓存大小(MB)，同一媒体重复下载时不再请求，内容相同的文件只保存一份，0表示不缓存
     # wechaty的配置
     "wechaty_puppet_service_token": "",  # wechaty的token
     # wechatmp的配置
     "wechatmp_token": "",  # 微信公众平台的Token
     "wechatmp_port": 8080,  # 微信公众平台的端口,需要端口转发到80或443
+    "wechatmp_server_threads": 64,  # 被动回复模式下http服务的线程数，每个等待回复的请求占用一个线程
+    "wechatmp_reply_cache_ttl": 600,  # 被动回复模式下未取回的回复保留时间，单位秒
+    "wechatmp_reply_cache_size": 10000,  # 被动回复模式下最多缓存多少个用户的回复
+    "wechatmp_running_ttl": 600,  # 被动回复模式下回复生成超过该时间仍未完成时，允许用户重新提问
     "wechatmp_app_id": "",  # 微信公众平台的appID
     "wechatmp_app_secret": "",  # 微信公众平台的appsecret
     "wechatmp_aes_key": "",  # 微信公众平台的EncodingAESKey，加密模式需要
@@ -163,6 +210,11 @@ available_setting = {
     "wechatcomapp_secret": "",  # 企业微信app的secret
     "wechatcomapp_agent_id": "",  # 企业微信app的agent_id
     "wechatcomapp_aes_key": "",  # 企业微信app的aes_key
+    # wechatcs(微信客服)的配置，其余配置与wechatcomapp共用
+    "wechatcs_sync_limit": 1000,  # 每次拉取客服消息的条数
+    "wechatcs_msg_max_age": 600,  # 只处理该时间(秒)以内发送的消息，避免首次拉取时回复历史消息，0表示不限制
+    "access_token_refresh_ahead": 300,  # 飞书、企业微信、公众号的access_token在过期前多少秒由后台线程主动刷新
+    "access_token_persist": False,  # 是否将access_token保存到appdata目录，重启后在有效期内继续使用
     # 飞书配置
     "feishu_port": 80,  # 飞书bot监听端口
     "feishu_app_id": "",  # 飞书机器人应用APP Id
@@ -179,6 +231,11 @@ available_setting = {
     "gewechat_token": "",
     "gewechat_app_id": "",
     "gewechat_callback_url": "", # 回调地址，示例：http://172.17.0.1:9919/v2/api/callback/collect
+    "gewechat_contact_cache_ttl": 3600,  # 联系人和群名称缓存时间，单位秒
+    "gewechat_member_cache_ttl": 600,  # 群成员列表缓存时间，单位秒
+    "gewechat_contact_cache_size": 10000,  # 最多缓存的联系人数
+    "gewechat_ingest_queue_size": 1000,  # 回调消息队列总容量，平均分给各ingest线程，队列满时回调返回503由gewechat重试
+    "gewechat_ingest_workers": 4,  # 解析回调消息的线程数，同一会话的消息固定由一个线程按顺序处理
     
     # chatgpt指令自定义触发词
     "clear_memory_commands": ["#清除记忆"],  # 重置会话指令，必须以#开头
@@ -213,6 +270,7 @@ available_setting = {
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
+        self.version = 0  # 每次修改配置项时递增，用于判断依赖配置的缓存是否需要重建
         if d is None:
             d = {}
         for k, v in d.items():
@@ -228,6 +286,7 @@ class Config(dict):
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        self.version += 1
         return super().__setitem__(key, value)
 
     def get(self, key, default=None):
@@ -1,10 +1,37 @@
+import asyncio
+
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 
 class DifyClient:
-    def __init__(self, api_key, base_url: str = 'https://api.dify.ai/v1'):
+    def __init__(self, api_key, base_url: str = 'https://api.dify.ai/v1', pool_size=10, timeout=None, max_retries=0,
+                 backoff_factor=0.5):
+        """
+        :param pool_size: 连接池大小，同一客户端的请求复用keep-alive连接
+        :param timeout: 请求超时时间，秒或(连接超时, 读取超时)
+        :param max_retries: 连接失败时的重试次数，GET等幂等请求返回网关错误(502/503/504)时也会重试；
+                            POST请求可能已被服务端处理，只在连接建立失败时重试，已发出的请求读取超时不重试
+        :param backoff_factor: 重试退避系数，第n次重试前等待 backoff_factor * 2^(n-1) 秒
+        """
         self.api_key = api_key
         self.base_url = base_url
+        self.timeout = timeout
+        retries = Retry(total=max_retries, connect=max_retries, read=0, status=max_retries,
+                        status_forcelist=[502, 503, 504], backoff_factor=backoff_factor,
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def _send_request(self, method, endpoint, json=None, params=None, stream=False):
         headers = {
@@ -13,7 +40,8 @@ class DifyClient:
         }
 
         url = f"{self.base_url}{endpoint}"
-        response = requests.request(method, url, json=json, params=params, headers=headers, stream=stream)
+        response = self.session.request(method, url, json=json, params=params, headers=headers, stream=stream,
+                                        timeout=self.timeout)
 
         return response
 
@@ -23,10 +51,13 @@ class DifyClient:
         }
 
         url = f"{self.base_url}{endpoint}"
-        response = requests.request(method, url, data=data, headers=headers, files=files)
+        response = self.session.request(method, url, data=data, headers=headers, files=files, timeout=self.timeout)
 
         return response
 
+    def close(self):
+        self.session.close()
+
     def message_feedback(self, message_id, rating, user):
         data = {
             "rating": rating,
@@ -91,3 +122,73 @@ class ChatClient(DifyClient):
     def rename_conversation(self, conversation_id, name, user):
         data = {"name": name, "user": user}
         return self._send_request("POST", f"/conversations/{conversation_id}/name", data)
+
+
+_client_cache = {}
+_client_cache_lock = threading.Lock()
+
+
+def get_chat_client(api_key, base_url: str = 'https://api.dify.ai/v1', **kwargs) -> ChatClient:
+    """
+    按(base_url, api_key)获取共享的ChatClient，同一个dify应用的请求复用同一个连接池，线程安全
+    :param kwargs: 首次创建客户端时使用的连接池参数，参考DifyClient
+    """
+    key = (base_url, api_key)
+    client = _client_cache.get(key)
+    if client is None:
+        with _client_cache_lock:
+            client = _client_cache.get(key)
+            if client is None:
+                client = ChatClient(api_key, base_url, **kwargs)
+                _client_cache[key] = client
+    return client
+
+
+class AsyncDifyClient:
+    """
+    基于aiohttp的异步客户端，供异步流水线使用，返回的aiohttp.ClientResponse需由调用方通过async with释放
+    """
+    _sessions = {}  # 每个事件循环共用一个ClientSession
+
+    def __init__(self, api_key, base_url: str = 'https://api.dify.ai/v1', timeout=None):
+        """
+        :param timeout: 读取超时时间，单位秒，流式响应中两次数据之间的最长间隔
+        """
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for async dify client, please install it by `pip install aiohttp`")
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession()
+            self._sessions[loop] = session
+        return session
+
+    async def _send_request(self, method, endpoint, json=None, params=None):
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+        url = f"{self.base_url}{endpoint}"
+        return await self._get_session().request(method, url, json=json, params=params, headers=headers,
+                                                 timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=self.timeout))
+
+
+class AsyncChatClient(AsyncDifyClient):
+    async def create_chat_message(self, inputs, query, user, response_mode="blocking", conversation_id=None, files=[]):
+        data = {
+            "inputs": inputs,
+            "query": query,
+            "user": user,
+            "response_mode": response_mode,
+            "files": files
+        }
+        if conversation_id:
+            data["conversation_id"] = conversation_id
+
+        return await self._send_request("POST", "/chat-messages", data)
@@ -98,14 +98,13 @@ def update_friend(self, userName):
         for f in friendList]
     return r if len(r) != 1 else r[0]
 
-@contact_change
 def update_local_chatrooms(core, l):
     '''
         get a list of chatrooms for updating local chatrooms
         return a list of given chatrooms with updated info
     '''
     for chatroom in l:
-        # format new chatrooms
+        # format new chatrooms, they are not shared yet so no lock is needed
         utils.emoji_formatter(chatroom, 'NickName')
         for member in chatroom['MemberList']:
             if 'NickName' in member:
@@ -114,52 +113,10 @@ def update_local_chatrooms(core, l):
                 utils.emoji_formatter(member, 'DisplayName')
             if 'RemarkName' in member:
                 utils.emoji_formatter(member, 'RemarkName')
-        # update it to old chatrooms
-        oldChatroom = utils.search_dict_list(
-            core.chatroomList, 'UserName', chatroom['UserName'])
-        if oldChatroom:
-            update_info_dict(oldChatroom, chatroom)
-            #  - update other values
-            memberList = chatroom.get('MemberList', [])
-            oldMemberList = oldChatroom['MemberList']
-            if memberList:
-                for member in memberList:
-                    oldMember = utils.search_dict_list(
-                        oldMemberList, 'UserName', member['UserName'])
-                    if oldMember:
-                        update_info_dict(oldMember, member)
-                    else:
-                        oldMemberList.append(member)
-        else:
-            core.chatroomList.append(chatroom)
-            oldChatroom = utils.search_dict_list(
-                core.chatroomList, 'UserName', chatroom['UserName'])
-        # delete useless members
-        if len(chatroom['MemberList']) != len(oldChatroom['MemberList']) and \
-                chatroom['MemberList']:
-            existsUserNames = [member['UserName'] for member in chatroom['MemberList']]
-            delList = []
-            for i, member in enumerate(oldChatroom['MemberList']):
-                if member['UserName'] not in existsUserNames:
-                    delList.append(i)
-            delList.sort(reverse=True)
-            for i in delList:
-                del oldChatroom['MemberList'][i]
-        #  - update OwnerUin
-        if oldChatroom.get('ChatRoomOwner') and oldChatroom.get('MemberList'):
-            owner = utils.search_dict_list(oldChatroom['MemberList'],
-                'UserName', oldChatroom['ChatRoomOwner'])
-            oldChatroom['OwnerUin'] = (owner or {}).get('Uin', 0)
-        #  - update IsAdmin
-        if 'OwnerUin' in oldChatroom and oldChatroom['OwnerUin'] != 0:
-            oldChatroom['IsAdmin'] = \
-                oldChatroom['OwnerUin'] == int(core.loginInfo['wxuin'])
-        else:
-            oldChatroom['IsAdmin'] = None
-        #  - update Self
-        newSelf = utils.search_dict_list(oldChatroom['MemberList'],
-            'UserName', core.storageClass.userName)
-        oldChatroom['Self'] = newSelf or copy.deepcopy(core.loginInfo['User'])
+    # merge chatrooms one by one, so that searches from message producing
+    # only wait for a single chatroom instead of the whole batch
+    for chatroom in l:
+        merge_local_chatroom(core, chatroom)
     return {
         'Type'         : 'System',
         'Text'         : [chatroom['UserName'] for chatroom in l],
@@ -168,11 +125,57 @@ def update_local_chatrooms(core, l):
         'ToUserName'   : core.storageClass.userName, }
 
 @contact_change
+def merge_local_chatroom(core, chatroom):
+    ''' merge a formatted chatroom into storage, linear in the size of its member list '''
+    # update it to old chatrooms
+    oldChatroom = core.storageClass.user_name_index('chatroomList').get(chatroom['UserName'])
+    if oldChatroom:
+        update_info_dict(oldChatroom, chatroom)
+        #  - update other values
+        memberList = chatroom.get('MemberList', [])
+        oldMemberList = oldChatroom['MemberList']
+        if memberList:
+            oldMembers = {}
+            for member in oldMemberList:
+                oldMembers.setdefault(member['UserName'], member)
+            for member in memberList:
+                oldMember = oldMembers.get(member['UserName'])
+                if oldMember:
+                    update_info_dict(oldMember, member)
+                else:
+                    oldMemberList.append(member)
+                    oldMembers[member['UserName']] = oldMemberList[-1]
+    else:
+        oldChatroom = core.storageClass.append_contact('chatroomList', chatroom)
+    # delete useless members
+    if len(chatroom['MemberList']) != len(oldChatroom['MemberList']) and \
+            chatroom['MemberList']:
+        existsUserNames = set(member['UserName'] for member in chatroom['MemberList'])
+        keptMembers = [member for member in oldChatroom['MemberList']
+                       if member['UserName'] in existsUserNames]
+        if len(keptMembers) != len(oldChatroom['MemberList']):
+            oldChatroom['MemberList'][:] = keptMembers
+    #  - update OwnerUin
+    if oldChatroom.get('ChatRoomOwner') and oldChatroom.get('MemberList'):
+        owner = utils.search_dict_list(oldChatroom['MemberList'],
+            'UserName', oldChatroom['ChatRoomOwner'])
+        oldChatroom['OwnerUin'] = (owner or {}).get('Uin', 0)
+    #  - update IsAdmin
+    if 'OwnerUin' in oldChatroom and oldChatroom['OwnerUin'] != 0:
+        oldChatroom['IsAdmin'] = \
+            oldChatroom['OwnerUin'] == int(core.loginInfo['wxuin'])
+    else:
+        oldChatroom['IsAdmin'] = None
+    #  - update Self
+    newSelf = utils.search_dict_list(oldChatroom['MemberList'],
+        'UserName', core.storageClass.userName)
+    oldChatroom['Self'] = newSelf or copy.deepcopy(core.loginInfo['User'])
+
+
 def update_local_friends(core, l):
     '''
         get a list of friends or mps for updating local contact
     '''
-    fullList = core.memberList + core.mpList
     for friend in l:
         if 'NickName' in friend:
             utils.emoji_formatter(friend, 'NickName')
@@ -180,17 +183,24 @@ def update_local_friends(core, l):
             utils.emoji_formatter(friend, 'DisplayName')
         if 'RemarkName' in friend:
             utils.emoji_formatter(friend, 'RemarkName')
-        oldInfoDict = utils.search_dict_list(
-            fullList, 'UserName', friend['UserName'])
+    merge_local_friends(core, l)
+
+
+@contact_change
+def merge_local_friends(core, l):
+    ''' merge formatted friends or mps into storage, linear in the size of l '''
+    for friend in l:
+        userName = friend['UserName']
+        oldInfoDict = core.storageClass.user_name_index('memberList').get(userName) or \
+            core.storageClass.user_name_index('mpList').get(userName)
         if oldInfoDict is None:
             oldInfoDict = copy.deepcopy(friend)
-            if oldInfoDict['VerifyFlag'] & 8 == 0:
-                core.memberList.append(oldInfoDict)
-            else:
-                core.mpList.append(oldInfoDict)
+            listName = 'memberList' if oldInfoDict['VerifyFlag'] & 8 == 0 else 'mpList'
+            core.storageClass.append_contact(listName, oldInfoDict)
         else:
             update_info_dict(oldInfoDict, friend)
 
+
 @contact_change
 def update_local_uin(core, msg):
     '''
@@ -1,4 +1,4 @@
-import pickle, os
+import pickle
 import logging
 
 import requests  # type: ignore
@@ -6,6 +6,7 @@ import requests  # type: ignore
 from ..config import VERSION
 from ..returnvalues import ReturnValue
 from ..storage import templates
+from ..storage.snapshot import dump_snapshot, load_snapshot, is_snapshot
 from .contact import update_local_chatrooms, update_local_friends
 from .messages import produce_msg
 
@@ -17,26 +18,27 @@ def load_hotreload(core):
 
 async def dump_login_status(self, fileDir=None):
     fileDir = fileDir or self.hotReloadDir
+    status = {
+        'version'           : VERSION,
+        'loginInfo'         : self.loginInfo,
+        'cookies'           : self.s.cookies.get_dict(),
+        'userName'          : self.storageClass.userName,
+        'nickName'          : self.storageClass.nickName,
+        'lastInputUserName' : self.storageClass.lastInputUserName, }
     try:
-        with open(fileDir, 'w') as f:
-            f.write('itchat - DELETE THIS')
-        os.remove(fileDir)
-    except:
+        dump_snapshot(self.storageClass, fileDir, status)
+    except (OSError, IOError):
         raise Exception('Incorrect fileDir')
-    status = {
-        'version'   : VERSION,
-        'loginInfo' : self.loginInfo,
-        'cookies'   : self.s.cookies.get_dict(),
-        'storage'   : self.storageClass.dumps()}
-    with open(fileDir, 'wb') as f:
-        pickle.dump(status, f)
     logger.debug('Dump login status for hot reload successfully.')
 
 async def load_login_status(self, fileDir,
         loginCallback=None, exitCallback=None):
     try:
-        with open(fileDir, 'rb') as f:
-            j = pickle.load(f)
+        if is_snapshot(fileDir):
+            j = load_snapshot(self.storageClass, fileDir, VERSION)
+        else: # status dumped by pickle before snapshots, replaced on next dump
+            with open(fileDir, 'rb') as f:
+                j = pickle.load(f)
     except Exception as e:
         logger.debug('No such file, loading login status failed.')
         return ReturnValue({'BaseResponse': {
@@ -54,7 +56,8 @@ async def load_login_status(self, fileDir,
     self.loginInfo['User'] = templates.User(self.loginInfo['User'])
     self.loginInfo['User'].core = self
     self.s.cookies = requests.utils.cookiejar_from_dict(j['cookies'])
-    self.storageClass.loads(j['storage'])
+    if 'storage' in j:
+        self.storageClass.loads(j['storage'])
     try:
         msgList, contactList = self.get_msg()
     except:
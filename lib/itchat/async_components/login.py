@@ -15,6 +15,7 @@ from pyqrcode import QRCode
 
 from .. import config, utils
 from ..returnvalues import ReturnValue
+from ..receiving import ReceivingPipeline
 from ..storage.templates import wrap_user_dict
 from .contact import update_local_chatrooms, update_local_friends
 from .messages import produce_msg
@@ -303,30 +304,25 @@ async def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
     self.alive = True
     def maintain_loop():
         retryCount = 0
+        pipeline = ReceivingPipeline(lambda msgList, contactList:
+            produce_received(self, msgList, contactList), self.receivingQueueSize)
+        self.receivingPipeline = pipeline
+        pipeline.start()
         while self.alive:
             try:
+                start = time.time()
                 i = sync_check(self)
+                pipeline.record_sync_check(time.time() - start)
                 if i is None:
                     self.alive = False
                 elif i == '0':
                     pass
                 else:
+                    start = time.time()
                     msgList, contactList = self.get_msg()
-                    if msgList:
-                        msgList = produce_msg(self, msgList)
-                        for msg in msgList:
-                            self.msgList.put(msg)
-                    if contactList:
-                        chatroomList, otherList = [], []
-                        for contact in contactList:
-                            if '@@' in contact['UserName']:
-                                chatroomList.append(contact)
-                            else:
-                                otherList.append(contact)
-                        chatroomMsg = update_local_chatrooms(self, chatroomList)
-                        chatroomMsg['User'] = self.loginInfo['User']
-                        self.msgList.put(chatroomMsg)
-                        update_local_friends(self, otherList)
+                    pipeline.record_fetch(time.time() - start)
+                    if msgList or contactList:
+                        pipeline.put(msgList, contactList)
                 retryCount = 0
             except requests.exceptions.ReadTimeout:
                 pass
@@ -337,6 +333,7 @@ async def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
                     self.alive = False
                 else:
                     time.sleep(1)
+        pipeline.stop(30) # messages already fetched are still delivered
         self.logout()
         if hasattr(exitCallback, '__call__'):
             exitCallback(self.storageClass.userName)
@@ -349,6 +346,25 @@ async def start_receiving(self, exitCallback=None, getReceivingFnOnly=False):
         maintainThread.setDaemon(True)
         maintainThread.start()
 
+def produce_received(self, msgList, contactList):
+    ''' format a batch fetched by get_msg and put the messages into msgList,
+        it runs in the producing thread of ReceivingPipeline '''
+    if msgList:
+        msgList = produce_msg(self, msgList)
+        for msg in msgList:
+            self.msgList.put(msg)
+    if contactList:
+        chatroomList, otherList = [], []
+        for contact in contactList:
+            if '@@' in contact['UserName']:
+                chatroomList.append(contact)
+            else:
+                otherList.append(contact)
+        chatroomMsg = update_local_chatrooms(self, chatroomList)
+        chatroomMsg['User'] = self.loginInfo['User']
+        self.msgList.put(chatroomMsg)
+        update_local_friends(self, otherList)
+
 def sync_check(self):
     url = '%s/synccheck' % self.loginInfo.get('syncUrl', self.loginInfo['url'])
     params = {
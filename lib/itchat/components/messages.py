@@ -6,7 +6,7 @@ from collections import OrderedDict
 
 import requests
 
-from .. import config, utils
+from .. import config, utils, download
 from ..returnvalues import ReturnValue
 from ..storage import templates
 from .contact import update_local_uin
@@ -29,19 +29,7 @@ def get_download_fn(core, url, msgId):
             'msgid': msgId,
             'skey': core.loginInfo['skey'],}
         headers = { 'User-Agent' : config.USER_AGENT }
-        r = core.s.get(url, params=params, stream=True, headers = headers)
-        tempStorage = io.BytesIO()
-        for block in r.iter_content(1024):
-            tempStorage.write(block)
-        if downloadDir is None:
-            return tempStorage.getvalue()
-        with open(downloadDir, 'wb') as f:
-            f.write(tempStorage.getvalue())
-        tempStorage.seek(0)
-        return ReturnValue({'BaseResponse': {
-            'ErrMsg': 'Successfully downloaded',
-            'Ret': 0, },
-            'PostFix': utils.get_image_postfix(tempStorage.read(20)), })
+        return download.download(core, url, params, headers, downloadDir, (url, msgId))
     return download_fn
 
 def produce_msg(core, msgList):
@@ -125,17 +113,7 @@ def produce_msg(core, msgList):
                     'msgid': msgId,
                     'skey': core.loginInfo['skey'],}
                 headers = {'Range': 'bytes=0-', 'User-Agent' : config.USER_AGENT }
-                r = core.s.get(url, params=params, headers=headers, stream=True)
-                tempStorage = io.BytesIO()
-                for block in r.iter_content(1024):
-                    tempStorage.write(block)
-                if videoDir is None:
-                    return tempStorage.getvalue()
-                with open(videoDir, 'wb') as f:
-                    f.write(tempStorage.getvalue())
-                return ReturnValue({'BaseResponse': {
-                    'ErrMsg': 'Successfully downloaded',
-                    'Ret': 0, }})
+                return download.download(core, url, params, headers, videoDir, (url, msgId))
             msg = {
                 'Type': 'Video',
                 'FileName' : '%s.mp4' % time.strftime('%y%m%d-%H%M%S', time.localtime()),
@@ -158,17 +136,8 @@ def produce_msg(core, msgList):
                         'pass_ticket': 'undefined',
                         'webwx_data_ticket': cookiesList['webwx_data_ticket'],}
                     headers = { 'User-Agent' : config.USER_AGENT }
-                    r = core.s.get(url, params=params, stream=True, headers=headers)
-                    tempStorage = io.BytesIO()
-                    for block in r.iter_content(1024):
-                        tempStorage.write(block)
-                    if attaDir is None:
-                        return tempStorage.getvalue()
-                    with open(attaDir, 'wb') as f:
-                        f.write(tempStorage.getvalue())
-                    return ReturnValue({'BaseResponse': {
-                        'ErrMsg': 'Successfully downloaded',
-                        'Ret': 0, }})
+                    return download.download(core, url, params, headers, attaDir,
+                        (url, rawMsg['MediaId']))
                 msg = {
                     'Type': 'Attachment',
                     'Text': download_atta, }
@@ -240,8 +209,7 @@ def produce_group_chat(core, msg):
         utils.msg_formatter(msg, 'Content')
         return
     chatroom = core.storageClass.search_chatrooms(userName=chatroomUserName)
-    member = utils.search_dict_list((chatroom or {}).get(
-        'MemberList') or [], 'UserName', actualUserName)
+    member = core.storageClass.search_chatroom_member(chatroomUserName, actualUserName)
     if member is None:
         chatroom = core.update_chatroom(chatroomUserName)
         member = utils.search_dict_list((chatroom or {}).get(
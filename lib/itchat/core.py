@@ -13,6 +13,13 @@ class Core(object):
             receivingRetryCount is for receiving loop retry
                 - it's 5 now, but actually even 1 is enough
                 - failing is failing
+            receivingQueueSize is the number of fetched batches waiting to be produced
+                - receiving blocks once it is reached
+                - receivingPipeline.metrics() shows how receiving performs
+            downloadMaxSize aborts media downloads larger than it (bytes)
+                - None means no limit
+            mediaCache is a download.MediaCache so that the same media is fetched once
+                - None means no cache
         '''
         self.alive, self.isLogging = False, False
         self.storageClass = storage.Storage(self)
@@ -26,6 +33,10 @@ class Core(object):
         self.functionDict = {'FriendChat': {}, 'GroupChat': {}, 'MpChat': {}}
         self.useHotReload, self.hotReloadDir = False, 'itchat.pkl'
         self.receivingRetryCount = 5
+        self.receivingQueueSize = 16
+        self.receivingPipeline = None
+        self.downloadMaxSize = None
+        self.mediaCache = None
     def login(self, enableCmdQR=False, picDir=None, qrCallback=None,
             loginCallback=None, exitCallback=None):
         ''' log in like web wechat does
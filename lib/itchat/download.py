@@ -0,0 +1,152 @@
+''' streaming download of message media
+
+    content is written to a temp file in large chunks and renamed to the target when complete,
+    so it is never held in memory as a whole and a failed download leaves no partial file.
+    core.downloadMaxSize aborts downloads larger than it, core.mediaCache (a MediaCache)
+    makes repeated downloads of the same media be fetched only once
+'''
+import os, shutil, tempfile, hashlib, threading
+import logging
+from collections import OrderedDict
+
+from . import config, utils
+from .returnvalues import ReturnValue
+
+logger = logging.getLogger('itchat')
+
+class MediaCache(object):
+    ''' content addressed cache of downloaded media
+        every content is stored once as <cacheDir>/<sha1>, keys (msgId, MediaId...) map to the content,
+        the least recently used contents are removed once their total size exceeds maxSize '''
+    def __init__(self, cacheDir, maxSize=256 * 1024 * 1024):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.size = 0
+        self.keys = OrderedDict() # key -> sha1 of content
+        self.contents = OrderedDict() # sha1 -> size, in least recently used order
+        self.stats = {'hits': 0, 'misses': 0, 'deduplicated': 0}
+        self.lock = threading.Lock()
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        for name in os.listdir(cacheDir): # contents of a former run can not be found by key any more
+            path = os.path.join(cacheDir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+    def get(self, key):
+        ''' path of the cached content of key, None if it is not cached '''
+        with self.lock:
+            digest = self.keys.get(key)
+            if digest is None or digest not in self.contents:
+                self.stats['misses'] += 1
+                return None
+            self.keys.move_to_end(key)
+            self.contents.move_to_end(digest)
+            self.stats['hits'] += 1
+            return os.path.join(self.cacheDir, digest)
+    def put(self, key, tempPath, digest, size):
+        ''' move a downloaded temp file into the cache and return the path of the cached content '''
+        path = os.path.join(self.cacheDir, digest)
+        with self.lock:
+            if digest in self.contents:
+                os.remove(tempPath) # same content from another key, keep a single copy
+                self.stats['deduplicated'] += 1
+            else:
+                os.replace(tempPath, path)
+                self.contents[digest] = size
+                self.size += size
+            self.contents.move_to_end(digest)
+            self.keys[key] = digest
+            self.keys.move_to_end(key)
+            while self.size > self.maxSize and len(self.contents) > 1:
+                oldDigest, oldSize = self.contents.popitem(last=False)
+                self.size -= oldSize
+                try:
+                    os.remove(os.path.join(self.cacheDir, oldDigest))
+                except OSError:
+                    pass
+            while len(self.keys) > len(self.contents) * 4 + 1024:
+                self.keys.popitem(last=False) # keys of removed contents are dropped lazily
+        return path
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics['contents'] = len(self.contents)
+            metrics['size'] = self.size
+        return metrics
+
+def _too_large(maxSize):
+    return ReturnValue({'BaseResponse': {
+        'ErrMsg': 'File is larger than %s bytes, download aborted' % maxSize,
+        'Ret': -1005, }})
+
+def _fetch(core, url, params, headers, tempDir):
+    ''' stream url into a temp file in tempDir, return (tempPath, sha1, size) or a failed ReturnValue '''
+    maxSize = getattr(core, 'downloadMaxSize', None)
+    r = core.s.get(url, params=params, headers=headers, stream=True)
+    try:
+        contentLength = r.headers.get('Content-Length')
+        if maxSize and contentLength and contentLength.isdigit() and int(contentLength) > maxSize:
+            return _too_large(maxSize)
+        fd, tempPath = tempfile.mkstemp(prefix='.download.', dir=tempDir)
+        sha1, size = hashlib.sha1(), 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in r.iter_content(config.DOWNLOAD_CHUNK_SIZE):
+                    size += len(block)
+                    if maxSize and size > maxSize:
+                        break
+                    sha1.update(block)
+                    f.write(block)
+        except:
+            os.remove(tempPath)
+            raise
+        if maxSize and size > maxSize:
+            os.remove(tempPath)
+            return _too_large(maxSize)
+        return tempPath, sha1.hexdigest(), size
+    finally:
+        r.close()
+
+def _deliver(path, fileDir):
+    if fileDir is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    if path != fileDir:
+        shutil.copyfile(path, fileDir)
+    with open(fileDir, 'rb') as f:
+        head = f.read(20)
+    return ReturnValue({'BaseResponse': {
+        'ErrMsg': 'Successfully downloaded',
+        'Ret': 0, },
+        'PostFix': utils.get_image_postfix(head), })
+
+def download(core, url, params, headers, fileDir=None, cacheKey=None):
+    ''' download url to fileDir, return the content if fileDir is None
+        on success a ReturnValue with PostFix guessed from the head of the content is returned,
+        a failed ReturnValue is returned when the content is larger than core.downloadMaxSize
+        if core.mediaCache is set, cacheKey identifies the media so that it is fetched only once '''
+    mediaCache = getattr(core, 'mediaCache', None) if cacheKey is not None else None
+    if mediaCache is not None:
+        path = mediaCache.get(cacheKey)
+        if path is not None:
+            try:
+                return _deliver(path, fileDir)
+            except FileNotFoundError:
+                pass # removed from cache meanwhile, download again
+        tempDir = mediaCache.cacheDir
+    else:
+        tempDir = os.path.dirname(os.path.abspath(fileDir)) if fileDir else None
+    r = _fetch(core, url, params, headers, tempDir)
+    if isinstance(r, ReturnValue):
+        logger.warning('Download of %s aborted: %s' % (url, r['BaseResponse']['RawMsg']))
+        return r
+    tempPath, digest, size = r
+    if mediaCache is not None:
+        return _deliver(mediaCache.put(cacheKey, tempPath, digest, size), fileDir)
+    if fileDir is None:
+        try:
+            return _deliver(tempPath, None)
+        finally:
+            os.remove(tempPath)
+    os.replace(tempPath, fileDir)
+    return _deliver(fileDir, fileDir)
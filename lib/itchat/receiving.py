@@ -0,0 +1,104 @@
+''' pipelined receiving of messages
+
+    the polling stage only runs synccheck and webwxsync and puts the raw batches into a bounded queue,
+    the producing stage formats them (contact searches, chatroom updates) and puts the messages into msgList,
+    so a slow batch no longer delays the next synccheck. batches are produced by a single thread in the
+    order they are fetched, and polling blocks once maxBatches are waiting to be produced
+'''
+import time, queue, threading, traceback
+import logging
+
+logger = logging.getLogger('itchat')
+
+class ReceivingPipeline(object):
+    def __init__(self, produceFn, maxBatches=16):
+        ''' produceFn(msgList, contactList) is called in the producing thread for every batch '''
+        self.produceFn = produceFn
+        self.batches = queue.Queue(maxBatches)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {
+            'polls'          : 0, # synccheck requests
+            'syncCheckTime'  : 0.0,
+            'fetches'        : 0, # webwxsync requests
+            'fetchTime'      : 0.0,
+            'batches'        : 0, # batches produced
+            'messages'       : 0,
+            'contacts'       : 0,
+            'maxBatchSize'   : 0,
+            'produceTime'    : 0.0,
+            'maxProduceTime' : 0.0,
+            'queueTime'      : 0.0, # time batches waited for the producing thread
+            'queueFullWaits' : 0, # times polling was blocked by a full queue
+            'errors'         : 0, }
+    def start(self):
+        self.thread = threading.Thread(target=self._produce_loop, name='itchat-produce')
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self, timeout=None):
+        ''' produce batches already fetched, then stop the producing thread '''
+        if self.thread is None:
+            return
+        self.batches.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning('Producing of received messages did not finish in %ss.' % timeout)
+        self.thread = None
+    def record_sync_check(self, seconds):
+        with self.lock:
+            self.stats['polls'] += 1
+            self.stats['syncCheckTime'] += seconds
+    def record_fetch(self, seconds):
+        with self.lock:
+            self.stats['fetches'] += 1
+            self.stats['fetchTime'] += seconds
+    def put(self, msgList, contactList):
+        if self.batches.full():
+            with self.lock:
+                self.stats['queueFullWaits'] += 1
+        self.batches.put((msgList or [], contactList or [], time.time()))
+    def metrics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        average = lambda total, count: round(total / count * 1000, 1) if count else 0
+        return {
+            'queueDepth'        : self.batches.qsize(),
+            'queueSize'         : self.batches.maxsize,
+            'polls'             : stats['polls'],
+            'avgSyncCheckMs'    : average(stats['syncCheckTime'], stats['polls']),
+            'fetches'           : stats['fetches'],
+            'avgFetchMs'        : average(stats['fetchTime'], stats['fetches']),
+            'batches'           : stats['batches'],
+            'messages'          : stats['messages'],
+            'contacts'          : stats['contacts'],
+            'avgBatchSize'      : round((stats['messages'] + stats['contacts']) / stats['batches'], 1)
+                                  if stats['batches'] else 0,
+            'maxBatchSize'      : stats['maxBatchSize'],
+            'avgProduceMs'      : average(stats['produceTime'], stats['batches']),
+            'maxProduceMs'      : round(stats['maxProduceTime'] * 1000, 1),
+            'avgQueueMs'        : average(stats['queueTime'], stats['batches']),
+            'queueFullWaits'    : stats['queueFullWaits'],
+            'errors'            : stats['errors'], }
+    def _produce_loop(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            msgList, contactList, queuedAt = batch
+            start = time.time()
+            failed = False
+            try:
+                self.produceFn(msgList, contactList)
+            except:
+                failed = True
+                logger.error(traceback.format_exc())
+            cost = time.time() - start
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['messages'] += len(msgList)
+                self.stats['contacts'] += len(contactList)
+                self.stats['maxBatchSize'] = max(self.stats['maxBatchSize'], len(msgList) + len(contactList))
+                self.stats['produceTime'] += cost
+                self.stats['maxProduceTime'] = max(self.stats['maxProduceTime'], cost)
+                self.stats['queueTime'] += start - queuedAt
+                self.stats['errors'] += failed
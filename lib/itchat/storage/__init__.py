@@ -1,4 +1,4 @@
-import os, time, copy
+import os, time
 from threading import Lock
 
 from .messagequeue import Queue
@@ -9,9 +9,36 @@ from .templates import (
 def contact_change(fn):
     def _contact_change(core, *args, **kwargs):
         with core.storageClass.updateLock:
-            return fn(core, *args, **kwargs)
+            try:
+                return fn(core, *args, **kwargs)
+            finally:
+                # contacts may be changed in place, indexes are rebuilt on next search
+                core.storageClass.generation += 1
     return _contact_change
 
+SEARCH_KEYS = ('RemarkName', 'NickName', 'Alias')
+
+class ContactIndex(object):
+    ''' hash indexes of a ContactList, built lazily and rebuilt after the list or its contacts change '''
+    def __init__(self, contactList, keys=()):
+        self.byUserName = {}
+        self.byKey = dict((k, {}) for k in keys)
+        self.position = {}
+        for i, m in enumerate(contactList):
+            self.byUserName.setdefault(m.get('UserName'), m)
+            self.position[id(m)] = i
+            for k in keys:
+                v = m.get(k)
+                if v is not None:
+                    self.byKey[k].setdefault(v, []).append(m)
+    def match_any(self, name):
+        ''' contacts with RemarkName, NickName or Alias equal to name, in list order '''
+        found = {}
+        for k in SEARCH_KEYS:
+            for m in self.byKey[k].get(name, ()):
+                found[id(m)] = m
+        return sorted(found.values(), key=lambda m: self.position[id(m)])
+
 class Storage(object):
     def __init__(self, core):
         self.userName          = None
@@ -28,6 +55,10 @@ class Storage(object):
         self.mpList.core = core
         self.chatroomList.set_default_value(contactClass=Chatroom)
         self.chatroomList.core = core
+        self.generation        = 0 # increased by contact_change
+        self._indexes          = {} # (list name, keys) -> (state, ContactIndex)
+        self._memberIndexes    = {} # chatroom UserName -> (state, ContactIndex)
+        self.snapshotState     = None # set by dump_snapshot and load_snapshot
     def dumps(self):
         return {
             'userName'          : self.userName,
@@ -59,59 +90,100 @@ class Storage(object):
                 chatroom['Self'].core = chatroom.core
                 chatroom['Self'].chatroom = chatroom
         self.lastInputUserName = j.get('lastInputUserName', None)
+        self.generation += 1
+    def _index(self, listName, keys=()):
+        ''' caller should hold updateLock
+            UserName of a contact never changes, so an index without keys only depends on the list itself
+            and stays valid across contact_change '''
+        contactList = getattr(self, listName)
+        state = (id(contactList), contactList.generation, self.generation if keys else None)
+        cached = self._indexes.get((listName, keys))
+        if cached is None or cached[0] != state:
+            cached = (state, ContactIndex(contactList, keys))
+            self._indexes[(listName, keys)] = cached
+        return cached[1]
+    def user_name_index(self, listName):
+        ''' UserName -> contact of memberList, mpList or chatroomList
+            caller should hold updateLock and must not modify the returned dict '''
+        return self._index(listName).byUserName
+    def append_contact(self, listName, info):
+        ''' append info to memberList, mpList or chatroomList and return the stored contact
+            cached indexes that were up to date are extended in place instead of being rebuilt,
+            so merging many new contacts one by one stays linear
+            caller should hold updateLock '''
+        contactList = getattr(self, listName)
+        before = (id(contactList), contactList.generation)
+        contactList.append(info)
+        contact = contactList[-1]
+        for (name, keys), (state, index) in list(self._indexes.items()):
+            if name != listName or state[:2] != before:
+                continue
+            index.byUserName.setdefault(contact.get('UserName'), contact)
+            index.position[id(contact)] = len(contactList) - 1
+            for k in keys:
+                v = contact.get(k)
+                if v is not None:
+                    index.byKey[k].setdefault(v, []).append(contact)
+            self._indexes[(name, keys)] = ((before[0], contactList.generation) + state[2:], index)
+        return contact
+    def _member_index(self, chatroom):
+        ''' caller should hold updateLock '''
+        memberList = chatroom.get('MemberList') or []
+        state = (id(memberList), getattr(memberList, 'generation', 0))
+        cached = self._memberIndexes.get(chatroom['UserName'])
+        if cached is None or cached[0] != state:
+            if len(self._memberIndexes) > len(self.chatroomList) * 2:
+                self._memberIndexes.clear() # drop indexes of chatrooms no longer in storage
+            cached = (state, ContactIndex(memberList))
+            self._memberIndexes[chatroom['UserName']] = cached
+        return cached[1]
     def search_friends(self, name=None, userName=None, remarkName=None, nickName=None,
             wechatAccount=None):
         with self.updateLock:
             if (name or userName or remarkName or nickName or wechatAccount) is None:
-                return copy.deepcopy(self.memberList[0]) # my own account
-            elif userName: # return the only userName match
-                for m in self.memberList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                return self.memberList[0].snapshot() # my own account
+            index = self._index('memberList', SEARCH_KEYS)
+            if userName: # return the only userName match
+                m = index.byUserName.get(userName)
+                return None if m is None else m.snapshot()
             else:
                 matchDict = {
                     'RemarkName' : remarkName,
                     'NickName'   : nickName,
                     'Alias'      : wechatAccount, }
-                for k in ('RemarkName', 'NickName', 'Alias'):
+                for k in SEARCH_KEYS:
                     if matchDict[k] is None:
                         del matchDict[k]
                 if name: # select based on name
-                    contact = []
-                    for m in self.memberList:
-                        if any([m.get(k) == name for k in ('RemarkName', 'NickName', 'Alias')]):
-                            contact.append(m)
+                    contact = index.match_any(name)
+                elif matchDict: # candidates from the index of any given key
+                    k, v = next(iter(matchDict.items()))
+                    contact = index.byKey[k].get(v, [])
                 else:
                     contact = self.memberList[:]
                 if matchDict: # select again based on matchDict
-                    friendList = []
-                    for m in contact:
-                        if all([m.get(k) == v for k, v in matchDict.items()]):
-                            friendList.append(m)
-                    return copy.deepcopy(friendList)
-                else:
-                    return copy.deepcopy(contact)
+                    contact = [m for m in contact
+                        if all([m.get(k) == v for k, v in matchDict.items()])]
+                return [m.snapshot() for m in contact]
     def search_chatrooms(self, name=None, userName=None):
         with self.updateLock:
             if userName is not None:
-                for m in self.chatroomList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self._index('chatroomList').byUserName.get(userName)
+                return None if m is None else m.snapshot()
             elif name is not None:
-                matchList = []
-                for m in self.chatroomList:
-                    if name in m['NickName']:
-                        matchList.append(copy.deepcopy(m))
-                return matchList
+                return [m.snapshot() for m in self.chatroomList if name in m['NickName']]
+    def search_chatroom_member(self, chatroomUserName, userName):
+        ''' find a member of a chatroom by UserName without copying the chatroom '''
+        with self.updateLock:
+            chatroom = self._index('chatroomList').byUserName.get(chatroomUserName)
+            if chatroom is None:
+                return None
+            m = self._member_index(chatroom).byUserName.get(userName)
+            return None if m is None else m.snapshot()
     def search_mps(self, name=None, userName=None):
         with self.updateLock:
             if userName is not None:
-                for m in self.mpList:
-                    if m['UserName'] == userName:
-                        return copy.deepcopy(m)
+                m = self._index('mpList').byUserName.get(userName)
+                return None if m is None else m.snapshot()
             elif name is not None:
-                matchList = []
-                for m in self.mpList:
-                    if name in m['NickName']:
-                        matchList.append(copy.deepcopy(m))
-                return matchList
+                return [m.snapshot() for m in self.mpList if name in m['NickName']]
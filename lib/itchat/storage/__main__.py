@@ -0,0 +1,129 @@
+''' benchmark of contact searches: python -m lib.itchat.storage [friends] [chatrooms] [members]
+    compares the indexed, snapshot based searches with the former linear scan + deepcopy '''
+import copy
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+from . import Storage, contact_change
+from .snapshot import dump_snapshot, load_snapshot
+from ..utils import search_dict_list
+
+class FakeCore(object):
+    pass
+
+def legacy_search_chatrooms(storage, userName):
+    with storage.updateLock:
+        for m in storage.chatroomList:
+            if m['UserName'] == userName:
+                return copy.deepcopy(m)
+
+def legacy_search_friends(storage, name=None, userName=None):
+    with storage.updateLock:
+        if userName:
+            for m in storage.memberList:
+                if m['UserName'] == userName:
+                    return copy.deepcopy(m)
+        else:
+            return copy.deepcopy([m for m in storage.memberList
+                if any([m.get(k) == name for k in ('RemarkName', 'NickName', 'Alias')])])
+
+def legacy_group_message(storage, chatroomUserName, userName):
+    # what produce_group_chat + produce_msg did for every group message
+    chatroom = legacy_search_chatrooms(storage, chatroomUserName)
+    member = search_dict_list(chatroom['MemberList'], 'UserName', userName)
+    legacy_search_chatrooms(storage, chatroomUserName)
+    return member
+
+def group_message(storage, chatroomUserName, userName):
+    storage.search_chatrooms(userName=chatroomUserName)
+    member = storage.search_chatroom_member(chatroomUserName, userName)
+    storage.search_chatrooms(userName=chatroomUserName)
+    return member
+
+def bench(name, fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    cost = (time.perf_counter() - start) / n * 1e6
+    print('%-38s %10.1f us/op' % (name, cost))
+    return cost
+
+def main():
+    friendCount = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    chatroomCount = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    memberCount = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    core = FakeCore()
+    storage = Storage(core)
+    core.storageClass = storage
+    storage.userName = '@self'
+    for i in range(friendCount):
+        storage.memberList.append({'UserName': '@friend%d' % i, 'NickName': 'friend%d' % i,
+            'RemarkName': 'remark%d' % i, 'Alias': '', 'VerifyFlag': 0})
+    for i in range(chatroomCount):
+        storage.chatroomList.append({'UserName': '@@room%d' % i, 'NickName': 'room%d' % i,
+            'MemberList': [{'UserName': '@member%d_%d' % (i, j), 'NickName': 'member%d' % j,
+                'DisplayName': ''} for j in range(memberCount)]})
+    print('%d friends, %d chatrooms x %d members' % (friendCount, chatroomCount, memberCount))
+
+    room = lambda i: '@@room%d' % (i % chatroomCount)
+    member = lambda i: '@member%d_%d' % (i % chatroomCount, i * 7 % memberCount)
+    friend = lambda i: '@friend%d' % (i * 13 % friendCount)
+    n = 200
+    pairs = (
+        ('group message (legacy)', lambda i: legacy_group_message(storage, room(i), member(i)),
+         'group message (indexed)', lambda i: group_message(storage, room(i), member(i))),
+        ('search_friends userName (legacy)', lambda i: legacy_search_friends(storage, userName=friend(i)),
+         'search_friends userName (indexed)', lambda i: storage.search_friends(userName=friend(i))),
+        ('search_friends name (legacy)', lambda i: legacy_search_friends(storage, name='remark%d' % (i % friendCount)),
+         'search_friends name (indexed)', lambda i: storage.search_friends(name='remark%d' % (i % friendCount))),
+    )
+    for legacyName, legacyFn, indexedName, indexedFn in pairs:
+        legacy = bench(legacyName, legacyFn, n)
+        indexed = bench(indexedName, indexedFn, n * 10)
+        print('%-38s %10.1fx' % ('speedup', legacy / indexed))
+
+    @contact_change
+    def touch(core):
+        pass
+    def changed_then_search(i):
+        touch(core)
+        storage.search_chatroom_member(room(i), member(i))
+    bench('rebuild after contact change', changed_then_search, 20)
+
+    # hot reload: former pickle of the whole storage against the snapshot
+    tmpDir = tempfile.mkdtemp()
+    try:
+        header = {'version': 'bench', 'userName': '@self'}
+        pklPath, snapshotPath = os.path.join(tmpDir, 'itchat.pkl'), os.path.join(tmpDir, 'itchat.snapshot')
+        def timed(fn):
+            start = time.perf_counter()
+            fn()
+            return (time.perf_counter() - start) * 1e3
+        def pickle_dump():
+            with open(pklPath, 'wb') as f:
+                pickle.dump({'version': 'bench', 'storage': storage.dumps()}, f)
+        def pickle_load():
+            with open(pklPath, 'rb') as f:
+                Storage(FakeCore()).loads(pickle.load(f)['storage'])
+        print('%-38s %10.1f ms, %d bytes' % ('pickle dump', timed(pickle_dump), os.path.getsize(pklPath)))
+        print('%-38s %10.1f ms' % ('pickle load', timed(pickle_load)))
+        print('%-38s %10.1f ms, %d bytes' % ('snapshot dump',
+            timed(lambda: dump_snapshot(storage, snapshotPath, header)), os.path.getsize(snapshotPath)))
+        loaded = Storage(FakeCore())
+        print('%-38s %10.1f ms' % ('snapshot load', timed(lambda: load_snapshot(loaded, snapshotPath, 'bench'))))
+        size = os.path.getsize(snapshotPath)
+        storage.memberList[0]['NickName'] = 'renamed'
+        storage.chatroomList[0]['MemberList'][0]['NickName'] = 'renamed'
+        print('%-38s %10.1f ms, +%d bytes' % ('snapshot dump, 2 contacts changed',
+            timed(lambda: dump_snapshot(storage, snapshotPath, header)), os.path.getsize(snapshotPath) - size))
+        print('%-38s %10.1f ms' % ('snapshot dump of unused reloaded rooms',
+            timed(lambda: dump_snapshot(loaded, snapshotPath, header))))
+    finally:
+        shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    main()
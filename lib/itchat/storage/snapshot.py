@@ -0,0 +1,178 @@
+''' versioned snapshot of login status and contacts for hot reload
+
+    the file is utf-8 text, one record per line, the first line is the magic with the format version:
+        itchat-snapshot 1
+        H\t{header: version, loginInfo, cookies, userName, nickName, lastInputUserName}
+        C\t<listName>\t{contact without MemberList}
+        M\t<chatroom UserName>\t[members of the chatroom]
+        D\t<listName>\t<UserName>
+    records are applied in order and a later record of the same contact replaces the former one,
+    so a dump only appends the records that changed since the last dump (D removes a contact),
+    and the file is rewritten through a temp file and rename once appended records outnumber live ones.
+    member lists are kept as json text until the chatroom is used, see LazyContactList
+'''
+import os, json, hashlib, tempfile
+import logging
+
+from .templates import ChatroomMember, LazyContactList
+
+logger = logging.getLogger('itchat')
+
+MAGIC = 'itchat-snapshot'
+FORMAT_VERSION = 1
+LIST_NAMES = ('memberList', 'mpList', 'chatroomList')
+
+class SnapshotState(object):
+    ''' what the last dump or load knows about the file, used to decide between append and rewrite '''
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.records = 0 # records in the file, including replaced ones
+        self.digests = {} # record key -> digest of the live record
+
+def _digest(line):
+    return hashlib.blake2b(line.encode('utf-8'), digest_size=16).digest()
+
+def _dumps(o):
+    return json.dumps(o, ensure_ascii=False, separators=(',', ':'))
+
+def _plain(contact):
+    ''' contact as a plain dict, MemberList is stored in its own record or rebuilt by templates '''
+    d = dict(contact)
+    d.pop('MemberList', None)
+    return d
+
+def is_snapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.readline().split(b' ')[0] == MAGIC.encode('utf-8')
+    except (OSError, IOError):
+        return False
+
+def _records(storage, header):
+    ''' yield (key, line) of every live record, caller should hold updateLock '''
+    yield ('H',), 'H\t%s\n' % _dumps(header)
+    for listName in LIST_NAMES:
+        for contact in getattr(storage, listName):
+            userName = contact.get('UserName')
+            yield ('C', listName, userName), 'C\t%s\t%s\n' % (listName,
+                _dumps(_plain(contact)))
+            if listName != 'chatroomList':
+                continue
+            memberList = contact.get('MemberList')
+            if isinstance(memberList, LazyContactList) and memberList.raw is not None:
+                members = memberList.raw # never used since loaded, no need to encode again
+            else:
+                members = _dumps([_plain(m) for m in memberList or ()])
+            yield ('M', userName), 'M\t%s\t%s\n' % (userName, members)
+
+def dump_snapshot(storage, path, header):
+    ''' write storage and header to path, appending changed records if path is the file last dumped or loaded '''
+    path = os.path.abspath(path)
+    with storage.updateLock:
+        records = [(key, line, _digest(line)) for key, line in _records(storage, header)]
+    state = getattr(storage, 'snapshotState', None)
+    if state is not None and state.path == path and os.path.exists(path) and \
+            os.path.getsize(path) == state.size:
+        live = set(key for key, line, digest in records)
+        changed = [line for key, line, digest in records if state.digests.get(key) != digest]
+        changed += ['D\t%s\t%s\n' % key[1:] for key in state.digests
+            if key not in live and key[0] == 'C']
+        if state.records + len(changed) <= len(records) * 2:
+            data = ''.join(changed).encode('utf-8')
+            with open(path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            state.size += len(data)
+            state.records += len(changed)
+            state.digests = dict((key, digest) for key, line, digest in records)
+            logger.debug('Appended %s changed records to snapshot.' % len(changed))
+            return
+    data = ('%s %s\n' % (MAGIC, FORMAT_VERSION) + ''.join(line for key, line, digest in records)).encode('utf-8')
+    fd, tmpPath = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    state = SnapshotState(path)
+    state.size = len(data)
+    state.records = len(records)
+    state.digests = dict((key, digest) for key, line, digest in records)
+    storage.snapshotState = state
+
+def load_snapshot(storage, path, version):
+    ''' load contacts of a snapshot into storage and return its header
+        storage is left untouched if the snapshot is dumped by another itchat version
+        member lists are only decoded when the chatroom is used '''
+    path = os.path.abspath(path)
+    with open(path, 'rb') as f:
+        magic = f.readline()
+        name, _, formatVersion = magic.decode('utf-8').strip().partition(' ')
+        if name != MAGIC:
+            raise ValueError('%s is not an itchat snapshot' % path)
+        if formatVersion != str(FORMAT_VERSION):
+            raise ValueError('unsupported snapshot format %s' % formatVersion)
+        size, records = len(magic), 0
+        header, lines = None, {}
+        contacts = dict((listName, {}) for listName in LIST_NAMES)
+        for raw in f:
+            if not raw.endswith(b'\n'):
+                break # torn append of an interrupted dump, ignore it
+            size += len(raw)
+            records += 1
+            line = raw.decode('utf-8')
+            kind, _, body = line.partition('\t')
+            if kind == 'H':
+                header, lines[('H',)] = json.loads(body), line
+            elif kind == 'C':
+                listName, _, body = body.partition('\t')
+                contact = json.loads(body)
+                userName = contact.get('UserName')
+                contacts[listName][userName] = contact
+                lines[('C', listName, userName)] = line
+            elif kind == 'M':
+                userName, _, body = body.partition('\t')
+                lines[('M', userName)] = line
+            elif kind == 'D':
+                listName, _, userName = body.rstrip('\n').partition('\t')
+                contacts[listName].pop(userName, None)
+                lines.pop(('C', listName, userName), None)
+                lines.pop(('M', userName), None)
+    if header is None:
+        raise ValueError('%s has no header' % path)
+    if header.get('version') != version:
+        return header
+    with storage.updateLock:
+        storage.userName = header.get('userName')
+        storage.nickName = header.get('nickName')
+        storage.lastInputUserName = header.get('lastInputUserName')
+        for listName in LIST_NAMES:
+            contactList = getattr(storage, listName)
+            del contactList[:]
+            for contact in contacts[listName].values():
+                contactList.append(contact)
+        for chatroom in storage.chatroomList:
+            memberList = chatroom['MemberList']
+            line = lines.get(('M', chatroom['UserName']))
+            lazyList = LazyContactList(line.split('\t', 2)[2].rstrip('\n') if line else None)
+            lazyList.set_default_value(memberList.contactInitFn, memberList.contactClass)
+            lazyList.core = memberList.core
+            chatroom['MemberList'] = lazyList
+            if 'Self' in chatroom:
+                chatroom['Self'] = ChatroomMember(chatroom['Self'])
+                chatroom['Self'].core = chatroom.core
+                chatroom['Self'].chatroom = chatroom
+        storage.generation += 1
+    state = SnapshotState(path)
+    state.size = size
+    state.records = records
+    state.digests = dict((key, _digest(line)) for key, line in lines.items())
+    storage.snapshotState = state
+    return header
@@ -1,4 +1,4 @@
-import logging, copy, pickle
+import logging, copy, pickle, json
 from weakref import ref
 
 from ..returnvalues import ReturnValue
@@ -27,7 +27,9 @@ class UnInitializedItchat(object):
         return self._raise_error
 
 class ContactList(list):
-    ''' when a dict is append, init function will be called to format that dict '''
+    ''' when a dict is append, init function will be called to format that dict
+        generation is increased on every change of the list so that indexes built on it know when to rebuild '''
+    generation = 0
     def __init__(self, *args, **kwargs):
         super(ContactList, self).__init__(*args, **kwargs)
         self.__setstate__(None)
@@ -42,12 +44,47 @@ class ContactList(list):
             self.contactInitFn = initFunction
         if hasattr(contactClass, '__call__'):
             self.contactClass = contactClass
-    def append(self, value):
+    def _format(self, value):
         contact = self.contactClass(value)
         contact.core = self.core
         if self.contactInitFn is not None:
             contact = self.contactInitFn(self, contact) or contact
-        super(ContactList, self).append(contact)
+        return contact
+    def append(self, value):
+        super(ContactList, self).append(self._format(value))
+        self.generation += 1
+    def __setitem__(self, key, value):
+        super(ContactList, self).__setitem__(key, value)
+        self.generation += 1
+    def __delitem__(self, key):
+        super(ContactList, self).__delitem__(key)
+        self.generation += 1
+    def __iadd__(self, other):
+        r = super(ContactList, self).__iadd__(other)
+        self.generation += 1
+        return r
+    def extend(self, values):
+        # pickle restores items through extend before __setstate__, so items are not formatted here
+        super(ContactList, self).extend(values)
+        self.generation += 1
+    def insert(self, index, value):
+        super(ContactList, self).insert(index, value)
+        self.generation += 1
+    def remove(self, value):
+        super(ContactList, self).remove(value)
+        self.generation += 1
+    def pop(self, *args):
+        self.generation += 1
+        return super(ContactList, self).pop(*args)
+    def clear(self):
+        super(ContactList, self).clear()
+        self.generation += 1
+    def sort(self, *args, **kwargs):
+        super(ContactList, self).sort(*args, **kwargs)
+        self.generation += 1
+    def reverse(self):
+        super(ContactList, self).reverse()
+        self.generation += 1
     def __deepcopy__(self, memo):
         r = self.__class__([copy.deepcopy(v) for v in self])
         r.contactInitFn = self.contactInitFn
@@ -65,6 +102,56 @@ class ContactList(list):
         return '<%s: %s>' % (self.__class__.__name__.split('.')[-1],
             self.__str__())
 
+class ContactListView(ContactList):
+    ''' read-only snapshot of a ContactList, the contacts in it are shared with storage and must not be modified
+        deepcopy it to get a modifiable list '''
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+    append = extend = insert = remove = pop = clear = sort = reverse = \
+        __setitem__ = __delitem__ = __iadd__ = _read_only
+    def __deepcopy__(self, memo):
+        r = ContactList([copy.deepcopy(v) for v in self])
+        r.contactInitFn = self.contactInitFn
+        r.contactClass = self.contactClass
+        r.core = self.core
+        return r
+
+class LazyContactList(ContactList):
+    ''' ContactList restored from a hot reload snapshot, contacts are decoded and formatted on first use
+        raw is the json text of the contacts, it is written back as is if the list is never used '''
+    raw = None
+    def __init__(self, raw=None):
+        super(LazyContactList, self).__init__()
+        self.raw = raw
+    def load(self):
+        raw, self.raw = self.raw, None
+        if raw is not None:
+            for value in json.loads(raw):
+                list.append(self, self._format(value))
+    def __deepcopy__(self, memo):
+        self.load()
+        r = ContactList([copy.deepcopy(v) for v in self])
+        r.contactInitFn = self.contactInitFn
+        r.contactClass = self.contactClass
+        r.core = self.core
+        return r
+
+def _load_first(name):
+    method = getattr(ContactList, name)
+    def _method(self, *args, **kwargs):
+        if self.raw is not None:
+            self.load()
+        return method(self, *args, **kwargs)
+    _method.__name__ = name
+    return _method
+
+for _name in ('__len__', '__iter__', '__reversed__', '__getitem__', '__contains__',
+        '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__add__', '__mul__',
+        '__rmul__', '__imul__', '__str__', '__repr__', 'index', 'count', 'copy',
+        'append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+        '__setitem__', '__delitem__', '__iadd__'):
+    setattr(LazyContactList, _name, _load_first(_name))
+
 class AbstractUserDict(AttributeDict):
     def __init__(self, *args, **kwargs):
         super(AbstractUserDict, self).__init__(*args, **kwargs)
@@ -130,6 +217,13 @@ class AbstractUserDict(AttributeDict):
             r[copy.deepcopy(k)] = copy.deepcopy(v)
         r.core = self.core
         return r
+    def snapshot(self):
+        ''' copy-on-write record returned by storage searches instead of a deepcopy
+            top level values can be changed freely, nested values are shared with storage '''
+        r = self.__class__.__new__(self.__class__)
+        dict.update(r, self)
+        r.__dict__.update(self.__dict__)
+        return r
     def __str__(self):
         return '{%s}' % ', '.join(
             ['%s: %s' % (repr(k),repr(v)) for k,v in self.items()])
@@ -160,6 +254,10 @@ class User(AbstractUserDict):
         r = super(User, self).__deepcopy__(memo)
         r.verifyDict = copy.deepcopy(self.verifyDict)
         return r
+    def snapshot(self):
+        r = super(User, self).snapshot()
+        r.verifyDict = dict(self.verifyDict)
+        return r
     def __setstate__(self, state):
         super(User, self).__setstate__(state)
         self.verifyDict = {}
@@ -210,6 +308,17 @@ class Chatroom(AbstractUserDict):
         return self.core.delete_member_from_chatroom(self.userName, userName)
     def add_member(self, userName):
         return self.core.add_member_into_chatroom(self.userName, userName)
+    def snapshot(self):
+        r = super(Chatroom, self).snapshot()
+        memberList = self['MemberList']
+        if isinstance(memberList, ContactList):
+            view = ContactListView(memberList)
+            view.contactInitFn = memberList.contactInitFn
+            view.contactClass = memberList.contactClass
+            if hasattr(memberList, '_core'):
+                view._core = memberList._core
+            dict.__setitem__(r, 'MemberList', view)
+        return r
     def search_member(self, name=None, userName=None, remarkName=None, nickName=None,
             wechatAccount=None):
         with self.core.storageClass.updateLock:
@@ -218,7 +327,7 @@ class Chatroom(AbstractUserDict):
             elif userName: # return the only userName match
                 for m in self.memberList:
                     if m.userName == userName:
-                        return copy.deepcopy(m)
+                        return m.snapshot()
             else:
                 matchDict = {
                     'RemarkName' : remarkName,
@@ -239,9 +348,9 @@ class Chatroom(AbstractUserDict):
                     for m in contact:
                         if all([m.get(k) == v for k, v in matchDict.items()]):
                             friendList.append(m)
-                    return copy.deepcopy(friendList)
+                    return [m.snapshot() for m in friendList]
                 else:
-                    return copy.deepcopy(contact)
+                    return [m.snapshot() for m in contact]
     def __setstate__(self, state):
         super(Chatroom, self).__setstate__(state)
         if not 'MemberList' in self:
@@ -13,6 +13,7 @@ from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
+from common.msg_dedup import MessageDeduplicator
 from config import conf, load_config, global_config
 from plugins import *
 
@@ -131,6 +132,10 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "status": {
+        "alias": ["status", "运行状态"],
+        "desc": "查看消息处理线程池状态",
+    },
 }
 
 
@@ -352,6 +357,42 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "status":
+                            ok, result = True, ""
+                            if hasattr(channel, "handler_pool_metrics"):
+                                result += "线程池状态：\n"
+                                for m in channel.handler_pool_metrics():
+                                    result += f"{m['name']}: 排队{m['queue_depth']}, 执行中{m['active_workers']}/{m['workers']}(上限{m['max_workers']}), 近期等待{m['recent_wait_ms']}ms, 最长等待{m['max_wait_ms']}ms\n"
+                            if hasattr(channel, "fair_queue_metrics"):
+                                m = channel.fair_queue_metrics()
+                                result += f"公平调度：排队{m['pending']}(流{m['flows']}), 模型调用{m['inflight']}/{m['slots'] or '不限'}, 超出用户额度{m['shed_user']}, 超出群额度{m['shed_group']}, 排队过多丢弃{m['shed_queue']}\n"
+                            if hasattr(channel, "contact_cache_metrics"):
+                                m = channel.contact_cache_metrics()
+                                result += f"联系人缓存：命中率{m['hit_rate']:.1%}, 命中{m['hits']}, 未命中{m['misses']}, 请求{m['fetches']}, 合并请求{m['coalesced']}, 失败{m['errors']}\n"
+                            if hasattr(channel, "receiving_metrics"):
+                                m = channel.receiving_metrics()
+                                if m:
+                                    result += f"消息接收：待处理{m['queueDepth']}/{m['queueSize']}批, 同步检查平均{m['avgSyncCheckMs']}ms, 拉取平均{m['avgFetchMs']}ms, 批次{m['batches']}(平均{m['avgBatchSize']}条, 最大{m['maxBatchSize']}条), 处理平均{m['avgProduceMs']}ms(最长{m['maxProduceMs']}ms), 排队平均{m['avgQueueMs']}ms, 队列满{m['queueFullWaits']}次\n"
+                            if hasattr(channel, "media_cache_metrics"):
+                                m = channel.media_cache_metrics()
+                                if m:
+                                    result += f"媒体缓存：{m['contents']}个文件{m['size'] / 1024 / 1024:.1f}MB, 命中{m['hits']}, 未命中{m['misses']}, 内容重复{m['deduplicated']}\n"
+                            if hasattr(channel, "ingest_metrics"):
+                                m = channel.ingest_metrics()
+                                result += f"回调队列：排队{m['queue_depth']}/{m['queue_size']}, 收到{m['received']}, 处理{m['processed']}, 拒绝{m['rejected']}, 失败{m['errors']}, 平均等待{m['avg_wait_ms']}ms\n"
+                            if hasattr(channel, "sync_metrics"):
+                                m = channel.sync_metrics()
+                                result += f"客服消息同步：回调{m['callbacks']}, 合并{m['coalesced']}, 同步{m['syncs']}, 拉取{m['pages']}页{m['messages']}条, 处理{m['handled']}, 跳过{m['skipped']}, 失败{m['errors']}\n"
+                            if hasattr(channel, "send_pipeline_metrics"):
+                                m = channel.send_pipeline_metrics()
+                                result += f"发送队列：待发送{m['pending']}条/{m['receivers']}人, 已发送{m['sent']}, 重试{m['retries']}, 发送失败{m['failed']}, 上传失败{m['upload_failed']}\n"
+                            if getattr(channel, "send_rate_limited", False):
+                                m = channel.send_scheduler_metrics()
+                                result += f"发送限速：待发送{m['pending']}条/{m['receivers']}人, 已发送{m['sent']}, 限速等待{m['throttled']}次, 重试{m['retries']}, 放弃{m['dead']}\n"
+                            dedup = MessageDeduplicator().stats()
+                            result += f"消息去重：检查{sum(dedup['checked'].values())}条，丢弃重复{sum(dedup['dropped'].values())}条"
+                            if dedup["dropped"]:
+                                result += " " + ", ".join(f"{k}:{v}" for k, v in dedup["dropped"].items())
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
@@ -1,11 +1,14 @@
 # encoding:utf-8
 
+import asyncio
+import functools
 import importlib
 import importlib.util
 import json
 import os
 import sys
 
+from common.event_loop import run_sync
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -194,7 +197,31 @@ class PluginManager:
                 if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
                     logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
                     instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
+                    handler = instance.handlers[e_context.event]
+                    if asyncio.iscoroutinefunction(handler):  # 异步插件交给全局事件循环执行
+                        run_sync(handler(e_context, *args, **kwargs))
+                    else:
+                        handler(e_context, *args, **kwargs)
+                    if e_context.is_break():
+                        e_context["breaked_by"] = name
+                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        return e_context
+
+    async def aemit_event(self, e_context: EventContext, *args, **kwargs):
+        """
+        异步流水线中使用的事件分发，异步插件直接await，同步插件在事件循环的线程池中执行
+        """
+        if e_context.event in self.listening_plugins:
+            loop = asyncio.get_running_loop()
+            for name in self.listening_plugins[e_context.event]:
+                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
+                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+                    instance = self.instances[name]
+                    handler = instance.handlers[e_context.event]
+                    if asyncio.iscoroutinefunction(handler):
+                        await handler(e_context, *args, **kwargs)
+                    else:
+                        await loop.run_in_executor(None, functools.partial(handler, e_context, *args, **kwargs))
                     if e_context.is_break():
                         e_context["breaked_by"] = name
                         logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
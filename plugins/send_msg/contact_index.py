@@ -0,0 +1,174 @@
+"""
+send_msg插件查找gewechat接收者使用的联系人索引
+    刷新时拉取联系人列表，并发分批获取简要信息，构建 群名 -> 群wxid、备注/昵称 -> 好友wxid 的索引，查找不再遍历列表
+    索引过期后继续使用旧索引，同时由后台线程刷新(stale-while-revalidate)，只有首次加载时需要等待
+    名字在索引中找不到时同步刷新一次，同一索引两次强制刷新至少间隔min_refresh_interval秒，避免错误的名字反复触发全量刷新
+    群成员列表来自gewechat渠道的GeWeChatContactCache，与消息处理共用缓存、单飞加载和ModContact回调的失效，
+    在其上按群构建 昵称 -> wxid列表 的索引，成员列表重新拉取后索引随之重建
+"""
+import threading
+import time
+from concurrent.futures import Future
+
+from channel.gewechat.gewechat_contact_cache import GeWeChatContactCache
+from common.log import logger
+from common.thread_pool import ElasticThreadPool
+
+BRIEF_INFO_CHUNK = 100  # get_brief_info单次查询的wxid数量
+
+
+class _Index(object):
+    __slots__ = ("data", "update_time")
+
+    def __init__(self, data):
+        self.data = data
+        self.update_time = time.monotonic()
+
+
+class ContactIndex(object):
+    def __init__(self, client, app_id, ttl=86400, fetch_workers=4, min_refresh_interval=60):
+        self.client = client
+        self.app_id = app_id
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.pool = ElasticThreadPool("send_msg_contacts", min_workers=0, max_workers=fetch_workers)
+        self._contacts = None  # _Index，data为{"rooms": {群名: wxid}, "friends": {备注或昵称: wxid}}
+        self._members = {}  # 群wxid -> (构建索引所用的成员列表, {昵称: [wxid]})
+        self._refreshing = {}  # 正在刷新的key -> Future，目前只有None，表示联系人索引
+        self._last_forced = {}  # key -> 上次强制刷新的时间
+        self._lock = threading.Lock()
+        self.stats = {"refreshes": 0, "background_refreshes": 0, "errors": 0}
+
+    def refresh_async(self):
+        """
+        后台预加载联系人索引
+        """
+        self._refresh(None, self._load_contacts)
+
+    def find_room(self, name):
+        return self._find_contact("rooms", name)
+
+    def find_friend(self, name):
+        return self._find_contact("friends", name)
+
+    def find_members(self, room_wxid, names) -> list:
+        """
+        返回群内昵称在names中的成员wxid，一个都找不到时重新拉取一次群成员再查找(同一个群最多每分钟一次)
+        """
+        cache = GeWeChatContactCache()
+        index = self._member_index(room_wxid, cache.get_chatroom_members(self.client, self.app_id, room_wxid))
+        wxids = [wxid for name in names for wxid in index.get(name, [])]
+        if not wxids:
+            index = self._member_index(room_wxid, cache.get_chatroom_members(self.client, self.app_id, room_wxid, force=True))
+            wxids = [wxid for name in names for wxid in index.get(name, [])]
+        return wxids
+
+    def metrics(self) -> dict:
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["rooms"] = len(self._contacts.data["rooms"]) if self._contacts else 0
+            metrics["friends"] = len(self._contacts.data["friends"]) if self._contacts else 0
+            metrics["member_indexes"] = len(self._members)
+        return metrics
+
+    def _find_contact(self, kind, name):
+        index = self._get(None, self._contacts, self.ttl, self._load_contacts)
+        wxid = index.data[kind].get(name)
+        if wxid is None and self._may_force(None, index):
+            index = self._refresh(None, self._load_contacts).result()
+            wxid = index.data[kind].get(name)
+        return wxid
+
+    def _get(self, key, index, ttl, loader) -> _Index:
+        if index is None:
+            return self._refresh(key, loader).result()
+        if time.monotonic() - index.update_time >= ttl:
+            # 过期的索引继续使用，后台刷新
+            self._refresh(key, loader, background=True)
+        return index
+
+    def _may_force(self, key, index) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            # 索引刚刷新过或刚强制刷新过时，再刷新也找不到
+            if now - index.update_time < self.min_refresh_interval or now - self._last_forced.get(key, 0) < self.min_refresh_interval:
+                return False
+            self._last_forced[key] = now
+            return True
+
+    def _refresh(self, key, loader, background=False) -> Future:
+        """
+        同一个key同时只有一个刷新在进行，其余调用方共用同一个Future
+        """
+        with self._lock:
+            future = self._refreshing.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._refreshing[key] = future
+            self.stats["background_refreshes" if background else "refreshes"] += 1
+        # 刷新联系人时需要等待分批获取的结果，不能占用分批获取所用的线程池
+        threading.Thread(target=self._run_refresh, args=(key, loader, future), name="send_msg_refresh", daemon=True).start()
+        return future
+
+    def _run_refresh(self, key, loader, future):
+        try:
+            data = loader()
+        except Exception as e:
+            logger.error("[send_msg] refresh contacts {} failed: {}".format(key or "all", e))
+            with self._lock:
+                self.stats["errors"] += 1
+                del self._refreshing[key]
+            future.set_exception(e)
+            return
+        index = _Index(data)
+        with self._lock:
+            self._contacts = index
+            del self._refreshing[key]
+        future.set_result(index)
+
+    def _load_contacts(self) -> dict:
+        contacts = self.client.fetch_contacts_list(self.app_id)
+        if contacts.get("ret") != 200:
+            raise ValueError(f"获取联系人列表失败: {contacts.get('msg')}")
+        data = contacts.get("data") or {}
+        rooms = data.get("chatrooms") or []
+        friends = data.get("friends") or []
+        # 群和好友的所有分批请求一起提交，并发获取
+        chunks = [rooms[i:i + BRIEF_INFO_CHUNK] for i in range(0, len(rooms), BRIEF_INFO_CHUNK)]
+        room_chunk_cnt = len(chunks)
+        chunks += [friends[i:i + BRIEF_INFO_CHUNK] for i in range(0, len(friends), BRIEF_INFO_CHUNK)]
+        futures = [self.pool.submit(self._fetch_brief_info, chunk) for chunk in chunks]
+        results = [future.result() for future in futures]
+
+        room_index = {}
+        for info in (item for result in results[:room_chunk_cnt] for item in result):
+            room_index.setdefault(info.get("nickName"), info.get("userName"))
+        friend_index = {}
+        for info in (item for result in results[room_chunk_cnt:] for item in result):
+            # 与原先按列表顺序逐个比较备注和昵称的结果一致，同名时取列表中靠前的好友
+            friend_index.setdefault(info.get("nickName"), info.get("userName"))
+            if info.get("remark"):
+                friend_index.setdefault(info.get("remark"), info.get("userName"))
+        logger.info("[send_msg] contacts index refreshed, rooms={}, friends={}".format(len(rooms), len(friends)))
+        return {"rooms": room_index, "friends": friend_index}
+
+    def _fetch_brief_info(self, wxids) -> list:
+        return self.client.get_brief_info(self.app_id, wxids).get("data") or []
+
+    def _member_index(self, room_wxid, members) -> dict:
+        """
+        按成员列表构建 昵称 -> [wxid] 的索引，成员列表还是上次的同一个对象时复用索引
+        """
+        if not members:
+            return {}
+        with self._lock:
+            cached = self._members.get(room_wxid)
+            if cached is not None and cached[0] is members:
+                return cached[1]
+        index = {}
+        for member in members.values():
+            index.setdefault(member.get("nickName"), []).append(member.get("wxid"))
+        with self._lock:
+            self._members[room_wxid] = (members, index)
+        return index
@@ -39,9 +39,17 @@ from plugins import *
 import plugins
 from plugins.send_msg.file_api import FileWriter
 from config import conf
+from common.send_scheduler import PRIORITY_BULK, get_send_scheduler
+from common.thread_pool import ElasticThreadPool
+from plugins.send_msg.contact_index import ContactIndex
+from functools import partial
 import time
 
 
+# 群发时并发查找接收者并提交发送，容量在插件初始化时按配置调整
+broadcast_pool = ElasticThreadPool("send_msg_broadcast", min_workers=0, max_workers=8)
+
+
 class FileChangeHandler(FileSystemEventHandler):
     def __init__(self, callback):
         self.callback = callback
@@ -71,22 +79,8 @@ class FileWatcherPlugin(Plugin):
         self.event_handler = FileChangeHandler(self.handle_message)
         self.start_watch()  # 默认启动 watchdog 监听
 
-        # 缓存相关属性
-        self._contacts_cache = None
-        self._rooms_brief_info_cache = None 
-        self._friends_brief_info_cache = None
-        self._room_members_cache = {}  # {room_wxid: {"members": [...], "update_time": timestamp}}
-        
-        # 不同类型缓存的更新时间
-        self._contacts_update_time = {
-            "all": 0,  # 完整联系人列表的更新时间
-            "rooms": 0,  # 群聊缓存的更新时间
-            "friends": 0  # 好友缓存的更新时间
-        }
-        
-        # 缓存过期时间设置
-        self._cache_expire_seconds = 86400  # 联系人缓存过期时间
-        self._room_members_expire_seconds = 86400  # 群成员缓存过期时间
+        self.contacts = None  # gewechat联系人索引
+        broadcast_pool.resize(0, conf().get("send_msg_broadcast_workers", 8))
 
         # 根据配置获取当前的channel类型
         self.channel_type = conf().get("channel_type", "wx")
@@ -109,99 +103,18 @@ class FileWatcherPlugin(Plugin):
                 self.token = conf().get("gewechat_token")
                 self.app_id = conf().get("gewechat_app_id")
                 self.channel = GewechatClient(self.base_url, self.token)
-                self._update_contacts_cache("all")
+                self.contacts = ContactIndex(
+                    self.channel,
+                    self.app_id,
+                    ttl=conf().get("send_msg_contact_ttl", 86400),
+                    fetch_workers=conf().get("send_msg_fetch_workers", 4),
+                )
+                self.contacts.refresh_async()  # 启动时后台加载，不阻塞插件初始化
             except Exception as e:
                 logger.error(f"未安装gewechat: {e}")
         else:
             logger.error(f"不支持的channel_type: {self.channel_type}")
             
-    def _update_contacts_cache(self, update_type="all"):
-        """
-        更新联系人缓存
-        @param update_type: 更新类型，可选值：
-            - "all": 更新所有内容(默认)
-            - "rooms": 只更新群聊
-            - "friends": 只更新好友
-        """
-        current_time = time.time()
-        
-        # 根据更新类型和缓存状态决定是否需要更新
-        if update_type == "all":
-            if (self._contacts_cache and 
-                current_time - self._cache_update_time < self._cache_expire_seconds):
-                return
-        elif update_type == "rooms":
-            if (self._rooms_brief_info_cache and 
-                current_time - self._cache_update_time < self._cache_expire_seconds):
-                return
-        elif update_type == "friends":
-            if (self._friends_brief_info_cache and 
-                current_time - self._cache_update_time < self._cache_expire_seconds):
-                return
-        else:
-            raise ValueError(f"不支持的更新类型: {update_type}")
-
-        # 获取联系人列表
-        contacts = self.channel.fetch_contacts_list(self.app_id)
-        if contacts.get("ret") != 200:
-            raise ValueError(f"获取联系人列表失败: {contacts.get('msg')}")
-        
-        self._contacts_cache = contacts.get("data", {})
-        
-        # 根据更新类型处理不同的缓存更新
-        if update_type in ["all", "rooms"]:
-            # 更新群聊缓存
-            rooms = self._contacts_cache.get("chatrooms", [])
-            rooms_brief_info = []
-            for i in range(0, len(rooms), 100):
-                rooms_brief_info.extend(
-                    self.channel.get_brief_info(
-                        self.app_id, 
-                        rooms[i:i+100]
-                    ).get("data", [])
-                )
-            self._rooms_brief_info_cache = rooms_brief_info
-            
-        if update_type in ["all", "friends"]:
-            # 更新好友缓存
-            friends = self._contacts_cache.get("friends", [])
-            friends_brief_info = []
-            for i in range(0, len(friends), 100):
-                friends_brief_info.extend(
-                    self.channel.get_brief_info(
-                        self.app_id, 
-                        friends[i:i+100]
-                    ).get("data", [])
-                )
-            self._friends_brief_info_cache = friends_brief_info
-        
-        # 更新缓存时间
-        self._cache_update_time = current_time 
-    def _get_room_members(self, room_wxid):
-        """获取群成员列表(带缓存)"""
-        current_time = time.time()
-        cache_info = self._room_members_cache.get(room_wxid)
-        
-        # 检查缓存是否存在且未过期
-        if (cache_info and 
-            current_time - cache_info["update_time"] < self._room_members_expire_seconds):
-            return cache_info["members"]
-        
-        # 缓存不存在或已过期,重新获取
-        members = self.channel.get_chatroom_member_list(self.app_id, room_wxid)
-        if members.get("ret") == 200:
-            members = members.get("data", {})
-            member_list = members.get("memberList", [])
-            # 更新缓存
-            self._room_members_cache[room_wxid] = {
-                "members": member_list,
-                "update_time": current_time
-            }
-            return member_list
-        else:
-            raise ValueError(f"获取群成员列表失败: {members.get('msg')}")
-
-        
     def on_handle_context(self, e_context: EventContext):
         if e_context['context'].type != ContextType.TEXT:
             return
@@ -338,37 +251,16 @@ class FileWatcherPlugin(Plugin):
         if receiver_names and any(receiver_names):
             if "所有人" in receiver_names or "all" in receiver_names:
                 at_content = "@所有人"
-                self.channel.post_text(self.app_id, wxid, content, at_content)
+                self._schedule_send(wxid, self.channel.post_text, self.app_id, wxid, content, at_content)
                 logger.info(f"发送群聊消息成功, 群聊: {group_name}, @所有人, 消息: {content}")
             else:
-                member_list = self._get_room_members(wxid)
-                
-                at_wxids = []
-                for member in member_list:
-                    if member.get("nickName") in receiver_names:
-                        at_wxids.append(member.get("wxid"))
-                
+                at_wxids = self.contacts.find_members(wxid, receiver_names)
                 if at_wxids:
                     at_content = ",".join(at_wxids)
-                    self.channel.post_text(self.app_id, wxid, content, at_content)
+                    self._schedule_send(wxid, self.channel.post_text, self.app_id, wxid, content, at_content)
                     logger.info(f"发送群聊消息成功, 群聊: {group_name}, @用户: {receiver_names}, 消息: {content}")
                 else:
-                    # 如果找不到成员,尝试刷新群成员缓存再找一次
-                    if wxid in self._room_members_cache:
-                        del self._room_members_cache[wxid]
-                    member_list = self._get_room_members(wxid)
-                    
-                    at_wxids = []
-                    for member in member_list:
-                        if member.get("nickName") in receiver_names:
-                            at_wxids.append(member.get("wxid"))
-                    
-                    if at_wxids:
-                        at_content = ",".join(at_wxids)
-                        self.channel.post_text(self.app_id, wxid, content, at_content)
-                        logger.info(f"发送群聊消息成功, 群聊: {group_name}, @用户: {receiver_names}, 消息: {content}")
-                    else:
-                        logger.warning(f"在群 {group_name} 中未找到指定的成员: {receiver_names}")
+                    logger.warning(f"在群 {group_name} 中未找到指定的成员: {receiver_names}")
         else:
             self._send_gewechat_media_or_text(media_type, content, wxid)
             logger.info(f"发送群聊消息成功, 群聊: {group_name}, 消息: {content}")
@@ -391,77 +283,52 @@ class FileWatcherPlugin(Plugin):
             else:
                 media_type = "text"
             # 过滤空名群聊
-            group_names = [group_name for group_name in group_names if group_name]
-            
-            # 处理群聊消息
-            if group_names:
-                for group_name in group_names:
-                    self._update_contacts_cache("rooms")
-                    room_found = False
-                    
-                    for room in self._rooms_brief_info_cache:
-                        if room.get("nickName") == group_name:
-                            room_found = True
-                            wxid = room.get("userName")
-                            self._send_group_message(group_name, wxid, receiver_names, content, media_type)
-                            break
+            group_names = [group_name for group_name in group_names or [] if group_name]
 
-                    if not room_found:
-                        # 如果缓存中找不到,强制更新缓存后再找一次
-                        self._contacts_update_time["rooms"] = 0  # 只重置群聊缓存时间
-                        self._update_contacts_cache("rooms")
-                        
-                        for room in self._rooms_brief_info_cache:
-                            if room.get("nickName") == group_name:
-                                room_found = True
-                                wxid = room.get("userName")
-                                self._send_group_message(group_name, wxid, receiver_names, content, media_type)
-                                break
-                                
-                        if not room_found:
-                            raise ValueError(f"未找到群聊: {group_name}")
-
-            # 处理私聊消息
+            # 每个群或好友的查找和发送并发执行
+            if group_names:
+                self._fan_out(partial(self._send_gewechat_group, receiver_names=receiver_names, content=content, media_type=media_type), group_names)
             else:
-                for receiver_name in receiver_names:
-                    self._update_contacts_cache()
-                    contact_found = False
-                    
-                    for friend in self._friends_brief_info_cache:
-                        if friend.get("nickName") == receiver_name or friend.get("remark") == receiver_name:
-                            contact_found = True
-                            wxid = friend.get("userName")
-                            self._send_gewechat_media_or_text(media_type, content, wxid)
-                            logger.info(f"发送私聊消息成功, 接收者: {receiver_name}, 消息: {content}")
-                            break
-                    
-                    if not contact_found:
-                        # 如果缓存中找不到,强制更新缓存后再找一次
-                        self._cache_update_time = 0
-                        self._update_contacts_cache()
-                        
-                        for friend in self._friends_brief_info_cache:
-                            if friend.get("nickName") == receiver_name or friend.get("remark") == receiver_name:
-                                contact_found = True
-                                wxid = friend.get("userName")
-                                self._send_gewechat_media_or_text(media_type, content, wxid)
-                                logger.info(f"发送私聊消息成功, 接收者: {receiver_name}, 消息: {content}")
-                                break
-                                
-                        if not contact_found:
-                            raise ValueError(f"未找到联系人: {receiver_name}")
+                self._fan_out(partial(self._send_gewechat_friend, content=content, media_type=media_type), receiver_names)
 
         except Exception as e:
             logger.error(f"发送gewechat消息时发生异常: {e}")
             raise e
 
 
+    def _send_gewechat_group(self, group_name, receiver_names, content, media_type):
+        wxid = self.contacts.find_room(group_name)
+        if not wxid:
+            raise ValueError(f"未找到群聊: {group_name}")
+        self._send_group_message(group_name, wxid, receiver_names, content, media_type)
+
+    def _send_gewechat_friend(self, receiver_name, content, media_type):
+        wxid = self.contacts.find_friend(receiver_name)
+        if not wxid:
+            raise ValueError(f"未找到联系人: {receiver_name}")
+        self._send_gewechat_media_or_text(media_type, content, wxid)
+        logger.info(f"发送私聊消息成功, 接收者: {receiver_name}, 消息: {content}")
+
+    def _fan_out(self, fn, items):
+        """
+        在群发线程池中对每个接收者并发执行fn，全部结束后汇总找不到或发送失败的接收者一起抛出
+        """
+        futures = [broadcast_pool.submit(fn, item) for item in items]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(str(e))
+        if errors:
+            raise ValueError("; ".join(errors))
+
     def _send_gewechat_media_or_text(self, media_type, content, wxid):
         """
         根据消息类型发送不同格式的消息
         """
         if media_type == "text":
-            self.channel.post_text(self.app_id, wxid, content, "")
+            self._schedule_send(wxid, self.channel.post_text, self.app_id, wxid, content, "")
         elif media_type == "img":
             pass
             # self.channel.post_image(self.app_id, wxid, content)
@@ -682,7 +549,19 @@ class FileWatcherPlugin(Plugin):
         else:
             logger.error(f"不支持的消息类型: {media_type}")
 
+    def _schedule_send(self, receiver, fn, *args):
+        """
+        群发消息以最低优先级交给发送调度器，与对话回复共用账号的发送速率限制
+        """
+        if not conf().get("send_scheduler_enabled", True):
+            return fn(*args)
+        account = "gewechat:{}".format(self.app_id) if self.channel_type == "gewechat" else self.channel_type
+        get_send_scheduler(account).submit(receiver, partial(fn, *args), PRIORITY_BULK, desc="send_msg")
+
     def send_msg(self, msg_type, content, to_user_name, at_content=None):
+        self._schedule_send(to_user_name, self._send_itchat_msg, msg_type, content, to_user_name, at_content)
+
+    def _send_itchat_msg(self, msg_type, content, to_user_name, at_content=None):
         """
         实际itchat发送消息函数
         :param msg_type: 消息类型